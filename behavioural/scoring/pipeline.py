@@ -1,8 +1,12 @@
 import pandas as pd
+import os
+import sys
 from edeq import edeq_scoring
 from hads import hads_scoring
 from time_difference import time_diff
 from fNeuro.behavioural.data_functions import connect_to_database
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'utils'))
+from instrumentation import profile
 
 def bmi_calculation() -> pd.DataFrame:
     
@@ -27,14 +31,18 @@ def bmi_calculation() -> pd.DataFrame:
 
 if __name__ == '__main__':
     connector = connect_to_database('BEACON')
-    measures = {
-        'hads_post_break': hads_scoring(),
-        'edeq_post_break': edeq_scoring(),
-        'time_post_break': time_diff(),
-        'bmi_neuroimaging': bmi_calculation(),
-        'neuroimaging_index': pd.read_csv('index.csv').drop('participant', axis=1)
+    scorers = {
+        'hads_post_break': hads_scoring,
+        'edeq_post_break': edeq_scoring,
+        'time_post_break': time_diff,
+        'bmi_neuroimaging': bmi_calculation,
+        'neuroimaging_index': lambda: pd.read_csv('index.csv').drop('participant', axis=1)
 }
+    measures = {}
+    for key, scorer in scorers.items():
+        with profile('score', measure=key):
+            measures[key] = scorer()
 
-    df = measures['edeq_post_break']
     for key in measures.keys():
-        measures[key].to_sql(key, connector) 
\ No newline at end of file
+        with profile('to_sql', measure=key, rows=len(measures[key])):
+            measures[key].to_sql(key, connector) 
\ No newline at end of file
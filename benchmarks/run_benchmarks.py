@@ -0,0 +1,772 @@
+import os
+import sys
+import time
+import shutil
+import socket
+import platform
+import argparse
+import importlib
+import subprocess
+import statistics
+import numpy as np
+import pandas as pd
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from joblib.externals.loky import get_reusable_executor
+from synthetic_data import scales, dataset_params, generate, default_data_dir
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for module_dir in [os.path.join('task_fmri', 'modelling'), os.path.join('task_fmri', 'modelling', 'troubleshooting'),
+                   os.path.join('task_fmri', 'mvpa'), 'utils']:
+    sys.path.append(os.path.join(repo_dir, module_dir))
+from instrumentation import snapshot
+
+'''
+Benchmark suite of the pipeline's stages on synthetic data.
+
+Generates (or reuses) a synthetic dataset at a given scale with
+synthetic_data.py, points the pipeline's config at it and runs each
+stage end to end offline, every repeat in a fresh spawned process so
+peak memory is the stage's own. Wall time, CPU time, peak RSS (of the
+stage's process and of the largest of its worker processes), IO and
+throughput (units of work i.e volumes or subjects per second) are
+appended to a results csv with the run, commit, host, thread count and
+dataset, then compared with the last run of the same dataset on the same
+host and thread count. A stage regresses if its throughput falls or the
+larger of its own and its workers' peak memory grows by more than the
+tolerance.
+
+Stages that need software not available offline are benchmarked through
+the nilearn code they stand in for, SPM 1st level models through
+nilearn's FirstLevelModel as beta_regression.py fits them and PALM
+through nilearn's permutation test after second_level_palm.py has made
+the copes and mask.
+
+Usage
+----
+python run_benchmarks.py -s small
+python run_benchmarks.py -s medium --stages first_level ridge -r 3 --fail
+'''
+
+thread_variables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+result_columns = ['run', 'timestamp', 'commit', 'dirty', 'host', 'python', 'numpy', 'threads', 'jobs', 'dataset',
+                  'scale', 'subjects', 'volumes', 'grid', 'trials', 'stage', 'units', 'unit', 'repeats', 'wall_s',
+                  'cpu_s', 'peak_rss_mb', 'children_peak_rss_mb', 'read_mb', 'write_mb', 'throughput', 'status', 'error']
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of flags
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-s', '--scale',
+                      dest='scale',
+                      default='small',
+                      choices=list(scales.keys()),
+                      help='Preset scale of dataset')
+    args.add_argument('--subjects',
+                      dest='subjects',
+                      type=int,
+                      default=None,
+                      help='Number of subjects. Overrides scale')
+    args.add_argument('--volumes',
+                      dest='volumes',
+                      type=int,
+                      default=None,
+                      help='Number of BOLD volumes. Overrides scale')
+    args.add_argument('--grid',
+                      dest='grid',
+                      type=int,
+                      nargs=3,
+                      default=None,
+                      help='Voxel grid i.e 65 77 65. Overrides scale')
+    args.add_argument('--trials',
+                      dest='trials',
+                      type=int,
+                      default=None,
+                      help='Number of trials. Overrides scale')
+    args.add_argument('--seed',
+                      dest='seed',
+                      type=int,
+                      default=0,
+                      help='Random seed')
+    args.add_argument('-t', '--task',
+                      dest='task',
+                      default='eft',
+                      help='Task name. Either happy, eft or fear')
+    args.add_argument('--stages',
+                      dest='stages',
+                      nargs='+',
+                      default=None,
+                      choices=list(stages.keys()),
+                      help='Stages to run. Default all')
+    args.add_argument('-r', '--repeats',
+                      dest='repeats',
+                      type=int,
+                      default=1,
+                      help='Times to run each stage. Median time is recorded')
+    args.add_argument('--threads',
+                      dest='threads',
+                      type=int,
+                      default=1,
+                      help='BLAS and OpenMP threads of each stage')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=1,
+                      help='Workers of stages that run in parallel')
+    args.add_argument('-p', '--perms',
+                      dest='perms',
+                      type=int,
+                      default=100,
+                      help='Permutations of the second level and ridge stages')
+    args.add_argument('-d', '--data_dir',
+                      dest='data_dir',
+                      default=None,
+                      help='Directory of datasets. Default benchmarks/data')
+    args.add_argument('-o', '--output',
+                      dest='output',
+                      default=None,
+                      help='Results csv. Default benchmarks/results/benchmarks.csv')
+    args.add_argument('--tolerance',
+                      dest='tolerance',
+                      type=float,
+                      default=0.1,
+                      help='Fraction throughput can fall or peak memory grow before a stage regresses')
+    args.add_argument('--fail',
+                      dest='fail',
+                      action='store_true',
+                      help='Exit with status 1 if any stage regresses or errors')
+    return vars(args.parse_args())
+
+
+def task_events(manifest: dict, subject: str, time_point: int) -> pd.DataFrame:
+
+    '''
+    Function to read a subject's events as
+    onset, duration and trial_type
+
+    Parameters
+    ----------
+    manifest: dict
+        dataset manifest
+
+    subject: str
+        subject i.e sub-B1001
+
+    time_point: int
+        1 or 2
+
+    Returns
+    -------
+    pd.DataFrame of events
+    '''
+
+    from design_diagnostics import task_designs
+    task = manifest['params']['task']
+    design = task_designs[task]
+    events_df = pd.read_csv(os.path.join(manifest['root'], 'raw', f'bids_t{time_point}', subject, 'func',
+                                         f'{subject}_task-{task}_events.tsv'), sep=design['sep'])
+    return events_df.rename(columns={design['column']: 'trial_type'})[['onset', 'duration', 'trial_type']]
+
+
+def subject_run(manifest: dict, subject: str, time_point: int) -> tuple:
+
+    '''
+    Function to get a subject's BOLD image and confounds
+
+    Parameters
+    ----------
+    manifest: dict
+        dataset manifest
+
+    subject: str
+        subject i.e sub-B1001
+
+    time_point: int
+        1 or 2
+
+    Returns
+    -------
+    tuple of BOLD image path and confounds pd.DataFrame
+    '''
+
+    from beta_regression import confounds
+    task = manifest['params']['task']
+    func_dir = os.path.join(manifest['env'][task], f'preprocessed_t{time_point}', subject, 'func')
+    bold = os.path.join(func_dir, f'{subject}_task-{task}_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz')
+    return bold, confounds(os.path.join(func_dir, f'{subject}_task-{task}_desc-confounds_timeseries.tsv')).fillna(0)
+
+
+def contrast_maps(manifest: dict, time_point: str = 'T1') -> list:
+
+    '''
+    Function to get the default contrast
+    map of every subject at a time point
+
+    Parameters
+    ----------
+    manifest: dict
+        dataset manifest
+
+    time_point: str
+        T1 or T2
+
+    Returns
+    -------
+    list of paths
+    '''
+
+    task = manifest['params']['task']
+    index_df = pd.read_csv(os.path.join(manifest['env'][task], '1stlevel_index.csv'))
+    return index_df[index_df['default'] & (index_df['timepoint'] == time_point)].sort_values('subject')['path'].tolist()
+
+
+def stage_first_level(manifest: dict, output_dir: str, jobs: int, perms: int) -> int:
+
+    '''
+    Function to fit every subject's 1st level model
+    and compute the task contrast, as SPM would in
+    first_level_{task}.py
+
+    Parameters
+    ----------
+    manifest: dict
+        dataset manifest
+
+    output_dir: str
+        directory to save outputs to
+
+    jobs: int
+        number of workers
+
+    perms: int
+        number of permutations
+
+    Returns
+    -------
+    int of volumes modelled
+    '''
+
+    from beta_regression import glm_1stlevel
+    from design_diagnostics import task_designs
+    design = task_designs[manifest['params']['task']]
+    names = {condition: pattern.strip('^$') for condition, pattern in design['conditions'].items()}
+    for subject in manifest['subjects']:
+        bold, confounds_df = subject_run(manifest, subject, 1)
+        glm = glm_1stlevel().fit(bold, task_events(manifest, subject, 1), confounds=confounds_df)
+        columns = glm.design_matrices_[0].columns
+        contrast = np.array([sum(weight for condition, weight in design['contrast'].items() if names[condition] == column)
+                             for column in columns], dtype=float)
+        glm.compute_contrast(contrast, output_type='effect_size').to_filename(os.path.join(output_dir, f'{subject}_con.nii.gz'))
+    return len(manifest['subjects']) * manifest['params']['volumes']
+
+
+def stage_beta_series(manifest: dict, output_dir: str, jobs: int, perms: int) -> int:
+
+    '''
+    Function to run beta series modelling of
+    every subject as beta_regression.py does
+
+    Parameters
+    ----------
+    manifest: dict
+        dataset manifest
+
+    output_dir: str
+        directory to save outputs to
+
+    jobs: int
+        number of workers
+
+    perms: int
+        number of permutations
+
+    Returns
+    -------
+    int of trials modelled
+    '''
+
+    from beta_regression import glm_1stlevel, glm_events, beta_maps, save_beta_maps
+    for subject in manifest['subjects']:
+        bold, confounds_df = subject_run(manifest, subject, 1)
+        events_df = task_events(manifest, subject, 1)
+        glm_events_df = glm_events(events_df)
+        glm = glm_1stlevel().fit(bold, glm_events_df, confounds=confounds_df)
+        save_dir = os.path.join(output_dir, subject)
+        os.makedirs(save_dir, exist_ok=True)
+        save_beta_maps(beta_maps(glm, events_df, glm_events_df), save_dir)
+    return len(manifest['subjects']) * manifest['params']['trials']
+
+
+def stage_design_diagnostics(manifest: dict, output_dir: str, jobs: int, perms: int) -> int:
+
+    '''
+    Function to build and check every subject's
+    design matrix as design_diagnostics.py does
+
+    Parameters
+    ----------
+    manifest: dict
+        dataset manifest
+
+    output_dir: str
+        directory to save outputs to
+
+    jobs: int
+        number of workers
+
+    perms: int
+        number of permutations
+
+    Returns
+    -------
+    int of designs checked
+    '''
+
+    from design_diagnostics import subject_files, build_design, cohort_metrics, flag_designs
+    task = manifest['params']['task']
+    files_df = subject_files(task, 'T1')
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        designs = list(executor.map(build_design, files_df['subject'], files_df['events'], files_df['confounds'],
+                                    [task] * len(files_df)))
+    metrics_df = cohort_metrics(designs, task)
+    flag_designs(metrics_df, designs, task).to_csv(os.path.join(output_dir, 'design_diagnostics.csv'), index=False)
+    return len(designs)
+
+
+def stage_concat_scans(manifest: dict, output_dir: str, jobs: int, perms: int) -> int:
+
+    '''
+    Function to reduce every participant's T1 and
+    T2 contrast maps as concat_scans.py does
+
+    Parameters
+    ----------
+    manifest: dict
+        dataset manifest
+
+    output_dir: str
+        directory to save outputs to
+
+    jobs: int
+        number of workers
+
+    perms: int
+        number of permutations
+
+    Returns
+    -------
+    int of participants reduced
+    '''
+
+    from concat_scans import paired_scans, reduce_participant
+    files = paired_scans(manifest['params']['task'])
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        report = list(executor.map(reduce_participant, files.index, files['t1'], files['t2'],
+                                   ['diff'] * len(files), [output_dir] * len(files), [6] * len(files)))
+    failed = [participant['error'] for participant in report if participant['status'] == 'failed']
+    if failed:
+        raise RuntimeError(f'{len(failed)} participants failed: {failed[0]}')
+    return len(report)
+
+
+def stage_second_level(manifest: dict, output_dir: str, jobs: int, perms: int) -> int:
+
+    '''
+    Function to make the copes and mask as
+    second_level_palm.py does and run a one sample
+    permutation test in place of PALM
+
+    Parameters
+    ----------
+    manifest: dict
+        dataset manifest
+
+    output_dir: str
+        directory to save outputs to
+
+    jobs: int
+        number of workers
+
+    perms: int
+        number of permutations
+
+    Returns
+    -------
+    int of permutations
+    '''
+
+    from second_level_palm import creating_cope_and_mask
+    from nilearn.glm.second_level import non_parametric_inference
+    scans = contrast_maps(manifest)
+    creating_cope_and_mask(scans, output_dir)
+    log_p = non_parametric_inference(scans, design_matrix=pd.DataFrame({'intercept': np.ones(len(scans))}),
+                                     mask=os.path.join(output_dir, 'mask_img.nii'), n_perm=perms,
+                                     two_sided_test=True, n_jobs=jobs, random_state=0, verbose=0)
+    log_p.to_filename(os.path.join(output_dir, 'vox_logp.nii.gz'))
+    return perms
+
+
+def stage_feature_store(manifest: dict, output_dir: str, jobs: int, perms: int) -> int:
+
+    '''
+    Function to build the MVPA feature
+    store of the contrast maps
+
+    Parameters
+    ----------
+    manifest: dict
+        dataset manifest
+
+    output_dir: str
+        directory to save outputs to
+
+    jobs: int
+        number of workers
+
+    perms: int
+        number of permutations
+
+    Returns
+    -------
+    int of images stored
+    '''
+
+    from feature_store import feature_store, store_path
+    shutil.rmtree(store_path('benchmark'), ignore_errors=True)
+    store = feature_store(contrast_maps(manifest), 'benchmark', n_jobs=jobs)
+    return store['features'].shape[0]
+
+
+def mvpa_data(manifest: dict, jobs: int) -> tuple:
+
+    '''
+    Function to get the MVPA features and targets.
+    Loads the feature store, building it if a previous
+    stage hasn't.
+
+    Parameters
+    ----------
+    manifest: dict
+        dataset manifest
+
+    jobs: int
+        number of workers
+
+    Returns
+    -------
+    tuple of feature store and (subjects x targets) np.ndarray
+    '''
+
+    from feature_store import feature_store
+    store = feature_store(contrast_maps(manifest), 'benchmark', n_jobs=jobs)
+    targets_df = pd.read_csv(os.path.join(manifest['root'], 'targets.csv'), index_col='subject')
+    return store, targets_df.loc[manifest['subjects']].values
+
+
+def stage_ridge(manifest: dict, output_dir: str, jobs: int, perms: int) -> int:
+
+    '''
+    Function to fit ridge to every target and
+    permutations of them over shared folds as
+    permutation_test.py does
+
+    Parameters
+    ----------
+    manifest: dict
+        dataset manifest
+
+    output_dir: str
+        directory to save outputs to
+
+    jobs: int
+        number of workers
+
+    perms: int
+        number of permutations
+
+    Returns
+    -------
+    int of targets fitted
+    '''
+
+    from multi_target import shared_folds, fit_ridge_multi
+    store, Y = mvpa_data(manifest, jobs)
+    rng = np.random.default_rng(0)
+    Y = np.hstack([Y] + [Y[rng.permutation(len(Y))] for _ in range(perms)])
+    fit = fit_ridge_multi(store['features'], Y, shared_folds(len(Y), 5, shuffle_split=False), np.logspace(-1, 5, 13))
+    np.save(os.path.join(output_dir, 'cv_scores.npy'), fit['cv_scores'])
+    return Y.shape[1]
+
+
+def stage_frem(manifest: dict, output_dir: str, jobs: int, perms: int) -> int:
+
+    '''
+    Function to fit FREM to every target
+    over shared folds as build_frem_models.py does
+
+    Parameters
+    ----------
+    manifest: dict
+        dataset manifest
+
+    output_dir: str
+        directory to save outputs to
+
+    jobs: int
+        number of workers
+
+    perms: int
+        number of permutations
+
+    Returns
+    -------
+    int of fold models fitted
+    '''
+
+    from multi_target import shared_folds, fit_frem_multi
+    store, Y = mvpa_data(manifest, jobs)
+    folds = shared_folds(len(Y), 3, shuffle_split=False)
+    fit = fit_frem_multi(store['features'], Y, folds, store['mask_img'], {'C': [0.1, 1], 'epsilon': [0.1]}, n_jobs=jobs)
+    np.save(os.path.join(output_dir, 'coef.npy'), fit['coef'])
+    return len(folds) * Y.shape[1]
+
+
+stages = {
+    'first_level': {'function': stage_first_level, 'unit': 'volumes', 'modules': ['beta_regression', 'design_diagnostics']},
+    'beta_series': {'function': stage_beta_series, 'unit': 'trials', 'modules': ['beta_regression', 'design_diagnostics']},
+    'design_diagnostics': {'function': stage_design_diagnostics, 'unit': 'subjects', 'modules': ['design_diagnostics']},
+    'concat_scans': {'function': stage_concat_scans, 'unit': 'participants', 'modules': ['concat_scans']},
+    'second_level': {'function': stage_second_level, 'unit': 'permutations',
+                     'modules': ['second_level_palm', 'nilearn.glm.second_level']},
+    'feature_store': {'function': stage_feature_store, 'unit': 'images', 'modules': ['feature_store']},
+    'ridge': {'function': stage_ridge, 'unit': 'targets', 'modules': ['feature_store', 'multi_target']},
+    'frem': {'function': stage_frem, 'unit': 'fold models', 'modules': ['feature_store', 'multi_target']},
+}
+
+
+def run_stage(stage: str, manifest: dict, jobs: int, perms: int) -> dict:
+
+    '''
+    Function to run and measure a stage. Runs in a fresh
+    spawned process, the stage's modules are imported
+    before measuring so imports aren't counted. joblib's
+    workers are shut down after the stage so their peak
+    RSS is counted in the children's.
+
+    Parameters
+    ----------
+    stage: str
+        stage name
+
+    manifest: dict
+        dataset manifest
+
+    jobs: int
+        number of workers
+
+    perms: int
+        number of permutations
+
+    Returns
+    -------
+    dict of units, wall, cpu, own and children's peak rss,
+    io, status and error
+    '''
+
+    os.environ.update(manifest['env'])
+    output_dir = os.path.join(manifest['root'], 'outputs', stage)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    for module in stages[stage]['modules']:
+        importlib.import_module(module)
+    start = snapshot()
+    try:
+        units, status, error = stages[stage]['function'](manifest, output_dir, jobs, perms), 'ok', None
+    except Exception as e:
+        units, status, error = 0, 'error', f'{type(e).__name__}: {e}'
+    end = snapshot()
+    get_reusable_executor().shutdown(wait=True)
+    children = snapshot()
+    return {
+        'units': units,
+        'wall_s': end['wall'] - start['wall'],
+        'cpu_s': (end['cpu'] - start['cpu']) + (end['children_cpu'] - start['children_cpu']),
+        'peak_rss_mb': end['max_rss_mb'],
+        'children_peak_rss_mb': children['children_max_rss_mb'],
+        'read_mb': (end['read_bytes'] - start['read_bytes']) / 1024 ** 2,
+        'write_mb': (end['write_bytes'] - start['write_bytes']) / 1024 ** 2,
+        'status': status,
+        'error': error,
+    }
+
+
+def measure(stage: str, manifest: dict, repeats: int, jobs: int, perms: int) -> dict:
+
+    '''
+    Function to run a stage a number of times, each in
+    a new process. Times and IO are the median of the
+    repeats and peak RSS the maximum.
+
+    Parameters
+    ----------
+    stage: str
+        stage name
+
+    manifest: dict
+        dataset manifest
+
+    repeats: int
+        number of repeats
+
+    jobs: int
+        number of workers
+
+    perms: int
+        number of permutations
+
+    Returns
+    -------
+    dict of stage measurements
+    '''
+
+    measurements = []
+    for _ in range(repeats):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            measurements.append(executor.submit(run_stage, stage, manifest, jobs, perms).result())
+        if measurements[-1]['status'] != 'ok':
+            return {**measurements[-1], 'repeats': len(measurements), 'throughput': np.nan}
+    wall = statistics.median(measurement['wall_s'] for measurement in measurements)
+    return {
+        'units': measurements[-1]['units'],
+        'repeats': repeats,
+        'wall_s': round(wall, 4),
+        'cpu_s': round(statistics.median(measurement['cpu_s'] for measurement in measurements), 4),
+        'peak_rss_mb': round(max(measurement['peak_rss_mb'] for measurement in measurements), 1),
+        'children_peak_rss_mb': round(max(measurement['children_peak_rss_mb'] for measurement in measurements), 1),
+        'read_mb': round(statistics.median(measurement['read_mb'] for measurement in measurements), 3),
+        'write_mb': round(statistics.median(measurement['write_mb'] for measurement in measurements), 3),
+        'throughput': round(measurements[-1]['units'] / wall, 4) if wall > 0 else np.nan,
+        'status': 'ok',
+        'error': None,
+    }
+
+
+def git_state() -> tuple:
+
+    '''
+    Function to get the commit of the repo
+    and whether tracked files have changed
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    tuple of short commit hash and dirty bool
+    '''
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+
+def compare(results_df: pd.DataFrame, run: str, tolerance: float) -> pd.DataFrame:
+
+    '''
+    Function to compare a run's stages with the last
+    successful run of the same stage, dataset, host,
+    threads and jobs. Memory is compared on the larger
+    of the stage's own and its workers' peak RSS.
+
+    Parameters
+    ----------
+    results_df: pd.DataFrame
+        all benchmark results
+
+    run: str
+        run to compare
+
+    tolerance: float
+        fraction throughput can fall or
+        peak memory grow before regressing
+
+    Returns
+    -------
+    pd.DataFrame of stage, baseline run, changes and status
+    '''
+
+    keys = ['stage', 'dataset', 'host', 'threads', 'jobs']
+    results_df = results_df.assign(max_rss_mb=np.fmax(results_df['peak_rss_mb'], results_df['children_peak_rss_mb']))
+    current_df = results_df[results_df['run'] == run]
+    previous_df = (results_df[(results_df['run'] != run) & (results_df['status'] == 'ok')]
+                   .sort_values('timestamp').groupby(keys).tail(1))
+    comparison_df = current_df.merge(previous_df, on=keys, how='left', suffixes=('', '_baseline'))
+    comparison_df['throughput_change'] = comparison_df['throughput'] / comparison_df['throughput_baseline'] - 1
+    comparison_df['rss_change'] = comparison_df['max_rss_mb'] / comparison_df['max_rss_mb_baseline'] - 1
+    comparison_df['result'] = np.select(
+        [comparison_df['status'] != 'ok', comparison_df['run_baseline'].isna(),
+         (comparison_df['throughput_change'] < -tolerance) | (comparison_df['rss_change'] > tolerance),
+         comparison_df['throughput_change'] > tolerance],
+        ['error', 'new', 'regression', 'improvement'], default='ok')
+    return comparison_df[['stage', 'unit', 'throughput', 'throughput_baseline', 'throughput_change', 'max_rss_mb',
+                          'max_rss_mb_baseline', 'rss_change', 'run_baseline', 'commit_baseline', 'result']].round(3)
+
+
+if __name__ == '__main__':
+    flags = options()
+    for variable in thread_variables:
+        os.environ[variable] = str(flags['threads'])
+    params = dataset_params(flags['scale'], flags['task'], flags['seed'], subjects=flags['subjects'],
+                            volumes=flags['volumes'], grid=flags['grid'], trials=flags['trials'])
+    manifest = generate(params, flags['data_dir'] if flags['data_dir'] else default_data_dir(), max(flags['jobs'], 4))
+    commit, dirty = git_state()
+    run = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+    run_fields = {
+        'run': run, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'dirty': dirty,
+        'host': socket.gethostname(), 'python': platform.python_version(), 'numpy': np.__version__,
+        'threads': flags['threads'], 'jobs': flags['jobs'], 'dataset': manifest['key'], 'scale': params['scale'],
+        'subjects': params['subjects'], 'volumes': params['volumes'], 'grid': 'x'.join(map(str, params['grid'])),
+        'trials': params['trials'],
+    }
+
+    results = []
+    for stage in flags['stages'] if flags['stages'] else stages.keys():
+        print(f'Running {stage}')
+        result = measure(stage, manifest, flags['repeats'], flags['jobs'], flags['perms'])
+        results.append({**run_fields, 'stage': stage, 'unit': stages[stage]['unit'], **result})
+        print(f'\t{result["status"]} in {result["wall_s"]:.2f}s, {result["throughput"]} {stages[stage]["unit"]}/s, '
+              f'{result["peak_rss_mb"]:.0f}MB peak, {result["children_peak_rss_mb"]:.0f}MB workers peak' if result['status'] == 'ok' else f'\t{result["error"]}')
+
+    output = flags['output'] if flags['output'] else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'benchmarks.csv')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    # Rewritten rather than appended so results from before a column was added stay aligned
+    results_df = pd.DataFrame(results, columns=result_columns)
+    if os.path.exists(output):
+        results_df = pd.concat([pd.read_csv(output), results_df], ignore_index=True).reindex(columns=result_columns)
+    results_df.to_csv(output, index=False)
+    print(f'\nResults of run {run} appended to {output}')
+
+    comparison_df = compare(results_df, run, flags['tolerance'])
+    print(comparison_df.to_string(index=False))
+    failures = comparison_df[comparison_df['result'].isin(['regression', 'error'])]
+    if not failures.empty:
+        print(f'\n{len(failures)} stages regressed or failed: {" ".join(failures["stage"])}')
+        if flags['fail']:
+            sys.exit(1)
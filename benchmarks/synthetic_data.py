@@ -0,0 +1,544 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'task_fmri', 'modelling', 'troubleshooting'))
+from design_diagnostics import task_designs, tr
+
+'''
+Script to generate synthetic fMRI shaped datasets for benchmarking.
+
+Lays out a dataset the way the pipeline expects to find one, BIDS events
+in raw_data/bids_t{n}, fMRIPrep BOLD images, brain masks and confounds in
+{task}/preprocessed_t{n} and 1st level contrast maps with a
+1stlevel_index.csv in {task}/1stlevel, at a configurable number of
+subjects, volumes, voxel grid and trials. BOLD images are a baseline,
+AR(1) noise and the HRF convolved events in a block of voxels, contrast
+maps carry a pattern scaled by each subject's synthetic targets so
+decoders have something to find.
+
+Every file is seeded by the seed, subject and time point so a dataset
+is identical whatever order it is written in. Datasets are keyed by a
+hash of their parameters and a dataset that already exists is reused.
+'''
+
+generator_version = 1
+scales = {
+    'small': {'subjects': 8, 'volumes': 60, 'grid': [24, 28, 24], 'trials': 12},
+    'medium': {'subjects': 24, 'volumes': 150, 'grid': [40, 48, 40], 'trials': 24},
+    'large': {'subjects': 60, 'volumes': 300, 'grid': [65, 77, 65], 'trials': 40},
+}
+n_targets = 5
+n_compcor = 6
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of flags
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-s', '--scale',
+                      dest='scale',
+                      default='small',
+                      choices=list(scales.keys()),
+                      help='Preset scale of dataset')
+    args.add_argument('--subjects',
+                      dest='subjects',
+                      type=int,
+                      default=None,
+                      help='Number of subjects. Overrides scale')
+    args.add_argument('--volumes',
+                      dest='volumes',
+                      type=int,
+                      default=None,
+                      help='Number of BOLD volumes. Overrides scale')
+    args.add_argument('--grid',
+                      dest='grid',
+                      type=int,
+                      nargs=3,
+                      default=None,
+                      help='Voxel grid i.e 65 77 65. Overrides scale')
+    args.add_argument('--trials',
+                      dest='trials',
+                      type=int,
+                      default=None,
+                      help='Number of trials. Overrides scale')
+    args.add_argument('--seed',
+                      dest='seed',
+                      type=int,
+                      default=0,
+                      help='Random seed')
+    args.add_argument('-t', '--task',
+                      dest='task',
+                      default='eft',
+                      choices=list(task_designs.keys()),
+                      help='Task name. Either happy, eft or fear')
+    args.add_argument('-d', '--data_dir',
+                      dest='data_dir',
+                      default=None,
+                      help='Directory to write datasets to. Default benchmarks/data')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=4,
+                      help='Number of workers')
+    return vars(args.parse_args())
+
+
+def dataset_params(scale: str, task: str, seed: int = 0, **overrides) -> dict:
+
+    '''
+    Function to get the parameters of a dataset
+    from a preset scale and any overrides.
+
+    Parameters
+    ----------
+    scale: str
+        preset scale, small, medium or large
+
+    task: str
+        task name
+
+    seed: int
+        random seed
+
+    overrides:
+        subjects, volumes, grid or trials.
+        None values are ignored
+
+    Returns
+    -------
+    dict of dataset parameters
+    '''
+
+    params = {**scales[scale], **{key: value for key, value in overrides.items() if value is not None}}
+    params['grid'] = [int(size) for size in params['grid']]
+    return {'scale': scale, 'task': task, 'seed': seed, **params, 'version': generator_version}
+
+
+def dataset_key(params: dict) -> str:
+
+    '''
+    Function to key a dataset by its parameters
+
+    Parameters
+    ----------
+    params: dict
+        dataset parameters
+
+    Returns
+    -------
+    str of scale and parameter hash i.e small-1a2b3c4d
+    '''
+
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:8]
+    return f'{params["scale"]}-{digest}'
+
+
+def subject_ids(n_subjects: int) -> list:
+
+    '''
+    Function to name subjects
+
+    Parameters
+    ----------
+    n_subjects: int
+        number of subjects
+
+    Returns
+    -------
+    list of subjects i.e sub-B1001
+    '''
+
+    return [f'sub-B{1001 + number}' for number in range(n_subjects)]
+
+
+def affine(grid: list) -> np.ndarray:
+
+    '''
+    Function to get a 2mm affine centred
+    on the grid, as MNI res-2 images are.
+
+    Parameters
+    ----------
+    grid: list
+        voxel grid
+
+    Returns
+    -------
+    np.ndarray of 4x4 affine
+    '''
+
+    matrix = np.diag([2.0, 2.0, 2.0, 1.0])
+    matrix[:3, 3] = -np.array(grid) + 1
+    return matrix
+
+
+def brain_mask(grid: list) -> np.ndarray:
+
+    '''
+    Function to get an ellipsoid brain mask
+    filling most of the grid
+
+    Parameters
+    ----------
+    grid: list
+        voxel grid
+
+    Returns
+    -------
+    np.ndarray of bool mask
+    '''
+
+    coordinates = np.meshgrid(*[np.linspace(-1, 1, size) for size in grid], indexing='ij')
+    return sum(coordinate ** 2 for coordinate in coordinates) < 0.8
+
+
+def activation_pattern(grid: list, rng: np.random.Generator) -> np.ndarray:
+
+    '''
+    Function to get a pattern of activation,
+    a block of voxels in the mask
+
+    Parameters
+    ----------
+    grid: list
+        voxel grid
+
+    rng: np.random.Generator
+        random generator
+
+    Returns
+    -------
+    np.ndarray of float32 pattern
+    '''
+
+    pattern = np.zeros(grid, dtype=np.float32)
+    centre = [rng.integers(size // 3, 2 * size // 3) for size in grid]
+    block = tuple(slice(max(middle - size // 8, 0), middle + size // 8 + 1) for middle, size in zip(centre, grid))
+    pattern[block] = 1
+    return pattern * brain_mask(grid)
+
+
+def make_events(task: str, volumes: int, trials: int, rng: np.random.Generator) -> pd.DataFrame:
+
+    '''
+    Function to make an events file in the format
+    of the task's real events files. Trials cycle
+    through the conditions with jittered onsets.
+
+    Parameters
+    ----------
+    task: str
+        task name
+
+    volumes: int
+        number of volumes
+
+    trials: int
+        number of trials
+
+    rng: np.random.Generator
+        random generator
+
+    Returns
+    -------
+    pd.DataFrame of events
+    '''
+
+    design = task_designs[task]
+    conditions = [pattern.strip('^$') for pattern in design['conditions'].values()]
+    run_length = volumes * tr
+    spacing = (run_length - 4 * tr) / trials
+    onsets = 2 * tr + np.arange(trials) * spacing + rng.uniform(0, spacing / 4, trials)
+    return pd.DataFrame({
+        'trial': np.arange(1, trials + 1),
+        'onset': onsets.round(3),
+        'duration': np.full(trials, round(min(spacing / 2, 4 * tr), 3)),
+        design['column']: [conditions[number % len(conditions)] for number in range(trials)],
+    })
+
+
+def make_confounds(volumes: int, rng: np.random.Generator) -> pd.DataFrame:
+
+    '''
+    Function to make an fMRIPrep confounds file
+    with CompCor and motion parameter expansions.
+    Derivatives start with NaN as fMRIPrep's do.
+
+    Parameters
+    ----------
+    volumes: int
+        number of volumes
+
+    rng: np.random.Generator
+        random generator
+
+    Returns
+    -------
+    pd.DataFrame of confounds
+    '''
+
+    confounds = {f'a_comp_cor_{number:02d}': rng.standard_normal(volumes) for number in range(n_compcor)}
+    for motion in ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']:
+        scale = 0.1 if motion.startswith('trans') else 0.002
+        parameter = np.cumsum(rng.normal(0, scale, volumes))
+        derivative = np.concatenate([[np.nan], np.diff(parameter)])
+        confounds.update({motion: parameter, f'{motion}_derivative1': derivative, f'{motion}_power2': parameter ** 2,
+                          f'{motion}_derivative1_power2': derivative ** 2})
+    return pd.DataFrame(confounds)
+
+
+def make_bold(events_df: pd.DataFrame, task: str, grid: list, volumes: int, rng: np.random.Generator) -> np.ndarray:
+
+    '''
+    Function to make BOLD data, a baseline in the mask,
+    AR(1) noise and the HRF convolved events of each
+    condition in its own pattern of voxels.
+
+    Parameters
+    ----------
+    events_df: pd.DataFrame
+        events of the run
+
+    task: str
+        task name
+
+    grid: list
+        voxel grid
+
+    volumes: int
+        number of volumes
+
+    rng: np.random.Generator
+        random generator
+
+    Returns
+    -------
+    np.ndarray of float32 (grid x volumes) data
+    '''
+
+    from nilearn.glm.first_level import compute_regressor
+
+    mask = brain_mask(grid)
+    frame_times = np.arange(volumes) * tr
+    column = task_designs[task]['column']
+    noise = rng.standard_normal((int(mask.sum()), volumes)).astype(np.float32)
+    for volume in range(1, volumes):
+        noise[:, volume] += 0.3 * noise[:, volume - 1]
+    signal = 100 + 2 * noise
+    for condition, condition_df in events_df.groupby(column):
+        regressor, _ = compute_regressor(np.vstack([condition_df['onset'], condition_df['duration'],
+                                                    np.ones(len(condition_df))]), 'spm', frame_times)
+        signal += 3 * activation_pattern(grid, rng)[mask][:, None] * regressor[:, 0].astype(np.float32)
+    data = np.zeros((*grid, volumes), dtype=np.float32)
+    data[mask] = signal
+    return data
+
+
+def targets(params: dict) -> pd.DataFrame:
+
+    '''
+    Function to make each subject's synthetic
+    targets, standing in for ADOS domain scores
+
+    Parameters
+    ----------
+    params: dict
+        dataset parameters
+
+    Returns
+    -------
+    pd.DataFrame of targets indexed by subject
+    '''
+
+    rng = np.random.default_rng([params['seed'], 0])
+    return pd.DataFrame(rng.standard_normal((params['subjects'], n_targets)).round(4),
+                        index=pd.Index(subject_ids(params['subjects']), name='subject'),
+                        columns=[f'target_{number}' for number in range(n_targets)])
+
+
+def write_subject(params: dict, root: str, subject_number: int, time_point: int) -> list:
+
+    '''
+    Function to write one subject's time point.
+    Runs in the worker processes.
+
+    Parameters
+    ----------
+    params: dict
+        dataset parameters
+
+    root: str
+        root directory of dataset
+
+    subject_number: int
+        number of subject
+
+    time_point: int
+        1 or 2
+
+    Returns
+    -------
+    list of dicts of 1st level index records
+    '''
+
+    task, grid, volumes = params['task'], params['grid'], params['volumes']
+    subject = subject_ids(params['subjects'])[subject_number]
+    rng = np.random.default_rng([params['seed'], subject_number + 1, time_point])
+    image_affine = affine(grid)
+
+    func_dir = os.path.join(root, 'raw', f'bids_t{time_point}', subject, 'func')
+    os.makedirs(func_dir, exist_ok=True)
+    events_df = make_events(task, volumes, params['trials'], rng)
+    events_df.to_csv(os.path.join(func_dir, f'{subject}_task-{task}_events.tsv'),
+                     sep=task_designs[task]['sep'], index=False)
+
+    preprocessed_dir = os.path.join(root, task, f'preprocessed_t{time_point}', subject, 'func')
+    os.makedirs(preprocessed_dir, exist_ok=True)
+    prefix = os.path.join(preprocessed_dir, f'{subject}_task-{task}_space-MNI152NLin2009cAsym_res-2')
+    make_confounds(volumes, rng).to_csv(os.path.join(preprocessed_dir, f'{subject}_task-{task}_desc-confounds_timeseries.tsv'),
+                                        sep='\t', index=False, na_rep='n/a')
+    nibabel.Nifti1Image(make_bold(events_df, task, grid, volumes, rng), image_affine).to_filename(f'{prefix}_desc-preproc_bold.nii.gz')
+    nibabel.Nifti1Image(brain_mask(grid).astype(np.uint8), image_affine).to_filename(f'{prefix}_desc-brain_mask.nii.gz')
+
+    contrast_dir = os.path.join(root, task, '1stlevel', f'T{time_point}', subject)
+    os.makedirs(contrast_dir, exist_ok=True)
+    pattern = activation_pattern(grid, np.random.default_rng([params['seed'], 0, 1]))
+    subject_targets = targets(params).loc[subject].values
+    records = []
+    for contrast in [1, 2]:
+        data = rng.standard_normal(grid).astype(np.float32)
+        if contrast == 1:
+            data += (subject_targets.sum() + 0.5 * (time_point - 1)) * pattern
+        path = os.path.join(contrast_dir, f'con_{contrast:04d}.nii')
+        nibabel.Nifti1Image(data * brain_mask(grid), image_affine).to_filename(path)
+        records.append({'participant': subject.replace('sub-', ''), 'subject': subject, 'group': 'AN',
+                        'task': task, 'timepoint': f'T{time_point}', 'contrast': f'con_{contrast:04d}',
+                        'default': contrast == 1, 'path': path, 'size': os.path.getsize(path),
+                        'mtime_ns': os.stat(path).st_mtime_ns})
+    return records
+
+
+def dataset_env(root: str, task: str) -> dict:
+
+    '''
+    Function to get the config keys pointing
+    the pipeline at a dataset
+
+    Parameters
+    ----------
+    root: str
+        root directory of dataset
+
+    task: str
+        task name
+
+    Returns
+    -------
+    dict of config keys and paths
+    '''
+
+    return {
+        task: os.path.join(root, task),
+        'raw_data': os.path.join(root, 'raw'),
+        'ml': os.path.join(root, 'ml'),
+        'bayesian': os.path.join(root, 'bayesian'),
+        'profiling': os.path.join(root, 'profiling'),
+    }
+
+
+def generate(params: dict, data_dir: str, n_jobs: int = 4) -> dict:
+
+    '''
+    Function to generate a dataset, or load
+    its manifest if it already exists.
+
+    Parameters
+    ----------
+    params: dict
+        dataset parameters from dataset_params
+
+    data_dir: str
+        directory to write datasets to
+
+    n_jobs: int
+        number of workers
+
+    Returns
+    -------
+    dict: dictionary object
+        manifest of key, root, params, env,
+        subjects and generation seconds
+    '''
+
+    key = dataset_key(params)
+    root = os.path.join(data_dir, key)
+    manifest_path = os.path.join(root, 'dataset.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+
+    start = time.perf_counter()
+    print(f'Generating dataset {key}: {params["subjects"]} subjects, {params["volumes"]} volumes, '
+          f'{"x".join(map(str, params["grid"]))} grid, {params["trials"]} trials')
+    jobs = [(subject_number, time_point) for subject_number in range(params['subjects']) for time_point in [1, 2]]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        records = [record for subject_records in executor.map(write_subject, [params] * len(jobs), [root] * len(jobs),
+                                                              *zip(*jobs)) for record in subject_records]
+    pd.DataFrame(records).to_csv(os.path.join(root, params['task'], '1stlevel_index.csv'), index=False)
+    targets(params).to_csv(os.path.join(root, 'targets.csv'))
+    manifest = {
+        'key': key,
+        'root': root,
+        'params': params,
+        'env': dataset_env(root, params['task']),
+        'subjects': subject_ids(params['subjects']),
+        'generation_s': round(time.perf_counter() - start, 2),
+    }
+    # Manifest is written last so an interrupted dataset is regenerated
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    print(f'Dataset written to {root} in {manifest["generation_s"]}s')
+    return manifest
+
+
+def default_data_dir() -> str:
+
+    '''
+    Function to return the default dataset directory
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    str of path to benchmarks/data
+    '''
+
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+if __name__ == '__main__':
+    flags = options()
+    params = dataset_params(flags['scale'], flags['task'], flags['seed'], subjects=flags['subjects'],
+                            volumes=flags['volumes'], grid=flags['grid'], trials=flags['trials'])
+    manifest = generate(params, flags['data_dir'] if flags['data_dir'] else default_data_dir(), flags['jobs'])
+    print(f'Dataset {manifest["key"]} at {manifest["root"]}')
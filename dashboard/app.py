@@ -1,18 +1,32 @@
-from flask import Flask, render_template
-from nilearn import plotting as nplot
-from nilearn import image
-import matplotlib
+from flask import Flask, render_template, send_file, jsonify, abort
+from decouple import config
 import os
+import re
+from render_cache import RenderCache, render_paths
+from dashboard import browser
+from tiles import tiles
 
 app = Flask(__name__)
+renders = RenderCache()
+app.config['renders'] = renders
+app.register_blueprint(browser)
+app.register_blueprint(tiles)
+default_image = config('dashboard_image', default='sub-B1001_task-happy_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz')
 
-@app.route('/')
+@app.route('/viewer')
 def index():
-    func_mean = 'sub-B1001_task-happy_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz' 
-    brain_plot = plot(func_mean)
+    brain_plot = renders.get(default_image)
     return render_template('index.html', plot=brain_plot)
 
-def plot(func_mean):
-    func = image.mean_img(func_mean)
-    plot = nplot.view_img(func, cmap='BuPu', symmetric_cmap=False, opacity=0.7, threshold="auto", cut_coords=(0, 0, 0))
-    return plot.open_in_browser()
+@app.route('/render/<key>.<extension>')
+def rendered(key, extension):
+    if not re.fullmatch(r'[0-9a-f]{40}', key) or extension not in ['html', 'png']:
+        abort(404)
+    path = render_paths(key, renders.save_dir)[extension]
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, max_age=31536000)
+
+@app.route('/render/<key>/status')
+def render_status(key):
+    return jsonify({'key': key, 'status': renders.status(key)})
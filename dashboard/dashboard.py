@@ -1,6 +1,264 @@
-from flask import Flask
-app = Flask(__name__)
+from flask import Blueprint, render_template, request, current_app, make_response, abort, url_for
+from decouple import config
+import os
+import glob
+import hashlib
+import pandas as pd
 
-@app.route('/')
-def hello():
-    return 'hello'
\ No newline at end of file
+'''
+QC and results browser.
+
+Lists every subject, task and time point from the 1st level index with
+their QC gate result. The page is paginated on the server and each
+subject's panels (harvested MRIQC metrics and a thumbnail of the 1st
+level contrast map) are fetched lazily as they scroll into view.
+Responses carry an ETag of the data they were built from so revisits
+are answered with 304 Not Modified until the data changes.
+'''
+
+browser = Blueprint('browser', __name__)
+tasks = ['happy', 'fear', 'eft']
+contrast_settings = {'cmap': 'cold_hot', 'symmetric_cmap': True, 'opacity': 1.0}
+
+class BrowserData:
+
+    '''
+    Tables the browser is built from. Each table is
+    re-read only when its file changes.
+
+    Usage
+    ----
+    data = BrowserData()
+    data.subjects()
+
+    '''
+
+    def __init__(self) -> None:
+        self.tables = {}
+
+    def table(self, path: str, reader) -> pd.DataFrame:
+
+        '''
+        Method to read a table, reusing the
+        loaded copy if the file hasn't changed.
+
+        Parameters
+        ----------
+        path: str
+            path to table
+
+        reader: function
+            function to read table with
+
+        Returns
+        -------
+        pd.DataFrame of table or empty DataFrame if no file
+        '''
+
+        if not os.path.exists(path):
+            return pd.DataFrame()
+        mtime = os.stat(path).st_mtime_ns
+        if path not in self.tables or self.tables[path][0] != mtime:
+            self.tables[path] = (mtime, reader(path))
+        return self.tables[path][1]
+
+    def files(self) -> list:
+
+        '''
+        Method to list the files the browser is built from
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        list of paths
+        '''
+
+        files = [os.path.join(config(task), '1stlevel_index.csv') for task in tasks]
+        files += [os.path.join(config(task), 'qc_gate', 'qc_gate.csv') for task in tasks]
+        files.append(os.path.join(config('mriqc_tables', default=''), 'bold.parquet'))
+        return files
+
+    def version(self) -> str:
+
+        '''
+        Method to get a version of the data from
+        the modification times of its files.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        str of hash
+        '''
+
+        stats = [(path, os.stat(path).st_mtime_ns) for path in self.files() if os.path.exists(path)]
+        return hashlib.sha1(str(stats).encode()).hexdigest()[:16]
+
+    def subjects(self) -> pd.DataFrame:
+
+        '''
+        Method to get every subject, task and time point
+        with its default contrast and QC gate result.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        pd.DataFrame of participant, subject, group, task,
+        timepoint, contrast, path, exclude and reason
+        '''
+
+        subjects = []
+        for task in tasks:
+            index_df = self.table(os.path.join(config(task), '1stlevel_index.csv'), pd.read_csv)
+            if index_df.empty:
+                continue
+            task_df = index_df[index_df['default']].copy()
+            gate_df = self.table(os.path.join(config(task), 'qc_gate', 'qc_gate.csv'), pd.read_csv)
+            if not gate_df.empty:
+                gate_df = gate_df.assign(subject='sub-' + gate_df['sub'].astype(str))[['subject', 'exclude', 'reason']]
+                task_df = task_df.merge(gate_df, on='subject', how='left')
+            subjects.append(task_df)
+        if not subjects:
+            return pd.DataFrame(columns=['participant', 'subject', 'group', 'task', 'timepoint', 'contrast',
+                                         'path', 'exclude', 'reason'])
+        subjects_df = pd.concat(subjects).reindex(columns=['participant', 'subject', 'group', 'task', 'timepoint',
+                                                           'contrast', 'path', 'exclude', 'reason'])
+        return subjects_df.sort_values(['participant', 'task', 'timepoint']).reset_index(drop=True)
+
+    def iqms(self, task: str, subject: str) -> pd.DataFrame:
+
+        '''
+        Method to get the harvested MRIQC metrics
+        of a subject's task runs.
+
+        Parameters
+        ----------
+        task: str
+            task name
+
+        subject: str
+            subject i.e sub-B1001
+
+        Returns
+        -------
+        pd.DataFrame of IQMs, one row per run
+        '''
+
+        bold_df = self.table(os.path.join(config('mriqc_tables', default=''), 'bold.parquet'), pd.read_parquet)
+        if bold_df.empty:
+            return bold_df
+        return bold_df[(bold_df['sub'] == subject.replace('sub-', '')) & (bold_df['task'] == task)]
+
+
+data = BrowserData()
+
+def conditional(html: str, tag: str):
+
+    '''
+    Function to make a response that is answered
+    with 304 Not Modified if the client has it.
+
+    Parameters
+    ----------
+    html: str
+        rendered html
+
+    tag: str
+        ETag of the response
+
+    Returns
+    -------
+    flask.Response
+    '''
+
+    response = make_response(html)
+    response.set_etag(tag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+def request_tag(*parts) -> str:
+
+    '''
+    Function to create an ETag from the data version,
+    the request and any extra parts.
+
+    Parameters
+    ----------
+    parts:
+        extra parts of tag
+
+    Returns
+    -------
+    str of tag
+    '''
+
+    return hashlib.sha1(str((data.version(), request.full_path) + parts).encode()).hexdigest()
+
+
+@browser.route('/')
+def subjects():
+    tag = request_tag()
+    if request.if_none_match.contains(tag):
+        return conditional('', tag)
+    subjects_df = data.subjects()
+    for column in ['task', 'timepoint', 'group']:
+        if request.args.get(column):
+            subjects_df = subjects_df[subjects_df[column] == request.args[column]]
+    if request.args.get('excluded') == '1':
+        subjects_df = subjects_df[subjects_df['exclude'] == True]
+    per_page = min(max(request.args.get('per_page', 30, type=int), 1), 200)
+    pages = max(1, -(-len(subjects_df) // per_page))
+    page = min(max(request.args.get('page', 1, type=int), 1), pages)
+    rows = subjects_df.iloc[(page - 1) * per_page:page * per_page].to_dict(orient='records')
+    filters = {column: request.args.get(column, '') for column in ['task', 'timepoint', 'group', 'excluded']}
+    return conditional(render_template('browser.html', rows=rows, page=page, pages=pages, per_page=per_page,
+                                       total=len(subjects_df), filters=filters, tasks=tasks), tag)
+
+
+@browser.route('/panel/iqms/<task>/<subject>')
+def iqms_panel(task, subject):
+    if task not in tasks:
+        abort(404)
+    tag = request_tag()
+    if request.if_none_match.contains(tag):
+        return conditional('', tag)
+    iqms_df = data.iqms(task, subject)
+    return conditional(render_template('panel_iqms.html', iqms=iqms_df.drop(columns=['path', 'mtime_ns', 'size'], errors='ignore')
+                                       .T.reset_index().values.tolist() if not iqms_df.empty else []), tag)
+
+
+@browser.route('/panel/contrast/<task>/<timepoint>/<subject>')
+def contrast_panel(task, timepoint, subject):
+    subjects_df = data.subjects()
+    row = subjects_df[(subjects_df['task'] == task) & (subjects_df['timepoint'] == timepoint) & (subjects_df['subject'] == subject)]
+    if row.empty:
+        abort(404)
+    render = current_app.config['renders'].get(row['path'].iloc[0], contrast_settings)
+    html = render_template('panel_contrast.html', render=render,
+                           volume_url=url_for('tiles.volume_viewer', task=task, timepoint=timepoint, subject=subject))
+    if render['status'] != 'ready':
+        return html
+    return conditional(html, request_tag(render['key']))
+
+
+@browser.route('/clusters/<task>')
+def clusters(task):
+    if task not in tasks:
+        abort(404)
+    tables = sorted(glob.glob(os.path.join(config(task), '2ndlevel', '*.csv')))
+    tag = request_tag(tuple((table, os.stat(table).st_mtime_ns) for table in tables))
+    if request.if_none_match.contains(tag):
+        return conditional('', tag)
+    cluster_tables = [(os.path.basename(table).split('.')[0], pd.read_csv(table)) for table in tables]
+    return conditional(render_template('clusters.html', task=task, tasks=tasks,
+                                       tables=[(name, table.to_html(index=False, classes='table', na_rep=''))
+                                               for name, table in cluster_tables]), tag)
@@ -0,0 +1,322 @@
+from decouple import config
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+'''
+Cache of pre-rendered brain viewer HTML and PNG thumbnails.
+
+Renders are keyed by the image's path, size and modification time plus
+the render settings, so a changed image or different settings is a new
+render. Cache misses are rendered by a background process pool; the web
+process only stats files and serves what is already on disk, it never
+loads a volume itself.
+'''
+
+default_settings = {
+    'cmap': 'BuPu',
+    'symmetric_cmap': False,
+    'opacity': 0.7,
+    'threshold': 'auto',
+    'cut_coords': [0, 0, 0],
+}
+
+def cache_dir() -> str:
+
+    '''
+    Function to return the render cache directory
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    str of path to render cache
+    '''
+
+    return config('dashboard_cache', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'render_cache'))
+
+
+def render_key(path: str, settings: dict) -> str:
+
+    '''
+    Function to create the cache key of
+    an image and render settings.
+
+    Parameters
+    ----------
+    path: str
+        path to image
+
+    settings: dict
+        render settings
+
+    Returns
+    -------
+    str of sha1 hash
+    '''
+
+    stat = os.stat(path)
+    key = json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns, settings], sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def render_paths(key: str, save_dir: str) -> dict:
+
+    '''
+    Function to return the paths of a render
+
+    Parameters
+    ----------
+    key: str
+        render key
+
+    save_dir: str
+        render cache directory
+
+    Returns
+    -------
+    dict of html, png and error paths
+    '''
+
+    return {
+        'html': os.path.join(save_dir, f'{key}.html'),
+        'png': os.path.join(save_dir, f'{key}.png'),
+        'error': os.path.join(save_dir, f'{key}.error'),
+    }
+
+
+def render(path: str, settings: dict, key: str, save_dir: str) -> str:
+
+    '''
+    Function to render an image to viewer HTML and a PNG thumbnail.
+    4D images are reduced to their mean first. Runs in the
+    worker processes. Files are written to temporary names
+    and moved so a half written render is never served.
+
+    Parameters
+    ----------
+    path: str
+        path to image
+
+    settings: dict
+        render settings
+
+    key: str
+        render key
+
+    save_dir: str
+        render cache directory
+
+    Returns
+    -------
+    str of key
+    '''
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from nilearn import image
+    from nilearn import plotting as nplot
+
+    files = render_paths(key, save_dir)
+    try:
+        brain_img = image.load_img(path)
+        if len(brain_img.shape) == 4:
+            brain_img = image.mean_img(brain_img)
+        view = nplot.view_img(brain_img, cmap=settings['cmap'], symmetric_cmap=settings['symmetric_cmap'],
+                              opacity=settings['opacity'], threshold=settings['threshold'],
+                              cut_coords=tuple(settings['cut_coords']))
+        with open(f'{files["html"]}.tmp', 'w') as html:
+            html.write(view.get_standalone())
+        display = nplot.plot_img(brain_img, cmap=settings['cmap'], cut_coords=tuple(settings['cut_coords']),
+                                 display_mode='ortho', black_bg=True, colorbar=False)
+        display.savefig(f'{files["png"]}.tmp.png', dpi=60)
+        display.close()
+        plt.close('all')
+        os.replace(f'{files["png"]}.tmp.png', files['png'])
+        os.replace(f'{files["html"]}.tmp', files['html'])
+    except Exception as e:
+        with open(files['error'], 'w') as error:
+            error.write(f'{type(e).__name__}: {e}')
+    return key
+
+
+class RenderCache:
+
+    '''
+    Cache of rendered images with a background worker pool.
+
+    Usage
+    ----
+    renders = RenderCache()
+    render = renders.get('sub-B1001_task-happy_bold.nii.gz')
+    render['status'] # ready, pending or failed
+
+    '''
+
+    def __init__(self, save_dir: str = None, max_workers: int = 2) -> None:
+        self.save_dir = save_dir if save_dir else cache_dir()
+        os.makedirs(self.save_dir, exist_ok=True)
+        self.max_workers = max_workers
+        self.executor = None
+        self.pending = {}
+
+    def get(self, path: str, settings: dict = None) -> dict:
+
+        '''
+        Method to look up a render, submitting it to the
+        worker pool if it isn't cached.
+
+        Parameters
+        ----------
+        path: str
+            path to image
+
+        settings: dict
+            render settings. Default default_settings
+
+        Returns
+        -------
+        dict: dictionary object
+            dict of key, status and the html and png paths
+        '''
+
+        settings = {**default_settings, **(settings if settings else {})}
+        if not os.path.exists(path):
+            return {'key': None, 'status': 'failed', 'html': None, 'png': None, 'error': None}
+        key = render_key(path, settings)
+        status = self.status(key)
+        if status == 'missing':
+            self.submit(key, render, path, settings, key, self.save_dir)
+            status = 'pending'
+        return {'key': key, 'status': status, **render_paths(key, self.save_dir)}
+
+    def status(self, key: str) -> str:
+
+        '''
+        Method to get the status of a render
+
+        Parameters
+        ----------
+        key: str
+            render key
+
+        Returns
+        -------
+        str of ready, pending, failed or missing
+        '''
+
+        files = render_paths(key, self.save_dir)
+        if os.path.exists(files['html']):
+            return 'ready'
+        if os.path.exists(files['error']):
+            return 'failed'
+        if self.running(key):
+            return 'pending'
+        return 'missing'
+
+    def running(self, key: str) -> bool:
+
+        '''
+        Method to check if a job is running in the worker pool
+
+        Parameters
+        ----------
+        key: str
+            job key
+
+        Returns
+        -------
+        bool
+        '''
+
+        return key in self.pending and not self.pending[key].done()
+
+    def submit(self, key: str, function, *args) -> None:
+
+        '''
+        Method to submit a job to the worker pool
+
+        Parameters
+        ----------
+        key: str
+            job key
+
+        function: function
+            function to run in a worker
+
+        args:
+            arguments for function
+
+        Returns
+        -------
+        None
+        '''
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        self.pending[key] = self.executor.submit(function, *args)
+        self.pending = {pending_key: future for pending_key, future in self.pending.items() if not future.done()}
+
+    def precompute(self, paths: list, settings: dict = None) -> list:
+
+        '''
+        Method to submit renders of many images
+
+        Parameters
+        ----------
+        paths: list
+            list of paths to images
+
+        settings: dict
+            render settings. Default default_settings
+
+        Returns
+        -------
+        list of render dicts from get
+        '''
+
+        return [self.get(path, settings) for path in paths]
+
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of images and number of workers
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-i', '--images',
+                      dest='images',
+                      nargs='+',
+                      required=True,
+                      help='Images to render')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=4,
+                      help='Number of render workers')
+    return vars(args.parse_args())
+
+
+if __name__ == '__main__':
+    flags = options()
+    renders = RenderCache(max_workers=flags['jobs'])
+    submitted = renders.precompute(flags['images'])
+    print(f'Rendering {sum(render["status"] == "pending" for render in submitted)} of {len(submitted)} images')
+    if renders.executor:
+        renders.executor.shutdown(wait=True)
+    print(f'{sum(renders.status(render["key"]) == "ready" for render in submitted)} renders in {renders.save_dir}')
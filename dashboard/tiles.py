@@ -0,0 +1,295 @@
+from flask import Blueprint, render_template, send_file, jsonify, current_app, request, abort
+from functools import lru_cache
+import os
+import io
+import re
+import json
+import numpy as np
+from render_cache import render_key
+from dashboard import data
+
+'''
+Slice tiles of volumes for the dashboard viewer.
+
+Instead of shipping a whole volume inside the viewer HTML, each image is
+converted once, by the render worker pool, to an uncompressed float32
+.npy cache in RAS orientation with a json of its shape, voxel sizes and
+display window. The web process memory-maps these caches and encodes
+single axial, coronal or sagittal slices to PNG or WebP on request, so
+the browser only fetches the slices being viewed. Open volumes and
+encoded tiles are kept in in-process LRU caches and tiles are served as
+immutable, as a changed image gets a new key.
+'''
+
+tiles = Blueprint('tiles', __name__)
+axes = {'sagittal': 0, 'coronal': 1, 'axial': 2}
+formats = {'png': 'PNG', 'webp': 'WEBP'}
+
+def volume_paths(key: str, save_dir: str) -> dict:
+
+    '''
+    Function to return the paths of a volume cache
+
+    Parameters
+    ----------
+    key: str
+        volume key
+
+    save_dir: str
+        render cache directory
+
+    Returns
+    -------
+    dict of npy, json and error paths
+    '''
+
+    return {
+        'npy': os.path.join(save_dir, f'{key}.npy'),
+        'json': os.path.join(save_dir, f'{key}.json'),
+        'error': os.path.join(save_dir, f'{key}.error'),
+    }
+
+
+def display_window(volume: np.ndarray) -> list:
+
+    '''
+    Function to get the default display window of a volume.
+    Volumes with positive and negative values get a window
+    symmetric around 0.
+
+    Parameters
+    ----------
+    volume: np.ndarray
+        volume data
+
+    Returns
+    -------
+    list of window minimum and maximum
+    '''
+
+    values = volume[volume != 0]
+    if values.size == 0:
+        return [0.0, 1.0]
+    if values.min() < 0 < values.max():
+        limit = float(np.percentile(np.abs(values), 99))
+        return [-limit, limit]
+    return [float(np.percentile(values, 2)), float(np.percentile(values, 98))]
+
+
+def build_volume(path: str, key: str, save_dir: str) -> str:
+
+    '''
+    Function to convert an image to an uncompressed volume cache.
+    4D images are reduced to their mean first. Runs in the
+    render worker processes.
+
+    Parameters
+    ----------
+    path: str
+        path to image
+
+    key: str
+        volume key
+
+    save_dir: str
+        render cache directory
+
+    Returns
+    -------
+    str of key
+    '''
+
+    import nibabel
+    from nilearn import image
+
+    files = volume_paths(key, save_dir)
+    try:
+        brain_img = image.load_img(path)
+        if len(brain_img.shape) == 4:
+            brain_img = image.mean_img(brain_img)
+        brain_img = nibabel.as_closest_canonical(brain_img)
+        volume = np.nan_to_num(np.asarray(brain_img.dataobj, dtype=np.float32))
+        meta = {
+            'shape': list(volume.shape),
+            'zooms': [float(zoom) for zoom in brain_img.header.get_zooms()[:3]],
+            'affine': brain_img.affine.tolist(),
+            'window': display_window(volume),
+        }
+        np.save(f'{files["npy"]}.tmp.npy', np.ascontiguousarray(volume))
+        with open(f'{files["json"]}.tmp', 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(f'{files["npy"]}.tmp.npy', files['npy'])
+        os.replace(f'{files["json"]}.tmp', files['json'])
+    except Exception as e:
+        with open(files['error'], 'w') as error:
+            error.write(f'{type(e).__name__}: {e}')
+    return key
+
+
+def get_volume(renders, path: str) -> dict:
+
+    '''
+    Function to look up a volume cache, submitting
+    it to the render worker pool if it isn't cached.
+
+    Parameters
+    ----------
+    renders: RenderCache
+        render cache with the worker pool
+
+    path: str
+        path to image
+
+    Returns
+    -------
+    dict of key and status
+    '''
+
+    if not os.path.exists(path):
+        return {'key': None, 'status': 'failed'}
+    key = render_key(path, {'volume': 'float32'})
+    files = volume_paths(key, renders.save_dir)
+    if os.path.exists(files['npy']) and os.path.exists(files['json']):
+        return {'key': key, 'status': 'ready'}
+    if os.path.exists(files['error']):
+        return {'key': key, 'status': 'failed'}
+    if not renders.running(key):
+        renders.submit(key, build_volume, path, key, renders.save_dir)
+    return {'key': key, 'status': 'pending'}
+
+
+@lru_cache(maxsize=32)
+def open_volume(save_dir: str, key: str) -> tuple:
+
+    '''
+    Function to memory-map a volume cache
+
+    Parameters
+    ----------
+    save_dir: str
+        render cache directory
+
+    key: str
+        volume key
+
+    Returns
+    -------
+    tuple of np.memmap of volume and dict of meta data
+    '''
+
+    files = volume_paths(key, save_dir)
+    with open(files['json']) as meta_file:
+        meta = json.load(meta_file)
+    return np.load(files['npy'], mmap_mode='r'), meta
+
+
+@lru_cache(maxsize=2048)
+def slice_tile(save_dir: str, key: str, axis: str, index: int, extension: str,
+               vmin: float, vmax: float, cmap: str) -> bytes:
+
+    '''
+    Function to encode a slice of a volume as an image.
+    Slices are rotated so anterior or superior is up.
+
+    Parameters
+    ----------
+    save_dir: str
+        render cache directory
+
+    key: str
+        volume key
+
+    axis: str
+        sagittal, coronal or axial
+
+    index: int
+        slice index
+
+    extension: str
+        png or webp
+
+    vmin: float
+        window minimum
+
+    vmax: float
+        window maximum
+
+    cmap: str
+        matplotlib colormap name or gray
+
+    Returns
+    -------
+    bytes of encoded image
+    '''
+
+    from PIL import Image
+
+    volume, _ = open_volume(save_dir, key)
+    plane = np.rot90(np.take(volume, index, axis=axes[axis]))
+    scaled = np.clip((plane - vmin) / ((vmax - vmin) if vmax > vmin else 1), 0, 1)
+    if cmap == 'gray':
+        tile = Image.fromarray((scaled * 255).astype(np.uint8), mode='L')
+    else:
+        from matplotlib import colormaps
+        tile = Image.fromarray((colormaps[cmap](scaled)[..., :3] * 255).astype(np.uint8), mode='RGB')
+    buffer = io.BytesIO()
+    tile.save(buffer, format=formats[extension], **({'lossless': True} if extension == 'webp' else {}))
+    return buffer.getvalue()
+
+
+def ready_volume(key: str) -> tuple:
+
+    '''
+    Function to open a volume from a
+    request, aborting if it isn't cached.
+
+    Parameters
+    ----------
+    key: str
+        volume key
+
+    Returns
+    -------
+    tuple of np.memmap of volume and dict of meta data
+    '''
+
+    save_dir = current_app.config['renders'].save_dir
+    if not re.fullmatch(r'[0-9a-f]{40}', key) or not os.path.exists(volume_paths(key, save_dir)['json']):
+        abort(404)
+    return open_volume(save_dir, key)
+
+
+@tiles.route('/volume/<task>/<timepoint>/<subject>')
+def volume_viewer(task, timepoint, subject):
+    subjects_df = data.subjects()
+    row = subjects_df[(subjects_df['task'] == task) & (subjects_df['timepoint'] == timepoint) & (subjects_df['subject'] == subject)]
+    if row.empty:
+        abort(404)
+    volume = get_volume(current_app.config['renders'], row['path'].iloc[0])
+    meta = ready_volume(volume['key'])[1] if volume['status'] == 'ready' else None
+    return render_template('volume.html', volume=volume, meta=meta, title=f'{subject} {task} {timepoint}',
+                           cmap=request.args.get('cmap', 'RdBu_r'))
+
+
+@tiles.route('/tiles/<key>/meta')
+def volume_meta(key):
+    response = jsonify(ready_volume(key)[1])
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+@tiles.route('/tiles/<key>/<axis>/<int:index>.<extension>')
+def tile(key, axis, index, extension):
+    from matplotlib import colormaps
+    volume, meta = ready_volume(key)
+    cmap = request.args.get('cmap', 'gray')
+    if axis not in axes or extension not in formats or not 0 <= index < volume.shape[axes[axis]]:
+        abort(404)
+    if cmap != 'gray' and cmap not in colormaps:
+        abort(404)
+    vmin = request.args.get('vmin', meta['window'][0], type=float)
+    vmax = request.args.get('vmax', meta['window'][1], type=float)
+    encoded = slice_tile(current_app.config['renders'].save_dir, key, axis, index, extension, vmin, vmax, cmap)
+    response = send_file(io.BytesIO(encoded), mimetype=f'image/{extension}', max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
@@ -0,0 +1,229 @@
+import argparse
+import os
+import re
+import json
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Script to harvest all the image quality metrics (IQMs)
+from an MRIQC derivatives directory into one parquet table per
+modality (bold, T1w, T2w).
+
+Refreshes are incremental, only jsons which are new or have been
+modified since the last harvest are parsed.
+'''
+
+entities = ['sub', 'ses', 'task', 'acq', 'rec', 'run', 'echo']
+file_columns = ['path', 'mtime_ns', 'size']
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dictionary of flags given
+    '''
+    flags = argparse.ArgumentParser()
+    flags.add_argument('-d', '--dir', dest='dir', help='MRIQC derivatives directory to search through')
+    flags.add_argument('-s', '--save', dest='save', help='directory to save parquet tables to')
+    flags.add_argument('-j', '--jobs', dest='jobs', type=int, default=8, help='number of jsons to read concurrently')
+    return vars(flags.parse_args())
+
+
+def scan_jsons(mriqc_dir: str) -> dict:
+
+    '''
+    Function to walk the MRIQC directory and find
+    every IQM json along with its modification time
+    and size.
+
+    Parameters
+    ----------
+    mriqc_dir: str
+        MRIQC derivatives directory
+
+    Returns
+    -------
+    found: dict
+        dict of path: (mtime_ns, size)
+    '''
+
+    found = {}
+    directories = [mriqc_dir]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.startswith('sub-') and entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    found[entry.path] = (stat.st_mtime_ns, stat.st_size)
+    return found
+
+
+def modality(path: str) -> str:
+
+    '''
+    Function to get the modality (BIDS suffix)
+    of an IQM json i.e bold, T1w
+
+    Parameters
+    ----------
+    path: str
+        path to IQM json
+
+    Returns
+    -------
+    str of modality
+    '''
+    return os.path.basename(path)[:-len('.json')].split('_')[-1]
+
+
+def parse_json(path: str) -> dict:
+
+    '''
+    Function to read an IQM json and flatten it
+    into a single row. BIDS entities are taken from the file name,
+    every scalar IQM is kept and the nested bids_meta
+    and provenance dicts are dropped.
+
+    Parameters
+    ----------
+    path: str
+        path to IQM json
+
+    Returns
+    -------
+    row: dict
+        dict of entities and IQMs
+    '''
+
+    with open(path) as json_file:
+        data = json.load(json_file)
+
+    name = os.path.basename(path)
+    row = {entity: (re.search(rf'(?:^|_){entity}-([a-zA-Z0-9]+)', name) or [None, None])[1] for entity in entities}
+    row['series_description'] = data.get('bids_meta', {}).get('SeriesDescription')
+    for key, value in data.items():
+        if isinstance(value, bool):
+            row[key] = float(value)
+        elif isinstance(value, (int, float)):
+            row[key] = value
+    return row
+
+
+def load_previous(save_dir: str) -> dict:
+
+    '''
+    Function to load tables from a previous harvest
+
+    Parameters
+    ----------
+    save_dir: str
+        directory of parquet tables
+
+    Returns
+    -------
+    dict of modality: pd.DataFrame
+    '''
+
+    if not os.path.isdir(save_dir):
+        return {}
+    return {file[:-len('.parquet')]: pd.read_parquet(os.path.join(save_dir, file))
+            for file in os.listdir(save_dir) if file.endswith('.parquet')}
+
+
+def typed_table(rows: pd.DataFrame) -> pd.DataFrame:
+
+    '''
+    Function to set the schema of a harvested table. BIDS entities
+    and paths are strings, file stats are int64 and all IQMs
+    are float64.
+
+    Parameters
+    ----------
+    rows: pd.DataFrame
+        DataFrame of harvested rows
+
+    Returns
+    -------
+    pd.DataFrame with set dtypes, sorted by subject
+    '''
+
+    string_columns = entities + ['series_description', 'path']
+    schema = {column: ('string' if column in string_columns else
+                       'int64' if column in ['mtime_ns', 'size'] else
+                       'float64') for column in rows.columns}
+    iqms = sorted(column for column in rows.columns if column not in string_columns + file_columns)
+    ordered = [column for column in entities + ['series_description'] if column in rows.columns] + iqms + file_columns
+    return rows.astype(schema)[ordered].sort_values(by=['sub', 'path']).reset_index(drop=True)
+
+
+def harvest(mriqc_dir: str, save_dir: str, jobs: int = 8) -> dict:
+
+    '''
+    Function to harvest IQMs into one parquet table per modality.
+    Rows of unchanged jsons are kept from the previous harvest,
+    rows of removed jsons are dropped.
+
+    Parameters
+    ----------
+    mriqc_dir: str
+        MRIQC derivatives directory
+
+    save_dir: str
+        directory to save parquet tables to
+
+    jobs: int
+        number of jsons to read concurrently
+
+    Returns
+    -------
+    tables: dict
+        dict of modality: pd.DataFrame
+    '''
+
+    found = scan_jsons(mriqc_dir)
+    previous = load_previous(save_dir)
+    kept = {}
+    for table_modality, table in previous.items():
+        unchanged = [found.get(path) == (mtime, size) for path, mtime, size in
+                     zip(table['path'], table['mtime_ns'], table['size'])]
+        kept[table_modality] = table[unchanged]
+
+    known = set(path for table in kept.values() for path in table['path'])
+    to_parse = sorted(path for path in found if path not in known)
+    print(f'Found {len(found)} jsons, {len(to_parse)} new or modified')
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        parsed = list(pool.map(parse_json, to_parse))
+    new_rows = {}
+    for path, row in zip(to_parse, parsed):
+        row.update(zip(file_columns, (path,) + found[path]))
+        new_rows.setdefault(modality(path), []).append(row)
+
+    os.makedirs(save_dir, exist_ok=True)
+    tables = {}
+    for table_modality in sorted(set(kept) | set(new_rows)):
+        table = pd.concat([kept.get(table_modality, pd.DataFrame()),
+                           pd.DataFrame(new_rows.get(table_modality, []))], ignore_index=True)
+        if table.empty:
+            os.remove(os.path.join(save_dir, f'{table_modality}.parquet'))
+            continue
+        tables[table_modality] = typed_table(table)
+        tables[table_modality].to_parquet(os.path.join(save_dir, f'{table_modality}.parquet'), index=False)
+    return tables
+
+
+if __name__ == '__main__':
+    flags = options()
+    tables = harvest(flags['dir'], flags['save'], flags['jobs'])
+    for table_modality, table in tables.items():
+        print(f'{table_modality}: {table.shape[0]} scans, {table.shape[1] - len(file_columns)} columns')
@@ -0,0 +1,146 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from decouple import config
+
+'''
+Script to gate subjects on their harvested MRIQC IQMs.
+
+For each task robust z-scores (median and MAD) are calculated for
+fd_mean, fd_perc and snr. Subjects are excluded if they are an outlier
+on any of these or go over the absolute motion threshold. Include/exclude
+manifests are saved to each task directory for the first and second level
+modelling scripts to read.
+'''
+
+tasks = ['happy', 'fear', 'eft']
+
+# Direction of a bad value for each IQM. 1 = high values are bad, -1 = low values are bad
+gated_iqms = {
+    'fd_mean': 1,
+    'fd_perc': 1,
+    'snr': -1,
+}
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dictionary of flags given
+    '''
+    flags = argparse.ArgumentParser()
+    flags.add_argument('-d', '--dir', dest='dir', help='directory of harvested IQM parquet tables')
+    flags.add_argument('-z', '--z_threshold', dest='z_threshold', type=float, default=3.5,
+                       help='robust z-score over which a subject is an outlier')
+    flags.add_argument('--fd_mean', dest='fd_mean', type=float, default=0.5,
+                       help='absolute mean framewise displacement (mm) over which a subject is excluded')
+    return vars(flags.parse_args())
+
+
+def robust_z(values: pd.Series) -> pd.Series:
+
+    '''
+    Function to calculate robust z-scores using
+    the median and median absolute deviation (MAD)
+    scaled to be consistent with the standard deviation.
+
+    Parameters
+    ----------
+    values: pd.Series
+        values of IQM
+
+    Returns
+    -------
+    pd.Series of robust z-scores
+    '''
+
+    median = values.median()
+    mad = 1.4826 * (values - median).abs().median()
+    if not mad > 0:
+        return pd.Series(np.zeros(len(values)), index=values.index)
+    return (values - median) / mad
+
+
+def gate_task(bold_df: pd.DataFrame, z_threshold: float, fd_mean_threshold: float) -> pd.DataFrame:
+
+    '''
+    Function to gate the subjects of a single task.
+
+    Parameters
+    ----------
+    bold_df: pd.DataFrame
+        harvested bold IQMs of one task
+
+    z_threshold: float
+        robust z-score over which a subject is an outlier
+
+    fd_mean_threshold: float
+        absolute mean framewise displacement (mm) over
+        which a subject is excluded
+
+    Returns
+    -------
+    gate_df: pd.DataFrame
+        DataFrame of subject, IQMs, z-scores, exclude and reason
+    '''
+
+    gate_df = bold_df[['sub'] + list(gated_iqms.keys())].copy().reset_index(drop=True)
+    reasons = [[] for _ in range(gate_df.shape[0])]
+    for iqm, direction in gated_iqms.items():
+        gate_df[f'{iqm}_z'] = robust_z(gate_df[iqm])
+        outlier = (direction * gate_df[f'{iqm}_z'] > z_threshold) | gate_df[iqm].isna()
+        for row in np.flatnonzero(outlier):
+            reasons[row].append(f'{iqm}_z')
+    for row in np.flatnonzero(gate_df['fd_mean'] > fd_mean_threshold):
+        reasons[row].append('fd_mean')
+
+    gate_df['exclude'] = [len(reason) > 0 for reason in reasons]
+    gate_df['reason'] = [';'.join(reason) for reason in reasons]
+    return gate_df.sort_values(by='sub').reset_index(drop=True)
+
+
+def save_manifests(gate_df: pd.DataFrame, save_dir: str) -> None:
+
+    '''
+    Function to save the gate table and the include and
+    exclude manifests. Manifests have one subject per
+    line (i.e sub-B1001) in the same format as the
+    SLURM participant index files.
+
+    Parameters
+    ----------
+    gate_df: pd.DataFrame
+        DataFrame from gate_task
+
+    save_dir: str
+        directory to save manifests to
+
+    Returns
+    -------
+    None
+    '''
+
+    os.makedirs(save_dir, exist_ok=True)
+    gate_df.to_csv(os.path.join(save_dir, 'qc_gate.csv'), index=False)
+    for manifest, subjects in [('include', gate_df[~gate_df['exclude']]['sub']),
+                               ('exclude', gate_df[gate_df['exclude']]['sub'])]:
+        with open(os.path.join(save_dir, f'{manifest}.participants'), 'w') as manifest_file:
+            manifest_file.writelines(f'sub-{subject}\n' for subject in subjects)
+
+
+if __name__ == '__main__':
+    flags = options()
+    bold_df = pd.read_parquet(os.path.join(flags['dir'], 'bold.parquet'))
+    for task in tasks:
+        gate_df = gate_task(bold_df[bold_df['task'] == task], flags['z_threshold'], flags['fd_mean'])
+        save_dir = os.path.join(config(task), 'qc_gate')
+        save_manifests(gate_df, save_dir)
+        print(f'{task}: {(~gate_df["exclude"]).sum()} included, {gate_df["exclude"].sum()} excluded. Saved to {save_dir}')
@@ -0,0 +1,276 @@
+from decouple import config
+import os
+import json
+import hashlib
+import itertools
+import argparse
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+'''
+Headless figure engine.
+
+Figures are described in a JSON spec rather than drawn interactively in a
+notebook. Each spec entry is a glass brain, stat map, mosaic or anatomical
+figure of an image with its threshold, cut coords and any other nilearn
+plotting arguments. Entries can be expanded over tasks and contrasts with
+{task} and {contrast} placeholders, image paths starting with {task_dir}
+are resolved against the task's directory from the .env and an entry with
+"index" expands over every default contrast in the task's 1stlevel_index.csv.
+
+Figures are rendered by a pool of worker processes with the Agg backend.
+A manifest in the output directory records the key of every figure, made
+from the path, size and modification time of its images and its spec, so
+figures whose inputs and spec haven't changed are skipped.
+
+Example spec
+------------
+{
+    "output_dir": "/path/to/figures",
+    "defaults": {"threshold": 3.1, "cmap": "cold_hot", "dpi": 300},
+    "figures": [
+        {"name": "{task}_group_tstat", "kind": "glass_brain", "tasks": ["happy", "fear", "eft"],
+         "image": "{task_dir}/2ndlevel/mixed_model/vox_tstat_group.nii.gz", "plot_abs": false}
+    ]
+}
+'''
+
+plots = {
+    'glass_brain': 'plot_glass_brain',
+    'stat_map': 'plot_stat_map',
+    'mosaic': 'plot_stat_map',
+    'anat': 'plot_anat',
+}
+spec_keys = ['name', 'kind', 'image', 'tasks', 'contrasts', 'index', 'format', 'dpi']
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of spec, jobs and force
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-s', '--spec',
+                      dest='spec',
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'figures.json'),
+                      help='Path to figure spec')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=4,
+                      help='Number of render workers')
+    args.add_argument('-f', '--force',
+                      dest='force',
+                      action='store_true',
+                      help='Render all figures even if unchanged')
+    return vars(args.parse_args())
+
+
+def output_dir(spec: dict) -> str:
+
+    '''
+    Function to return the figure directory of a spec
+
+    Parameters
+    ----------
+    spec: dict
+        figure spec
+
+    Returns
+    -------
+    str of path to figure directory
+    '''
+
+    return spec.get('output_dir', config('figures', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'figures')))
+
+
+def expand_figures(spec: dict) -> list:
+
+    '''
+    Function to expand the entries of a spec
+    into one dictionary per figure.
+
+    Parameters
+    ----------
+    spec: dict
+        figure spec
+
+    Returns
+    -------
+    list of figure dictionaries
+    '''
+
+    figures = []
+    for entry in spec['figures']:
+        entry = {**spec.get('defaults', {}), **entry}
+        if entry['kind'] not in plots:
+            raise ValueError(f'Unknown figure kind {entry["kind"]} of {entry["name"]}')
+        for task, contrast in itertools.product(entry.get('tasks', [None]), entry.get('contrasts', [None])):
+            fields = {'task': task, 'contrast': contrast, 'task_dir': config(task) if task else None}
+            if entry.get('index'):
+                index_df = pd.read_csv(os.path.join(config(task), '1stlevel_index.csv'))
+                index_df = index_df.loc[index_df['default'].astype(bool)]
+                if contrast:
+                    index_df = index_df[index_df['contrast'] == contrast]
+                rows = [{**fields, **row} for row in index_df[['subject', 'timepoint', 'contrast', 'path']].to_dict(orient='records')]
+            else:
+                rows = [fields]
+            for row in rows:
+                figure = {key: value.format(**row) if isinstance(value, str) else value for key, value in entry.items()
+                          if key not in ['tasks', 'contrasts', 'index']}
+                if entry.get('index'):
+                    figure['image'] = row['path']
+                figures.append(figure)
+    names = [figure['name'] for figure in figures]
+    duplicated = set(name for name in names if names.count(name) > 1)
+    if duplicated:
+        raise ValueError(f'Figure names are not unique: {sorted(duplicated)}')
+    return figures
+
+
+def figure_key(figure: dict) -> str:
+
+    '''
+    Function to create the key of a figure from
+    its images and spec.
+
+    Parameters
+    ----------
+    figure: dict
+        figure dictionary
+
+    Returns
+    -------
+    str of sha1 hash
+    '''
+
+    images = [figure['image']] + ([figure['bg_img']] if isinstance(figure.get('bg_img'), str) else [])
+    stats = [(os.path.abspath(image), os.stat(image).st_size, os.stat(image).st_mtime_ns) for image in images]
+    return hashlib.sha1(json.dumps([stats, figure], sort_keys=True).encode()).hexdigest()
+
+
+def render_figure(figure: dict, save_dir: str) -> dict:
+
+    '''
+    Function to render a figure. Runs in the worker
+    processes. The figure is written to a temporary
+    name and moved so a half written figure is never
+    left behind.
+
+    Parameters
+    ----------
+    figure: dict
+        figure dictionary
+
+    save_dir: str
+        figure directory
+
+    Returns
+    -------
+    dict of name, path and error
+    '''
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from nilearn import plotting as nplot
+
+    extension = figure.get('format', 'png')
+    path = os.path.join(save_dir, f'{figure["name"]}.{extension}')
+    kwargs = {key: tuple(value) if isinstance(value, list) else value
+              for key, value in figure.items() if key not in spec_keys}
+    if figure['kind'] == 'mosaic':
+        kwargs['display_mode'] = 'mosaic'
+    try:
+        display = getattr(nplot, plots[figure['kind']])(figure['image'], **kwargs)
+        display.savefig(f'{path}.tmp.{extension}', dpi=figure.get('dpi', 300))
+        display.close()
+        os.replace(f'{path}.tmp.{extension}', path)
+        error = None
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    plt.close('all')
+    return {'name': figure['name'], 'path': path, 'error': error}
+
+
+def render_figures(figures: list, save_dir: str, n_jobs: int = 4, force: bool = False) -> pd.DataFrame:
+
+    '''
+    Function to render figures in parallel, skipping
+    figures that are unchanged since the last run.
+
+    Parameters
+    ----------
+    figures: list
+        list of figure dictionaries
+
+    save_dir: str
+        figure directory
+
+    n_jobs: int
+        number of render workers
+
+    force: bool
+        render all figures
+
+    Returns
+    -------
+    pd.DataFrame of name, status, path and error of each figure
+    '''
+
+    os.makedirs(save_dir, exist_ok=True)
+    manifest_path = os.path.join(save_dir, 'figure_manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+
+    results, todo = [], []
+    for figure in figures:
+        if not os.path.exists(figure['image']):
+            results.append({'name': figure['name'], 'status': 'missing', 'path': None, 'error': f'No image {figure["image"]}'})
+            continue
+        key = figure_key(figure)
+        path = os.path.join(save_dir, f'{figure["name"]}.{figure.get("format", "png")}')
+        if not force and manifest.get(figure['name']) == key and os.path.exists(path):
+            results.append({'name': figure['name'], 'status': 'unchanged', 'path': path, 'error': None})
+            continue
+        todo.append((figure, key))
+
+    print(f'Rendering {len(todo)} of {len(figures)} figures')
+    if todo:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            rendered = executor.map(render_figure, [figure for figure, _ in todo], itertools.repeat(save_dir))
+            for (figure, key), result in zip(todo, rendered):
+                if result['error']:
+                    print(f'Failed {figure["name"]}: {result["error"]}')
+                    manifest.pop(figure['name'], None)
+                    results.append({**result, 'status': 'failed'})
+                else:
+                    manifest[figure['name']] = key
+                    results.append({**result, 'status': 'rendered'})
+
+    with open(f'{manifest_path}.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+    return pd.DataFrame(results, columns=['name', 'status', 'path', 'error'])
+
+
+if __name__ == '__main__':
+    flags = options()
+    with open(flags['spec']) as spec_file:
+        spec = json.load(spec_file)
+    save_dir = output_dir(spec)
+    results_df = render_figures(expand_figures(spec), save_dir, flags['jobs'], flags['force'])
+    results_df.to_csv(os.path.join(save_dir, 'figure_report.csv'), index=False)
+    print(results_df['status'].value_counts().to_string())
+    print(f'Figures saved to {save_dir}')
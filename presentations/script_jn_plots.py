@@ -1,42 +1,45 @@
-import subprocess
-import nbformat as nbf
-import sys
+from figure_engine import render_figures
+import argparse
 import os
 
-def notebook():
-    nb = nbf.v4.new_notebook()
-    text = """\
-    # My first automatic Jupyter Notebook
-    This is an auto-generated notebook."""
-
-    imports = """
-    %pylab inline
-    import matplotlib.pyplot as plt
-    from nilearn import image as nimg
-    from nilearn import plotting as nplot
-    """
-    images = """
-    image = nimg.load_img("/data/project/BEACONB/task_fmri/happy/preprocessed_t2/sub-B1001/anat/sub-B1001_space-MNI152NLin2009cAsym_res-2_desc-preproc_T1w.nii.gz")
-    """
-    plots = """
-    nplot.view_img(image, bg_img=False, cmap='Grey_r', symmetric_cmap=False, threshold="auto")
-    """
-
-    nb['cells'] = [nbf.v4.new_markdown_cell(text),
-                   nbf.v4.new_code_cell(imports),
-                   nbf.v4.new_code_cell(images),
-                   nbf.v4.new_code_cell(plots)]
-    
-    fname = 'plotting.ipynb'
-    with open(fname, 'w') as f:
-        nbf.write(nb, f)
-
-def executeJupyter():
-    openJupyter = "jupyter-notebook plotting.ipynb"
-    subprocess.Popen(openJupyter, shell=True)
-
-notebook()
-executeJupyter()
-print('done')
+'''
+Script to plot an anatomical image. Used to write
+a notebook and open it in jupyter, now renders the
+figure headlessly with the figure engine. Use
+figure_engine.py with a spec for batches of figures.
+'''
 
+def options() -> dict:
 
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of image and output directory
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-i', '--image',
+                      dest='image',
+                      default='/data/project/BEACONB/task_fmri/happy/preprocessed_t2/sub-B1001/anat/sub-B1001_space-MNI152NLin2009cAsym_res-2_desc-preproc_T1w.nii.gz',
+                      help='Image to plot')
+    args.add_argument('-o', '--output',
+                      dest='output',
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'figures'),
+                      help='Directory to save figure to')
+    return vars(args.parse_args())
+
+
+if __name__ == '__main__':
+    flags = options()
+    figure = {'name': os.path.basename(flags['image']).split('.')[0], 'kind': 'anat', 'image': flags['image'],
+              'cmap': 'gray', 'display_mode': 'ortho', 'dim': 'auto'}
+    results_df = render_figures([figure], flags['output'], n_jobs=1)
+    print(results_df.to_string(index=False))
+    print('done')
@@ -10,6 +10,9 @@ import os
 from bids.layout import BIDSLayout
 import sys
 from decouple import config
+from qc_manifest import excluded_subjects
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'utils'))
+from instrumentation import profile
 
 def subjectinfo(subject_id: str) -> list:
 
@@ -86,6 +89,9 @@ def subjectinfo(subject_id: str) -> list:
 #  Global parameters lots of these are repeated due to nipype quirks
 experiment_dir = config('happy')
 subject_to_analyse = [sys.argv[1]] 
+if subject_to_analyse[0] in excluded_subjects('happy'):
+    print(f'{subject_to_analyse[0]} was excluded by the QC gate. Not running 1st level model')
+    sys.exit(0)
 layout = BIDSLayout(os.path.join(experiment_dir,'preprocessed_t1', subject_to_analyse[0]), validate=False)
 img_file = layout.get(subject=subject_to_analyse[0].lstrip('sub-'), datatype='func', 
                       space='MNI152NLin2009cAsym', suffix='bold', extension='nii.gz')[0]
@@ -207,7 +213,8 @@ level_1_analysis.connect([
 
 if __name__ == "__main__":
     level_1_analysis.write_graph(graph2use='colored', format='png', simple_form=True)
-    level_1_analysis.run()
+    with profile('first_level_glm', subject=subject_to_analyse[0], task='happy'):
+        level_1_analysis.run()
     print('\n\n','-'*100)
     print(f'\nCompleted 1st Level modelling for {subject_to_analyse[0]}\n')
     print('Cleaning up workingdir')
@@ -0,0 +1,311 @@
+from decouple import config
+import os
+import re
+import argparse
+import pandas as pd
+
+'''
+Script to build an index of the 1st level outputs of each task.
+
+One scan of the 1stlevel directory records every con, spmT, beta image
+and SPM.mat with its size and modification time, keyed by participant,
+task, time point and contrast. T1 and T2 subjects are paired into one
+participant (keyed by their T1 G-Number) using 1stlevel_location.csv
+at build time. The contrast listed in 1stlevel_location.csv is marked
+as the default contrast for second level modelling.
+'''
+
+tasks = ['happy', 'fear', 'eft']
+time_points = ['T1', 'T2']
+index_columns = ['participant', 'task', 'timepoint', 'contrast']
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of tasks to index
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-t', '--task',
+                      dest='task',
+                      nargs='+',
+                      default=tasks,
+                      help='Task names. Any of happy, eft or fear')
+    return vars(args.parse_args())
+
+
+def index_path(task: str) -> str:
+
+    '''
+    Function to return the path of the index of a task
+
+    Parameters
+    ----------
+    task: str
+        Name of task. Must be happy, fear or eft.
+
+    Returns
+    -------
+    str of path to index csv
+    '''
+
+    return os.path.join(config(task), '1stlevel_index.csv')
+
+
+def subject_id(scan: str) -> str:
+
+    '''
+    Function to get the subject from a path
+    i.e sub-G1001 from .../T1/sub-G1001/con_0001.nii
+
+    Parameters
+    ----------
+    scan: str
+        path to a scan
+
+    Returns
+    -------
+    str of subject or None if no subject in path
+    '''
+
+    subject = re.findall(r'sub-[A-Za-z0-9]+', str(scan))
+    return subject[-1] if subject else None
+
+
+def participant_pairs(base_path: str) -> dict:
+
+    '''
+    Function to pair T1 and T2 subjects using 1stlevel_location.csv.
+    Only read when building the index.
+
+    Parameters
+    ----------
+    base_path: str
+        absolute path to task directory
+
+    Returns
+    -------
+    dict: dictionary object
+        dict of pairs {subject: participant} where participant is the
+        T1 subject if the participant has one and default contrasts
+    '''
+
+    location_df = pd.read_csv(f"{base_path}/1stlevel_location.csv")
+    pairs = {}
+    for t1, t2 in zip(location_df['t1'], location_df['t2']):
+        participant = subject_id(t1) or subject_id(t2)
+        pairs.update({subject: participant for subject in [subject_id(t1), subject_id(t2)] if subject})
+    default_contrasts = set(os.path.basename(str(scan)).split('.')[0] for scan in location_df[['t1', 't2']].values.ravel()
+                            if subject_id(scan))
+    return {
+        'pairs': pairs,
+        'default_contrasts': default_contrasts
+    }
+
+
+def build_index(task: str) -> pd.DataFrame:
+
+    '''
+    Function to build the index of a task's 1st level
+    outputs with one scan of the 1stlevel directory.
+
+    Parameters
+    ----------
+    task: str
+        Name of task. Must be happy, fear or eft.
+
+    Returns
+    -------
+    index_df: pd.DataFrame
+        DataFrame of participant, subject, group, task, timepoint,
+        contrast, default, path, size and mtime_ns
+    '''
+
+    base_path = config(task)
+    participants = participant_pairs(base_path)
+    records = []
+    for time_point in time_points:
+        time_point_dir = os.path.join(base_path, '1stlevel', time_point)
+        if not os.path.isdir(time_point_dir):
+            continue
+        with os.scandir(time_point_dir) as subject_dirs:
+            for subject_dir in subject_dirs:
+                if not subject_dir.name.startswith('sub-') or not subject_dir.is_dir():
+                    continue
+                with os.scandir(subject_dir.path) as files:
+                    for file in files:
+                        contrast = file.name.split('.')[0]
+                        if not file.is_file() or not re.match(r'(con|spmT|beta|ess|spmF)_\d+$|SPM$', contrast):
+                            continue
+                        stat = file.stat()
+                        records.append({
+                            'participant': participants['pairs'].get(subject_dir.name, subject_dir.name),
+                            'subject': subject_dir.name,
+                            'group': 'HC' if re.match(r'sub-[GB]1', subject_dir.name) else 'AN',
+                            'task': task,
+                            'timepoint': time_point,
+                            'contrast': contrast,
+                            'default': contrast in participants['default_contrasts'],
+                            'path': file.path,
+                            'size': stat.st_size,
+                            'mtime_ns': stat.st_mtime_ns,
+                        })
+    return pd.DataFrame(records, columns=['participant', 'subject', 'group', 'task', 'timepoint', 'contrast',
+                                          'default', 'path', 'size', 'mtime_ns']).sort_values(by=index_columns).reset_index(drop=True)
+
+
+class FirstLevelIndex:
+
+    '''
+    Index of 1st level outputs across tasks.
+    Look ups are done from a dictionary keyed by
+    (participant, task, timepoint, contrast).
+
+    Usage
+    ----
+    index = FirstLevelIndex(['eft', 'happy'])
+    index.path('sub-G1001', 'happy', 'T2')
+    scans_df = index.subject_scans('eft')
+    all_tasks_df = index.task_scans(['eft', 'happy'])
+
+    '''
+
+    def __init__(self, index_tasks: list) -> None:
+        self.frame = pd.concat([pd.read_csv(index_path(task)) for task in index_tasks], ignore_index=True)
+        self.records = {key: record for key, record in
+                        zip(self.frame[index_columns].itertuples(index=False, name=None),
+                            self.frame.to_dict(orient='records'))}
+        self.defaults = self.frame[self.frame['default']].groupby('task')['contrast'].first().to_dict()
+
+    def record(self, participant: str, task: str, time_point: str, contrast: str = None) -> dict:
+        contrast = contrast or self.defaults[task]
+        return self.records[(participant, task, time_point, contrast)]
+
+    def path(self, participant: str, task: str, time_point: str, contrast: str = None) -> str:
+        return validate(self.record(participant, task, time_point, contrast))
+
+    def subject_scans(self, task: str, contrast: str = None, complete: bool = True) -> pd.DataFrame:
+
+        '''
+        Method to get a dataframe of participants' T1 and T2 scans
+        for a contrast. Only participants with both time points are
+        returned unless complete is False.
+
+        Parameters
+        ----------
+        task: str
+            Name of task. Must be happy, fear or eft.
+
+        contrast: str
+            name of contrast i.e con_0001. Default is
+            the contrast from 1stlevel_location.csv
+
+        complete: bool
+            Drop participants missing a time point. If False
+            they are kept with a missing path of NaN
+
+        Returns
+        -------
+        pd.DataFrame: DataFrame
+            DataFrame of participant, group, t1 and t2
+        '''
+
+        contrast = contrast or self.defaults[task]
+        task_df = self.frame[(self.frame['task'] == task) & (self.frame['contrast'] == contrast)]
+        scans_df = task_df.pivot(index='participant', columns='timepoint', values='path').rename(
+            columns={'T1': 't1', 'T2': 't2'}).reindex(columns=['t1', 't2'])
+        if complete:
+            scans_df = scans_df.dropna()
+        scans_df['group'] = task_df.groupby('participant')['group'].first()
+        for participant in scans_df.index:
+            for time_point in time_points:
+                if (participant, task, time_point, contrast) in self.records:
+                    validate(self.records[(participant, task, time_point, contrast)])
+        return scans_df.reset_index().rename_axis(columns=None)[['participant', 'group', 't1', 't2']]
+
+
+    def task_scans(self, scan_tasks: list) -> pd.DataFrame:
+
+        '''
+        Method to get a dataframe of participants' T1 and T2 scans
+        of the default contrast of several tasks. Only participants
+        with both time points of every task are returned.
+
+        Parameters
+        ----------
+        scan_tasks: list
+            list of tasks. Each must be in the index
+
+        Returns
+        -------
+        pd.DataFrame: DataFrame
+            DataFrame of participant, group and {task}_t1
+            and {task}_t2 of each task
+        '''
+
+        scans_df = None
+        for task in scan_tasks:
+            task_df = self.subject_scans(task).rename(columns={'t1': f'{task}_t1', 't2': f'{task}_t2'})
+            scans_df = task_df if scans_df is None else scans_df.merge(task_df.drop(columns='group'), on='participant')
+        return scans_df.reset_index(drop=True)
+
+    def participants(self, task: str) -> pd.Series:
+
+        '''
+        Method to map a task's subjects
+        to their participant
+
+        Parameters
+        ----------
+        task: str
+            Name of task
+
+        Returns
+        -------
+        pd.Series of participant indexed by subject
+        '''
+
+        return self.frame[self.frame['task'] == task].drop_duplicates('subject').set_index('subject')['participant']
+
+
+def validate(record: dict) -> str:
+
+    '''
+    Function to check an indexed file still exists.
+    Warns if the file has changed since it was indexed.
+
+    Parameters
+    ----------
+    record: dict
+        record from FirstLevelIndex
+
+    Returns
+    -------
+    str of path to file
+    '''
+
+    try:
+        stat = os.stat(record['path'])
+    except FileNotFoundError:
+        raise FileNotFoundError(f"{record['path']} is in the 1st level index but doesn't exist. Rebuild the index")
+    if (stat.st_size, stat.st_mtime_ns) != (record['size'], record['mtime_ns']):
+        print(f"Warning: {record['path']} has changed since it was indexed")
+    return record['path']
+
+
+if __name__ == '__main__':
+    flags = options()
+    for task in flags['task']:
+        print(f'Indexing 1st level outputs for {task}')
+        index_df = build_index(task)
+        index_df.to_csv(index_path(task), index=False)
+        print(f'\t{index_df.shape[0]} files from {index_df["participant"].nunique()} participants saved to {index_path(task)}')
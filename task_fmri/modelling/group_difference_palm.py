@@ -9,6 +9,8 @@ import re
 import nilearn.image as img
 import numpy as np
 from itertools import chain
+from qc_manifest import drop_excluded
+from first_level_index import FirstLevelIndex
 
 def options() -> dict:
 
@@ -58,25 +60,25 @@ def paths(task: str) -> dict:
     }
 
 
-def subject_scans(base_path: str) -> pd.DataFrame:
+def subject_scans(task: str) -> pd.DataFrame:
 
     '''
-    Function to load csv of subjects scans.
-    Will remove one subject who doesn't have T1 scan.
+    Function to get subjects scans from the 1st level index.
+    Only participants with both time points are kept and
+    any participants excluded by the QC gate are removed.
 
     Parameters
     ----------
-    base_path: str
-       absolute path to task directory
+    task: str
+       str of happy, fear, eft.
 
     Returns
     -------
     subject_scans_df: pd.DataFrame
         csv of subjects scans locations 
     '''
-    subject_scans_df = pd.read_csv(f"{base_path}/1stlevel_location.csv")
-    subject_scans_df = subject_scans_df.drop(subject_scans_df[subject_scans_df['t1'] == 75].index)
-    return subject_scans_df
+    subject_scans_df = FirstLevelIndex([task]).subject_scans(task)
+    return drop_excluded(subject_scans_df, task)
 
 
 def create_desgin_matrix(subjects_scans: dict) -> pd.DataFrame:
@@ -251,7 +253,7 @@ if __name__ == "__main__":
     # Creates design matrix and gets list of participants scans
     print('\nSetting up workflow\n')
     print('\tGetting participants scans and setting up design matrix\n')
-    participant_scans = subject_scans(paths_location['base_path'])
+    participant_scans = subject_scans(flags['task'])
     scans = mean_imgs(participant_scans)
     design_matrix = create_desgin_matrix(scans)
     
@@ -6,6 +6,9 @@ import nilearn.image as img
 from nilearn.glm.second_level import non_parametric_inference
 import nibabel
 import argparse
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from first_level_index import FirstLevelIndex
 
 def options() -> dict:
 
@@ -55,25 +58,24 @@ def paths(task: str) -> dict:
     }
 
 
-def subject_scans(base_path: str) -> pd.DataFrame:
+def subject_scans(task: str) -> pd.DataFrame:
 
     '''
-    Function to load csv of subjects scans.
-    Will remove one subject who doesn't have T1 scan.
+    Function to load subjects scans of the default contrast
+    from the 1st level index. Only participants with both
+    time points are kept.
 
     Parameters
     ----------
-    base_path: str
-       absolute path to task directory
+    task: str
+       str of happy, fear, eft.
 
     Returns
     -------
     subject_scans_df: pd.DataFrame
-        csv of subjects scans locations 
+        DataFrame of subjects T1 and T2 scans locations 
     '''
-    subject_scans_df = pd.read_csv(f"{base_path}/1stlevel_location.csv")
-    subject_scans_df = subject_scans_df.drop(subject_scans_df[subject_scans_df['t1'] == 75].index)
-    return subject_scans_df
+    return FirstLevelIndex([task]).subject_scans(task)
 
 
 def create_desgin_matrix(subjects_scans: dict) -> pd.DataFrame:
@@ -175,7 +177,7 @@ if __name__ == "__main__":
     print('Starting up permutated ols for group differences')
     flags = options()
     path = paths(flags['task'])
-    scans_location = subject_scans(path['base_path'])
+    scans_location = subject_scans(flags['task'])
     mean_images = mean_img(scans_location)
     design_matrix = create_desgin_matrix(mean_images)
     mask = img.load_img(os.path.join(path['mixed_model'], 'mask_img.nii.gz' ))
@@ -0,0 +1,59 @@
+from decouple import config
+import os
+import pandas as pd
+
+'''
+Functions to read the QC gate manifests made by mriqc/qc_gate.py
+'''
+
+def excluded_subjects(task: str) -> set:
+
+    '''
+    Function to get the subjects excluded by the QC gate
+    for a task. If the gate hasn't been ran then no
+    subjects are excluded.
+
+    Parameters
+    ----------
+    task: str
+        Name of task. Must be happy, fear or eft.
+
+    Returns
+    -------
+    set of excluded subjects i.e sub-B1001
+    '''
+
+    manifest = os.path.join(config(task), 'qc_gate', 'exclude.participants')
+    if not os.path.exists(manifest):
+        return set()
+    with open(manifest) as manifest_file:
+        return set(line.strip() for line in manifest_file if line.strip())
+
+
+def drop_excluded(subject_scans_df: pd.DataFrame, task: str) -> pd.DataFrame:
+
+    '''
+    Function to drop participants from a dataframe of
+    T1 and T2 scans if either scan was excluded by the QC gate.
+    The index is kept so subjects keep their row number.
+
+    Parameters
+    ----------
+    subject_scans_df: pd.DataFrame
+        Dataframe of participants scans with t1 and t2 columns
+
+    task: str
+        Name of task. Must be happy, fear or eft.
+
+    Returns
+    -------
+    pd.DataFrame of participants scans that passed QC
+    '''
+
+    excluded = excluded_subjects(task)
+    if not excluded:
+        return subject_scans_df
+    failed_qc = pd.concat([subject_scans_df[time_point].astype(str).apply(
+        lambda scan: any(f'{subject}/' in scan for subject in excluded)) for time_point in ['t1', 't2']], axis=1).any(axis=1)
+    print(f'\tDropping {failed_qc.sum()} participants excluded by the QC gate')
+    return subject_scans_df[~failed_qc]
@@ -7,6 +7,11 @@ import argparse
 import glob
 import re
 import nilearn.image as img
+from qc_manifest import drop_excluded
+from first_level_index import FirstLevelIndex
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'utils'))
+from instrumentation import profile
 
 def options() -> dict:
 
@@ -91,19 +96,21 @@ def set_up_design_df(df: pd.DataFrame, subtractve=False) -> pd.DataFrame:
     long_df['group'] = long_df['scans'].apply(lambda participants: design_matrix_value if 'sub-G1' in participants or 'sub-B1' in participants else 1)
     long_df['time'] = long_df['time_point'].apply(lambda participants: design_matrix_value if 't1' in participants else 1)
     long_df['intercept'] = 1
-    long_df = long_df.drop(long_df[long_df['sub'] == 75].index)
 
     return long_df
 
-def create_design_matrix(path: str, subtractive=False, random_effects_subtractive=False) -> dict:
+def create_design_matrix(task: str, subtractive=False, random_effects_subtractive=False) -> dict:
     
     '''
-    Function to create a design matrix
+    Function to create a design matrix. Participants scans
+    are taken from the 1st level index so only participants with
+    both time points are used. Participants excluded by the QC 
+    gate are dropped.
 
     Parameters
     ----------
-    path: str
-        File path to csv of participants scans
+    task: str
+        Name of task. Must be happy, fear or eft.
     
     subtractive: bool 
         If true will set 0 in design matrix to -1. 
@@ -120,7 +127,7 @@ def create_design_matrix(path: str, subtractive=False, random_effects_subtractiv
         
     '''
 
-    participant_scans = pd.read_csv(f"{path}/1stlevel_location.csv")
+    participant_scans = drop_excluded(FirstLevelIndex([task]).subject_scans(task), task)
     long_df = set_up_design_df(participant_scans, subtractive)
     scans = long_df['scans'].to_list()
     random_effects = pd.get_dummies(long_df['sub']).add_prefix('sub-')
@@ -290,13 +297,15 @@ if __name__ == "__main__":
     # Creates design matrix and gets list of participants scans
     print('\nSetting up workflow\n')
     print('\tGetting participants scans and setting up design matrix\n')
-    matrix_dict = create_design_matrix(paths['base_dir'], random_effects_subtractive=False, subtractive=False)
+    with profile('design_matrix', task=flags['task']):
+        matrix_dict = create_design_matrix(flags['task'], random_effects_subtractive=False, subtractive=False)
     
     # Creates and saves design files 
     print('\nCreating design files')
     create_design_files(matrix_dict['design_matrix'], paths['2ndlevel_dir'], matrix_dict['scans'])
     # Get all scans into same space and create a mask for palm
-    creating_cope_and_mask(matrix_dict['scans'], paths['2ndlevel_dir'])
+    with profile('copes_and_mask', task=flags['task'], scans=len(matrix_dict['scans'])):
+        creating_cope_and_mask(matrix_dict['scans'], paths['2ndlevel_dir'])
 
     # Makes results directory and defines path
     os.mkdir(os.path.join(paths['2ndlevel_dir'], 'mixed_model'))
@@ -306,7 +315,8 @@ if __name__ == "__main__":
     
     # Runs Palm
     print('\nStarting Palm now\n')
-    run_palm(paths['2ndlevel_dir'], results_path, flags['perms'])
+    with profile('palm', task=flags['task'], perms=flags['perms']):
+        run_palm(paths['2ndlevel_dir'], results_path, flags['perms'])
     
     # Moves files into results directory and deletes any working directories
     print('Cleaning up directory')
@@ -0,0 +1,334 @@
+from decouple import config
+import os
+import re
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+'''
+Script to check every subject's 1st level design before any model is ran.
+
+Each subject's design is built from their events and the confounds used
+by the 1st level scripts (aCompCor components and motion expansions)
+with nilearn, no BOLD data is loaded. Conditions are convolved with the
+canonical HRF and no parametric modulation, so these are the designs of
+the unmodulated contrasts. Designs are built in parallel, then grouped by
+shape and stacked so the condition number, VIFs, correlation of the task
+regressors with the confounds and contrast efficiency are computed for
+each group in a few batched linear algebra calls.
+
+Subjects are flagged if the design is rank deficient, badly conditioned,
+a condition has no events, a task regressor has a high VIF or the
+contrast efficiency is far below the cohort's.
+'''
+
+task_designs = {
+    'eft': {
+        'sep': '\t',
+        'column': 'Condition',
+        'conditions': {'Baseline': 'Baseline', 'ComplexFigures': 'ComplexFigures', 'SimpleFigures': 'SimpleFigures'},
+        'contrast': {'ComplexFigures': 1, 'SimpleFigures': -1},
+    },
+    'happy': {
+        'sep': ',',
+        'column': 'trial_type',
+        'conditions': {'blank': 'Blank', 'neutral': 'Neutral', 'partially_happy': 'Partially_happy', 'happy': '^happy$'},
+        'contrast': {'neutral': -1, 'partially_happy': 0, 'happy': 1},
+    },
+    'fear': {
+        'sep': ',',
+        'column': 'trial_type',
+        'conditions': {'blank': 'Blank', 'neutral': 'Neutral', 'partially_fear': 'Partially_fear', 'fear': '^fear$'},
+        'contrast': {'neutral': -1, 'partially_fear': 0, 'fear': 1},
+    },
+}
+confound_regex = r'^(a_comp_cor_\d+|(trans|rot)_[xyz]_(derivative1|power2|derivative1_power2))$'
+tr = 2.0
+metric_columns = ['n_scans', 'n_columns', 'rank', 'condition_number', 'max_task_vif', 'max_task_vif_column',
+                  'max_task_confound_r', 'max_task_confound_pair', 'contrast_efficiency']
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of flags
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-t', '--task',
+                      dest='task',
+                      help='Task name. Either happy, eft or fear')
+    args.add_argument('-p', '--time_point',
+                      dest='time_point',
+                      default='T1',
+                      help='Time point, T1 or T2')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=8,
+                      help='Number of workers building designs')
+    args.add_argument('-v', '--vif',
+                      dest='vif',
+                      type=float,
+                      default=10,
+                      help='Flag task regressors with a VIF above this')
+    args.add_argument('-c', '--condition_number',
+                      dest='condition_number',
+                      type=float,
+                      default=1000,
+                      help='Flag designs with a condition number above this')
+    return vars(args.parse_args())
+
+
+def subject_files(task: str, time_point: str) -> pd.DataFrame:
+
+    '''
+    Function to get the events and confounds
+    files of every preprocessed subject.
+
+    Parameters
+    ----------
+    task: str
+        task name
+
+    time_point: str
+        T1 or T2
+
+    Returns
+    -------
+    pd.DataFrame of subject, events and confounds paths
+    '''
+
+    number = time_point[-1]
+    subjects = sorted(os.path.basename(path) for path in
+                      glob.glob(os.path.join(config(task), f'preprocessed_t{number}', 'sub-*')))
+    return pd.DataFrame({
+        'subject': subjects,
+        'events': [os.path.join(config('raw_data'), f'bids_t{number}', subject, 'func',
+                                f'{subject}_task-{task}_events.tsv') for subject in subjects],
+        'confounds': [os.path.join(config(task), f'preprocessed_t{number}', subject, 'func',
+                                   f'{subject}_task-{task}_desc-confounds_timeseries.tsv') for subject in subjects],
+    })
+
+
+def build_design(subject: str, events_path: str, confounds_path: str, task: str) -> dict:
+
+    '''
+    Function to build a subject's design matrix.
+    Runs in the worker processes.
+
+    Parameters
+    ----------
+    subject: str
+        subject i.e sub-B1001
+
+    events_path: str
+        path to events tsv
+
+    confounds_path: str
+        path to fmriprep confounds tsv
+
+    task: str
+        task name
+
+    Returns
+    -------
+    dict of subject, design matrix, number of
+    events per condition and error
+    '''
+
+    from nilearn.glm.first_level import make_first_level_design_matrix
+
+    design = task_designs[task]
+    try:
+        events_df = pd.read_csv(events_path, sep=design['sep'])
+        confounds_df = pd.read_csv(confounds_path, sep='\t').fillna(0)
+        confounds_df = confounds_df[[column for column in confounds_df.columns if re.match(confound_regex, column)]]
+        trials = []
+        for condition, pattern in design['conditions'].items():
+            condition_df = events_df[events_df[design['column']].astype(str).str.contains(pattern)]
+            trials.append(pd.DataFrame({'onset': condition_df['onset'], 'duration': condition_df['duration'],
+                                        'trial_type': condition}))
+        trials_df = pd.concat(trials)
+        frame_times = np.arange(len(confounds_df)) * tr
+        X = make_first_level_design_matrix(frame_times, trials_df, hrf_model='spm', drift_model='cosine',
+                                           high_pass=1 / 128, add_regs=confounds_df.values,
+                                           add_reg_names=list(confounds_df.columns))
+        X = X.reindex(columns=list(design['conditions'].keys()) + [column for column in X.columns
+                                                                   if column not in design['conditions']], fill_value=0)
+        return {'subject': subject, 'design': X, 'n_events': trials_df['trial_type'].value_counts().to_dict(), 'error': None}
+    except Exception as e:
+        return {'subject': subject, 'design': None, 'n_events': {}, 'error': f'{type(e).__name__}: {e}'}
+
+
+def batch_metrics(X: np.ndarray, columns: list, task: str) -> pd.DataFrame:
+
+    '''
+    Function to compute design metrics of a stack of
+    designs of the same shape.
+
+    Parameters
+    ----------
+    X: np.ndarray
+        (subjects x scans x columns) designs
+
+    columns: list
+        column names of designs
+
+    task: str
+        task name
+
+    Returns
+    -------
+    pd.DataFrame of metrics, one row per design
+    '''
+
+    conditions = list(task_designs[task]['conditions'].keys())
+    task_columns = np.array([column in conditions for column in columns])
+    confound_columns = np.array([bool(re.match(confound_regex, column)) for column in columns])
+    varying = np.array([column != 'constant' for column in columns])
+
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    singular_values = np.linalg.svd(X / np.where(norms > 0, norms, 1), compute_uv=False)
+    tolerance = singular_values[:, :1] * max(X.shape[1:]) * np.finfo(float).eps
+    rank = (singular_values > tolerance).sum(axis=1)
+    condition_number = np.where(singular_values[:, -1] > tolerance[:, 0],
+                                singular_values[:, 0] / np.maximum(singular_values[:, -1], np.finfo(float).tiny), np.inf)
+
+    Z = X[:, :, varying] - X[:, :, varying].mean(axis=1, keepdims=True)
+    std = Z.std(axis=1, keepdims=True)
+    Z = Z / np.where(std > 0, std, 1)
+    correlation = np.einsum('snp,snq->spq', Z, Z) / X.shape[1]
+    vif = np.einsum('spp->sp', np.linalg.pinv(correlation, hermitian=True))
+    task_vif = vif[:, task_columns[varying]]
+    task_confound_r = np.abs(correlation[:, task_columns[varying]][:, :, confound_columns[varying]])
+
+    contrast = np.array([task_designs[task]['contrast'].get(column, 0) for column in columns], dtype=float)
+    XtX_inv = np.linalg.pinv(np.einsum('snp,snq->spq', X, X), hermitian=True)
+    efficiency = 1 / np.einsum('p,spq,q->s', contrast, XtX_inv, contrast)
+
+    task_names = np.array(columns)[varying][task_columns[varying]]
+    confound_names = np.array(columns)[varying][confound_columns[varying]]
+    return pd.DataFrame({
+        'n_scans': X.shape[1],
+        'n_columns': X.shape[2],
+        'rank': rank,
+        'condition_number': condition_number,
+        'max_task_vif': task_vif.max(axis=1),
+        'max_task_vif_column': task_names[task_vif.argmax(axis=1)],
+        'max_task_confound_r': task_confound_r.max(axis=(1, 2)) if confound_names.size else np.nan,
+        'max_task_confound_pair': [f'{task_names[i]}~{confound_names[j]}' for i, j in
+                                   zip(*np.unravel_index(task_confound_r.reshape(len(X), -1).argmax(axis=1),
+                                                         task_confound_r.shape[1:]))] if confound_names.size else None,
+        'contrast_efficiency': efficiency,
+    })
+
+
+def cohort_metrics(designs: list, task: str) -> pd.DataFrame:
+
+    '''
+    Function to compute design metrics of a cohort,
+    batching designs of the same shape and columns.
+
+    Parameters
+    ----------
+    designs: list
+        list of dicts from build_design
+
+    task: str
+        task name
+
+    Returns
+    -------
+    pd.DataFrame of metrics, one row per subject.
+    Metrics of designs that failed to build are NaN
+    '''
+
+    built = [design for design in designs if design['design'] is not None]
+    groups = {}
+    for design in built:
+        groups.setdefault(tuple(design['design'].columns) + (len(design['design']),), []).append(design)
+    metrics = []
+    for key, group in groups.items():
+        group_df = batch_metrics(np.stack([design['design'].values for design in group]).astype(float), list(key[:-1]), task)
+        metrics.append(group_df.assign(subject=[design['subject'] for design in group]))
+    failed_df = pd.DataFrame({'subject': [design['subject'] for design in designs if design['design'] is None]})
+    return pd.concat(metrics + [failed_df]).reindex(columns=metric_columns + ['subject'])
+
+
+def flag_designs(metrics_df: pd.DataFrame, designs: list, task: str, max_vif: float = 10,
+                 max_condition_number: float = 1000) -> pd.DataFrame:
+
+    '''
+    Function to flag degenerate designs
+
+    Parameters
+    ----------
+    metrics_df: pd.DataFrame
+        design metrics
+
+    designs: list
+        list of dicts from build_design
+
+    task: str
+        task name
+
+    max_vif: float
+        flag task regressors with a VIF above this
+
+    max_condition_number: float
+        flag designs with a condition number above this
+
+    Returns
+    -------
+    pd.DataFrame of metrics with flags and errors
+    '''
+
+    details_df = pd.DataFrame([{'subject': design['subject'], 'error': design['error'],
+                                'missing_conditions': ' '.join(condition for condition in task_designs[task]['conditions']
+                                                               if design['design'] is not None
+                                                               and design['n_events'].get(condition, 0) == 0)}
+                               for design in designs])
+    metrics_df = details_df.merge(metrics_df, on='subject', how='left')
+    median_efficiency = metrics_df['contrast_efficiency'].median()
+    checks = {
+        'not_built': metrics_df['error'].notna(),
+        'rank_deficient': metrics_df['rank'] < metrics_df['n_columns'],
+        'ill_conditioned': metrics_df['condition_number'] > max_condition_number,
+        'missing_condition': metrics_df['missing_conditions'] != '',
+        'high_vif': metrics_df['max_task_vif'] > max_vif,
+        'low_efficiency': metrics_df['contrast_efficiency'] < 0.5 * median_efficiency,
+    }
+    metrics_df['flags'] = [' '.join(name for name, check in checks.items() if check.iloc[row])
+                           for row in range(len(metrics_df))]
+    metrics_df['degenerate'] = metrics_df['flags'] != ''
+    return metrics_df.sort_values(['degenerate', 'subject'], ascending=[False, True])
+
+
+if __name__ == '__main__':
+    flags = options()
+    files_df = subject_files(flags['task'], flags['time_point'])
+    print(f'Building {len(files_df)} {flags["task"]} {flags["time_point"]} designs')
+    with ProcessPoolExecutor(max_workers=flags['jobs']) as executor:
+        designs = list(executor.map(build_design, files_df['subject'], files_df['events'], files_df['confounds'],
+                                    [flags['task']] * len(files_df), chunksize=4))
+    metrics_df = flag_designs(cohort_metrics(designs, flags['task']), designs, flags['task'],
+                              flags['vif'], flags['condition_number'])
+    save_dir = os.path.join(config(flags['task']), 'design_diagnostics')
+    os.makedirs(save_dir, exist_ok=True)
+    metrics_df.to_csv(os.path.join(save_dir, f'design_diagnostics_{flags["time_point"]}.csv'), index=False)
+    degenerate_df = metrics_df[metrics_df['degenerate']]
+    print(f'{len(degenerate_df)} of {len(metrics_df)} designs flagged')
+    if not degenerate_df.empty:
+        print(degenerate_df[['subject', 'flags', 'condition_number', 'max_task_vif', 'contrast_efficiency']].to_string(index=False))
+    print(f'Saved to {save_dir}')
@@ -0,0 +1,262 @@
+import os
+import re
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+'''
+Script to diagnose failed nipype runs across all subjects at once.
+
+Walks log and 1st level directories for nipype crash-*.pklz files and
+SPM.mat files and parses them in parallel. Crashes are grouped by node
+and exception signature, the exception with subject ids, numbers and
+paths taken out, so one error hitting many subjects is one row listing
+the subjects. Every SPM.mat design matrix is summarised as its size,
+rank, condition number and column names in one table.
+'''
+
+tasks = ['happy', 'fear', 'eft']
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of directories, output and jobs
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-d', '--directories',
+                      dest='directories',
+                      nargs='+',
+                      required=True,
+                      help='Logs and 1st level directories to scan')
+    args.add_argument('-o', '--output',
+                      dest='output',
+                      default=None,
+                      help='Directory to save tables to. Default first directory')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=8,
+                      help='Number of workers')
+    return vars(args.parse_args())
+
+
+def find_files(directories: list) -> dict:
+
+    '''
+    Function to find crash files and SPM.mat files
+
+    Parameters
+    ----------
+    directories: list
+        list of directories to walk
+
+    Returns
+    -------
+    dict of lists of crash and spm paths
+    '''
+
+    files = {'crash': [], 'spm': []}
+    for directory in directories:
+        for root, _, names in os.walk(directory):
+            for name in names:
+                if name.startswith('crash-') and name.endswith('.pklz'):
+                    files['crash'].append(os.path.join(root, name))
+                elif name == 'SPM.mat':
+                    files['spm'].append(os.path.join(root, name))
+    return files
+
+
+def path_fields(text: str) -> dict:
+
+    '''
+    Function to get the subject, task and time
+    point from a path or traceback.
+
+    Parameters
+    ----------
+    text: str
+        path or text
+
+    Returns
+    -------
+    dict of subject, task and time point, None if not found
+    '''
+
+    subject = re.search(r'sub-[GB]\d+', text)
+    task = re.search(rf'\b({"|".join(tasks)})\b', text)
+    time_point = re.search(r'\b(T[12])\b', text)
+    return {
+        'subject': subject.group(0) if subject else None,
+        'task': task.group(1) if task else None,
+        'time_point': time_point.group(1) if time_point else None,
+    }
+
+
+def signature(exception: str) -> str:
+
+    '''
+    Function to normalise an exception so the same
+    error from different subjects matches.
+
+    Parameters
+    ----------
+    exception: str
+        last line of a traceback
+
+    Returns
+    -------
+    str of exception signature
+    '''
+
+    exception = re.sub(r'sub-[GB]\d+', 'sub-<id>', exception)
+    exception = re.sub(r'(/[^\s\'",:]+)+', '<path>', exception)
+    exception = re.sub(r'0x[0-9a-f]+', '<address>', exception)
+    return re.sub(r'\d+(\.\d+)?', '<n>', exception)[:300]
+
+
+def parse_crash(path: str) -> dict:
+
+    '''
+    Function to parse a nipype crash file.
+    Node name and iteration come from the file name
+    crash-date-time-user-node.iteration-uuid.pklz
+
+    Parameters
+    ----------
+    path: str
+        path to crash file
+
+    Returns
+    -------
+    dict of crash details
+    '''
+
+    name = re.match(r'crash-(?P<date>\d{8})-(?P<time>\d{6})-[^-]+-(?P<node>.+?)(\.(?P<iteration>[a-z]\d+))?-[0-9a-f]{8}-',
+                    os.path.basename(path))
+    crash = {'path': path, 'node': name.group('node') if name else None,
+             'iteration': name.group('iteration') if name else None,
+             'time': pd.to_datetime(name.group('date') + name.group('time'), format='%Y%m%d%H%M%S') if name else None}
+    try:
+        from nipype.utils.filemanip import loadpkl
+        content = loadpkl(path)
+        traceback = ''.join(content['traceback']) if isinstance(content['traceback'], list) else str(content['traceback'])
+        node_dir = ''
+        try:
+            node_dir = content['node'].output_dir()
+        except Exception:
+            pass
+        exception = [line for line in traceback.strip().splitlines() if line.strip()][-1].strip()
+        crash.update({'exception': exception, 'signature': signature(exception), 'node_dir': node_dir,
+                      **path_fields(f'{node_dir} {traceback} {path}'), 'error': None})
+    except Exception as e:
+        crash.update({'exception': None, 'signature': None, 'node_dir': None, **path_fields(path),
+                      'error': f'{type(e).__name__}: {e}'})
+    return crash
+
+
+def parse_spm(path: str) -> dict:
+
+    '''
+    Function to summarise the design matrix
+    of an SPM.mat file.
+
+    Parameters
+    ----------
+    path: str
+        path to SPM.mat
+
+    Returns
+    -------
+    dict of design details
+    '''
+
+    from scipy.io import loadmat
+
+    design = {'path': path, **path_fields(path)}
+    try:
+        spm = loadmat(path, squeeze_me=True, struct_as_record=False)['SPM']
+        X = np.atleast_2d(np.asarray(spm.xX.X, dtype=float))
+        columns = [str(column) for column in np.atleast_1d(spm.xX.name)]
+        singular_values = np.linalg.svd(X, compute_uv=False)
+        design.update({
+            'n_scans': X.shape[0],
+            'n_columns': X.shape[1],
+            'rank': int(np.sum(singular_values > singular_values.max() * max(X.shape) * np.finfo(float).eps)),
+            'condition_number': float(singular_values.max() / singular_values.min()) if singular_values.min() > 0 else np.inf,
+            'empty_columns': '|'.join(column for column, std in zip(columns, X.std(axis=0)) if std == 0 and 'constant' not in column),
+            'columns': '|'.join(columns),
+            'error': None,
+        })
+    except Exception as e:
+        design['error'] = f'{type(e).__name__}: {e}'
+    return design
+
+
+def crash_summary(crashes_df: pd.DataFrame) -> pd.DataFrame:
+
+    '''
+    Function to group crashes by node and
+    exception signature.
+
+    Parameters
+    ----------
+    crashes_df: pd.DataFrame
+        parsed crashes
+
+    Returns
+    -------
+    pd.DataFrame of crashes, subjects and an example
+    exception of each node and signature
+    '''
+
+    parsed_df = crashes_df.dropna(subset=['signature'])
+    if parsed_df.empty:
+        return pd.DataFrame(columns=['node', 'signature', 'n_crashes', 'n_subjects', 'subjects', 'example', 'first', 'last'])
+    return parsed_df.groupby(['node', 'signature'], dropna=False).agg(
+        n_crashes=('path', 'size'),
+        n_subjects=('subject', 'nunique'),
+        subjects=('subject', lambda subjects: ' '.join(sorted(subjects.dropna().unique()))),
+        example=('exception', 'first'),
+        first=('time', 'min'),
+        last=('time', 'max'),
+    ).reset_index().sort_values('n_crashes', ascending=False)
+
+
+if __name__ == '__main__':
+    flags = options()
+    save_dir = flags['output'] if flags['output'] else flags['directories'][0]
+    files = find_files(flags['directories'])
+    print(f'Found {len(files["crash"])} crash files and {len(files["spm"])} SPM.mat files')
+    with ProcessPoolExecutor(max_workers=flags['jobs']) as executor:
+        crashes = list(executor.map(parse_crash, files['crash'], chunksize=16))
+        designs = list(executor.map(parse_spm, files['spm'], chunksize=4))
+
+    os.makedirs(save_dir, exist_ok=True)
+    if crashes:
+        crashes_df = pd.DataFrame(crashes)
+        summary_df = crash_summary(crashes_df)
+        crashes_df.to_csv(os.path.join(save_dir, 'crashes.csv'), index=False)
+        summary_df.to_csv(os.path.join(save_dir, 'crash_summary.csv'), index=False)
+        print(f'\n{len(summary_df)} distinct failures, {crashes_df["error"].notna().sum()} unreadable crash files')
+        if not summary_df.empty:
+            print(summary_df[['node', 'n_crashes', 'n_subjects', 'example']].to_string(index=False, max_colwidth=80))
+    if designs:
+        designs_df = pd.DataFrame(designs)
+        designs_df.to_csv(os.path.join(save_dir, 'designs.csv'), index=False)
+        readable_df = designs_df.dropna(subset=['n_columns'])
+        print(f'\n{len(readable_df)} design matrices, {len(designs_df) - len(readable_df)} unreadable')
+        if not readable_df.empty:
+            print(f'{(readable_df["rank"] < readable_df["n_columns"]).sum()} rank deficient, '
+                  f'median condition number {readable_df["condition_number"].median():.1f}')
+    print(f'\nTables saved to {save_dir}')
@@ -1,3 +1,17 @@
-from nipype.utils.filemanip import loadpkl
-res = loadpkl('/data/project/BEACONB/logs/crash-20230523-092120-k1812017-getsubjectinfo.a0-388ba0fb-e4f1-419c-a267-9297517693d5.pklz')
-print(res['traceback'])
\ No newline at end of file
+from diagnose_logs import parse_crash
+import sys
+
+'''
+Script to print one nipype crash file.
+Use diagnose_logs.py to go through a whole logs directory.
+
+Usage
+----
+python read_crash_file.py /path/to/crash-*.pklz
+'''
+
+if __name__ == '__main__':
+    from nipype.utils.filemanip import loadpkl
+    crash = parse_crash(sys.argv[1])
+    print(f'Node {crash["node"]} subject {crash["subject"]}\n')
+    print(''.join(loadpkl(sys.argv[1])['traceback']))
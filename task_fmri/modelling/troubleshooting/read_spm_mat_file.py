@@ -1,10 +1,20 @@
 from scipy.io import loadmat
-
-mat_file = loadmat('/data/project/BEACONB/task_fmri/eft/1stlevel/T2/sub-B2999/SPM.mat')
-print(mat_file['SPM']['xX'][0][0])#['X'])
 import sys
-sys.exit(0)
 import pandas as pd
-df = pd.DataFrame(data=mat_file['SPM']['xX'][0][0]['X'][0][0])
-print(df)
+from diagnose_logs import parse_spm
+
+'''
+Script to print the design matrix of one SPM.mat file.
+Use diagnose_logs.py to go through all 1st level designs.
+
+Usage
+----
+python read_spm_mat_file.py /path/to/SPM.mat
+'''
 
+if __name__ == '__main__':
+    design = parse_spm(sys.argv[1])
+    for key in ['n_scans', 'n_columns', 'rank', 'condition_number', 'empty_columns', 'error']:
+        print(f'{key}: {design.get(key)}')
+    spm = loadmat(sys.argv[1], squeeze_me=True, struct_as_record=False)['SPM']
+    print(pd.DataFrame(data=spm.xX.X, columns=[str(column) for column in spm.xX.name]))
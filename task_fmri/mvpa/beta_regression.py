@@ -30,14 +30,14 @@ def paths() -> dict:
         'save_dir': os.path.join(config('eft'), 'spotlight', 'beta_regression', 'T1')
     }
 
-def confounds(confounds_df: str) -> pd.DataFrame:
+def confounds(confounds_tsv: str) -> pd.DataFrame:
     '''
     Function to filter out fMRIPrep confounds df 
     to get confounds actually wanted
 
     Parameters
     ----------
-    confounds_df: str
+    confounds_tsv: str
       file path to fMRIPrep confounds tsv
 
     Returns
@@ -180,7 +180,8 @@ if __name__ == '__main__':
     
     # To get all the files paths needed
     file_paths = paths()
-    os.mkdir(file_paths['save_dir'])
+    save_dir = os.path.join(file_paths['save_dir'], subject)
+    os.makedirs(save_dir, exist_ok=True)
     preprocessed = os.path.join(file_paths['base_dir'], 
                                 subject, 
                                 'func', 
@@ -216,4 +217,4 @@ if __name__ == '__main__':
     beta_maps_dict = beta_maps(glm, events_df, glm_events_df)    
     
     # Save beta maps
-    save_beta_maps(beta_maps_dict, file_paths['save_dir'])
\ No newline at end of file
+    save_beta_maps(beta_maps_dict, save_dir)
\ No newline at end of file
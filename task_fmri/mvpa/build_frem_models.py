@@ -1,29 +1,89 @@
 from decouple import config
 import os
 import sys
+import argparse
 from nilearn.decoding import FREMRegressor
-from fNeuro.utils.pickling import save_pickle, ados
+from fNeuro.utils.pickling import ados
+from feature_store import feature_store, features_to_img
+from multi_target import shared_folds, fit_frem_multi
+from model_artifacts import checkpoint_dir, save_store_reference, save_artifact, artifact_exists
 from sklearn.svm import SVR 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'utils'))
+from instrumentation import profile
 import warnings
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 warnings.filterwarnings("ignore", category=UserWarning)
 
+param_grid = {'C': [1e0, 1e1, 1e2], 'epsilon': [1e-3, 1e-2, 1e-1]}
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of flags
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('--multi_target',
+                      dest='multi_target',
+                      action='store_true',
+                      help='Fit all ADOS domains in one pass sharing folds and clustering')
+    return vars(args.parse_args())
+
+
 if __name__ == "__main__":
+    flags = options()
     frem_path = config('ml')
     print('\nBuilding FREM models')
     print('\nReading ADOS results')
     
     ados_df = ados('G2', test_train='train', directory='combined')
     ados_df = ados_df.drop([20]) # Remove the one outlier
-    for domain in ados_df.columns[1:6]:
+    print('\nLoading feature store')
+    with profile('feature_store', scans=len(ados_df)):
+        store = feature_store(ados_df['paths'], 'combined_train')
+    domains = ados_df.columns[1:6]
+
+    if flags['multi_target']:
+        save_dir = os.path.join(frem_path, 'frem_best_estimator', 'frem_multi_target')
+        if all(artifact_exists(save_dir, domain, store) for domain in domains):
+            print('\nFREM models already trained on this feature store')
+            sys.exit(0)
+        print(f'\nWorking on {", ".join(domains)} together')
+        folds = shared_folds(ados_df.shape[0], 50)
+        with profile('fit_frem_multi_target', domains=len(domains)):
+            frem = fit_frem_multi(store['features'], ados_df[domains].values, folds, store['mask_img'], param_grid, n_jobs=8,
+                                  checkpoint_dir=checkpoint_dir('frem_multi_target', store, targets=ados_df[domains].values,
+                                                                folds=folds, param_grid=param_grid))
+        print('\nSaving output')
+        save_store_reference(save_dir, store)
+        for target, domain in enumerate(domains):
+            save_artifact(save_dir, domain, frem['coef'][target], frem['intercept'][target],
+                          frem['best_params'][target], frem['cv_scores'][target], store)
+        print('\nFinished calculating FREM models')
+        sys.exit(0)
+
+    save_dir = os.path.join(frem_path, 'frem_best_estimator', 'frem')
+    features_img = features_to_img(store)
+    for domain in domains:
+        if artifact_exists(save_dir, domain, store):
+            print(f'\nSkipping {domain}, already trained on this feature store')
+            continue
         print(f'\nWorking on {domain}')
-        frem = FREMRegressor(estimator=SVR(kernel='linear'), n_jobs=8, cv=50,
-                             param_grid={'C': [1e0, 1e1, 1e2], 'epsilon': [1e-3, 1e-2, 1e-1]})
-        frem.fit(ados_df['paths'], ados_df[domain])
-        try:
-            print('\nSaving output')
-            save_pickle(os.path.join(frem_path, 'frem_best_estimator', domain), frem)
-        except Exception as e:
-            print(e)
-            sys.exit(1)
-    print('\nFinished calculating FREM models')
\ No newline at end of file
+        frem = FREMRegressor(estimator=SVR(kernel='linear'), n_jobs=8, cv=50, mask=store['mask_img'], standardize=False,
+                             param_grid=param_grid)
+        with profile('fit_frem', domain=domain):
+            frem.fit(features_img, ados_df[domain])
+        print('\nSaving output')
+        save_store_reference(save_dir, store)
+        save_artifact(save_dir, domain, frem.coef_, frem.intercept_,
+                      list(frem.cv_params_.values())[0], list(frem.cv_scores_.values())[0], store)
+    print('\nFinished calculating FREM models')
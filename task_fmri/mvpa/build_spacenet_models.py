@@ -1,32 +1,100 @@
 from decouple import config
 import os
 import sys
+import argparse
 from nilearn.decoding import SpaceNetRegressor
 from sklearn.model_selection import GridSearchCV
-from fNeuro.utils.pickling import save_pickle, ados
+from fNeuro.utils.pickling import ados
+from feature_store import feature_store, features_to_img
+from multi_target import shared_folds
+from spacenet_path import path_search
+from model_artifacts import checkpoint_dir, save_store_reference, save_artifact, artifact_exists
 import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'utils'))
+from instrumentation import profile
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of flags
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('--path_search',
+                      dest='path_search',
+                      action='store_true',
+                      help='Use the warm-started, cached regularization path search. Every domain shares the same folds')
+    return vars(args.parse_args())
+
 
 if __name__ == "__main__":
-    
+    flags = options()
     tv_l1_path = config('ml')
     print('\nBuilding TV-l1 models')
     print('\nReading ADOS results')
     
     ados_df = ados('G2', test_train='train', directory='combined')
     ados_df = ados_df.drop([20]) # Remove the one outlier
-    models = {}
-    for domain in ados_df.columns[1:6]:
+    print('\nLoading feature store')
+    with profile('feature_store', scans=len(ados_df)):
+        store = feature_store(ados_df['paths'], 'combined_train')
+    l1_ratios = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+
+    domains = ados_df.columns[1:6]
+
+    if flags['path_search']:
+        save_dir = os.path.join(tv_l1_path, 'spacenet_best_estimator', 'spacenet_path')
+        folds = shared_folds(ados_df.shape[0], 10, shuffle_split=False)
+        for domain in domains:
+            if artifact_exists(save_dir, domain, store):
+                print(f'\nSkipping {domain}, already trained on this feature store')
+                continue
+            print(f'\nWorking on {domain}')
+            cache_dir = os.path.join(checkpoint_dir('spacenet_path', store, targets=ados_df[domain].values, folds=folds,
+                                                    l1_ratios=l1_ratios), domain)
+            with profile('fit_spacenet_path', domain=domain):
+                model = path_search(store['features'], ados_df[domain].values, store['mask_img'], folds, l1_ratios,
+                                    cache_dir, n_jobs=8)
+            print(model['timing'].to_string(index=False))
+            model['timing'].to_csv(os.path.join(cache_dir, 'fold_timing.csv'), index=False)
+            print('\nSaving output')
+            save_store_reference(save_dir, store)
+            save_artifact(save_dir, domain, model['coef'], model['intercept'], model['best_params'], model['cv_scores'],
+                          store)
+        print('\nFinished calculating spacenet models')
+        sys.exit(0)
+
+    name = 'spacenet'
+    save_dir = os.path.join(tv_l1_path, 'spacenet_best_estimator', name)
+    features_img = features_to_img(store)
+    for domain in domains:
+        if artifact_exists(save_dir, domain, store):
+            print(f'\nSkipping {domain}, already trained on this feature store')
+            continue
         print(f'\nWorking on {domain}')
+        # memory_level=2 caches each fold's path so an interrupted fit resumes from finished folds
         tv_l1 = SpaceNetRegressor(penalty="tv-l1", 
-                                  l1_ratios=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9],
+                                  l1_ratios=l1_ratios,
+                                  mask=store['mask_img'],
+                                  standardize=False,
                                   n_jobs=8,
-                                  cv=10)
-        tv_l1.fit(ados_df['paths'], ados_df[domain])
-        models[domain] = tv_l1
-    try:
+                                  cv=10,
+                                  memory=os.path.join(checkpoint_dir(name, store), domain),
+                                  memory_level=2)
+        with profile(f'fit_{name}', domain=domain):
+            tv_l1.fit(features_img, ados_df[domain])
         print('\nSaving output')
-        save_pickle(os.path.join(tv_l1_path, 'spacenet_best_estimator', 'spacenet_models'), models)
-    except Exception as e:
-        print(e)
-        sys.exit(1)
-    print('\nFinished calculating spacenet models')
\ No newline at end of file
+        save_store_reference(save_dir, store)
+        save_artifact(save_dir, domain, tv_l1.coef_, tv_l1.intercept_,
+                      [{'alpha': alpha, 'l1_ratio': l1_ratio} for alpha, l1_ratio in tv_l1.best_model_params_],
+                      tv_l1.cv_scores_, store)
+    print('\nFinished calculating spacenet models')
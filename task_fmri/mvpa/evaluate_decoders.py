@@ -0,0 +1,350 @@
+from decouple import config
+import os
+import sys
+import time
+import argparse
+import resource
+import numpy as np
+import pandas as pd
+import joblib
+from joblib import Parallel, delayed
+from scipy import stats
+from sklearn.model_selection import RepeatedKFold, ShuffleSplit, GridSearchCV
+from sklearn.linear_model import Ridge
+from sklearn.svm import SVR
+from sklearn.metrics import r2_score, mean_absolute_error
+from fNeuro.utils.pickling import ados
+from feature_store import feature_store
+from multi_target import shared_folds, fit_frem_multi, fit_ridge_multi
+from build_frem_models import param_grid
+from spacenet_path import path_search
+from model_artifacts import checkpoint_dir
+
+'''
+Script to benchmark the ADOS decoders on accuracy, speed and memory.
+
+Train and test subjects go into one feature store and every split is a
+set of row indices into it, so no images are moved. Each outer split
+fits an estimator on its training rows (choosing hyperparameters with
+an inner CV on those rows only) and predicts its test rows. The held-out
+scheme reproduces the existing 80/20 split. Every estimator is reduced to
+a linear map (coef, intercept) so prediction is the same matrix product
+for all of them. Splits run in parallel, so timings are under load.
+'''
+
+estimators = ['frem', 'spacenet', 'ridge', 'svr', 'dummy']
+ridge_alphas = np.logspace(-1, 5, 13)
+l1_ratios = [0.1, 0.3, 0.5, 0.7, 0.9]
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of flags
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-s', '--scheme',
+                      dest='scheme',
+                      default='nested',
+                      choices=['nested', 'repeated_split', 'held_out'],
+                      help='''nested: repeated k fold outer CV. repeated_split: repeated 80/20 splits.
+                      held_out: the existing train/test split''')
+    args.add_argument('-e', '--estimators',
+                      dest='estimators',
+                      nargs='+',
+                      default=estimators,
+                      choices=estimators,
+                      help='Estimators to benchmark')
+    args.add_argument('-o', '--outer',
+                      dest='outer',
+                      type=int,
+                      default=5,
+                      help='Number of outer folds (nested) or splits (repeated_split)')
+    args.add_argument('-r', '--repeats',
+                      dest='repeats',
+                      type=int,
+                      default=2,
+                      help='Number of repeats of the outer k fold')
+    args.add_argument('-i', '--inner',
+                      dest='inner',
+                      type=int,
+                      default=5,
+                      help='Number of inner folds for hyperparameter selection')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=8,
+                      help='Number of splits to run in parallel')
+    return vars(args.parse_args())
+
+
+def ados_subjects() -> pd.DataFrame:
+
+    '''
+    Function to get the train and test subjects
+    as one DataFrame.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    ados_df: pd.DataFrame
+        DataFrame of ADOS scores, paths and
+        held_out (bool) of the existing test set
+    '''
+
+    train_df = ados('G2', test_train='train', directory='combined')
+    train_df = train_df.drop([20]) # Remove the one outlier
+    test_df = ados('G2', test_train='test', directory='combined')
+    ados_df = pd.concat([train_df.assign(held_out=False), test_df.assign(held_out=True)])
+    return ados_df.reset_index(drop=True)
+
+
+def outer_splits(ados_df: pd.DataFrame, scheme: str, n_outer: int, n_repeats: int) -> list:
+
+    '''
+    Function to create the outer splits as row indices
+
+    Parameters
+    ----------
+    ados_df: pd.DataFrame
+        DataFrame from ados_subjects
+
+    scheme: str
+        nested, repeated_split or held_out
+
+    n_outer: int
+        number of outer folds or splits
+
+    n_repeats: int
+        number of repeats of the outer k fold
+
+    Returns
+    -------
+    list of (train, test) index arrays
+    '''
+
+    if scheme == 'held_out':
+        held_out = ados_df['held_out'].values
+        return [(np.flatnonzero(~held_out), np.flatnonzero(held_out))]
+    if scheme == 'repeated_split':
+        splitter = ShuffleSplit(n_splits=n_outer, test_size=0.2, random_state=3)
+    else:
+        splitter = RepeatedKFold(n_splits=n_outer, n_repeats=n_repeats, random_state=3)
+    return list(splitter.split(np.zeros((ados_df.shape[0], 1))))
+
+
+def fit_estimator(name: str, X: np.ndarray, Y: np.ndarray, n_inner: int, mask_img, cache_dir: str) -> tuple:
+
+    '''
+    Function to fit an estimator to all targets, choosing
+    hyperparameters by inner CV on the training data.
+
+    Parameters
+    ----------
+    name: str
+        name of estimator
+
+    X: np.ndarray
+        (subjects x voxels) training features
+
+    Y: np.ndarray
+        (subjects x targets) training targets
+
+    n_inner: int
+        number of inner folds
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask of features
+
+    cache_dir: str
+        directory for the spacenet path cache
+
+    Returns
+    -------
+    tuple of coef (targets x voxels) and intercept (targets)
+    '''
+
+    if name == 'dummy':
+        return np.zeros((Y.shape[1], X.shape[1])), Y.mean(axis=0)
+    if name == 'frem':
+        frem = fit_frem_multi(X, Y, shared_folds(X.shape[0], n_inner), mask_img, param_grid, n_jobs=1)
+        return frem['coef'], frem['intercept']
+    if name == 'ridge':
+        best_alpha = fit_ridge_multi(X, Y, shared_folds(X.shape[0], n_inner, shuffle_split=False), ridge_alphas)['best_alpha']
+        models = [Ridge(alpha=alpha).fit(X, Y[:, target]) for target, alpha in enumerate(best_alpha)]
+    elif name == 'svr':
+        models = [GridSearchCV(SVR(kernel='linear'), {'C': param_grid['C']}, cv=n_inner).fit(X, Y[:, target]).best_estimator_
+                  for target in range(Y.shape[1])]
+    elif name == 'spacenet':
+        folds = shared_folds(X.shape[0], n_inner, shuffle_split=False)
+        models = [path_search(X, Y[:, target], mask_img, folds, l1_ratios, os.path.join(cache_dir, str(target)), n_jobs=1)
+                  for target in range(Y.shape[1])]
+        return np.array([model['coef'] for model in models]), np.array([model['intercept'] for model in models])
+    return np.array([np.ravel(model.coef_) for model in models]), np.array([np.ravel(model.intercept_)[0] for model in models])
+
+
+def measure(function, *args) -> tuple:
+
+    '''
+    Function to time a function and record the peak
+    resident memory of the process once it has run.
+    Memory is read from getrusage rather than traced
+    so that tracing does not slow down the timed call.
+
+    Parameters
+    ----------
+    function: function
+        function to measure
+
+    args:
+        arguments for function
+
+    Returns
+    -------
+    tuple of result, wall seconds and peak resident memory in MB
+    '''
+
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result, seconds, peak / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def evaluate_split(name: str, split: int, train: np.ndarray, test: np.ndarray, store: dict,
+                   Y: np.ndarray, domains: list, n_inner: int, cache_dir: str) -> pd.DataFrame:
+
+    '''
+    Function to fit and score one estimator on one outer split.
+    Features are re-standardized on the split's training rows
+    so the test rows play no part in fitting.
+
+    Parameters
+    ----------
+    name: str
+        name of estimator
+
+    split: int
+        number of outer split
+
+    train: np.ndarray
+        indices of training subjects
+
+    test: np.ndarray
+        indices of test subjects
+
+    store: dict
+        feature store of all subjects
+
+    Y: np.ndarray
+        (subjects x domains) ADOS scores
+
+    domains: list
+        list of ADOS domains
+
+    n_inner: int
+        number of inner folds
+
+    cache_dir: str
+        directory for the spacenet path cache. Each split caches
+        under a hash of its rows, targets and inner folds so a
+        rerun with other CV settings never reuses its fits
+
+    Returns
+    -------
+    pd.DataFrame of scores and timings per domain
+    '''
+
+    X_train = np.asarray(store['features'][train], dtype=float)
+    mean, scale = X_train.mean(axis=0), X_train.std(axis=0)
+    scale[scale == 0] = 1
+    X_train = (X_train - mean) / scale
+    X_test = (np.asarray(store['features'][test], dtype=float) - mean) / scale
+
+    split_key = joblib.hash((train, test, Y[train], shared_folds(len(train), n_inner, shuffle_split=False)))[:12]
+    (coef, intercept), fit_seconds, fit_mb = measure(fit_estimator, name, X_train, Y[train], n_inner,
+                                                     store['mask_img'], os.path.join(cache_dir, f'split_{split}_{split_key}'))
+    predicted, predict_seconds, predict_mb = measure(lambda: X_test @ np.asarray(coef).T + intercept)
+    return pd.DataFrame(data={
+        'estimator': name,
+        'split': split,
+        'domain': domains,
+        'r2': [r2_score(Y[test, target], predicted[:, target]) for target in range(len(domains))],
+        'pearson_r': [stats.pearsonr(Y[test, target], predicted[:, target])[0] if np.ptp(predicted[:, target]) > 0 else np.nan
+                      for target in range(len(domains))],
+        'mae': [mean_absolute_error(Y[test, target], predicted[:, target]) for target in range(len(domains))],
+        'n_train': len(train),
+        'n_test': len(test),
+        'fit_seconds': fit_seconds,
+        'fit_peak_mb': fit_mb,
+        'predict_seconds': predict_seconds,
+        'predict_peak_mb': predict_mb,
+    })
+
+
+def benchmark_report(scores_df: pd.DataFrame) -> pd.DataFrame:
+
+    '''
+    Function to summarise split scores into a report
+    per estimator and domain.
+
+    Parameters
+    ----------
+    scores_df: pd.DataFrame
+        DataFrame of scores from evaluate_split
+
+    Returns
+    -------
+    pd.DataFrame of mean and sd of scores, mean timings
+    and max memory
+    '''
+
+    report = scores_df.groupby(['estimator', 'domain']).agg(
+        r2_mean=('r2', 'mean'),
+        r2_sd=('r2', 'std'),
+        pearson_r_mean=('pearson_r', 'mean'),
+        mae_mean=('mae', 'mean'),
+        n_splits=('split', 'nunique'),
+        fit_seconds=('fit_seconds', 'mean'),
+        fit_peak_mb=('fit_peak_mb', 'max'),
+        predict_seconds=('predict_seconds', 'mean'),
+        predict_peak_mb=('predict_peak_mb', 'max'),
+    )
+    return report.reset_index().sort_values(['domain', 'r2_mean'], ascending=[True, False])
+
+
+if __name__ == "__main__":
+    flags = options()
+    print(f'\nBenchmarking {", ".join(flags["estimators"])} with {flags["scheme"]} evaluation')
+    ados_df = ados_subjects()
+    domains = list(ados_df.columns[1:6])
+    print('\nLoading feature store')
+    store = feature_store(ados_df['paths'], 'combined_all')
+    splits = outer_splits(ados_df, flags['scheme'], flags['outer'], flags['repeats'])
+    Y = ados_df[domains].values.astype(float)
+    cache_dir = os.path.join(checkpoint_dir('evaluation', store), flags['scheme'])
+
+    print(f'\nRunning {len(splits)} splits of {len(flags["estimators"])} estimators')
+    scores_df = pd.concat(Parallel(n_jobs=flags['jobs'])(
+        delayed(evaluate_split)(name, split, train, test, store, Y, domains, flags['inner'], os.path.join(cache_dir, name))
+        for name in flags['estimators'] for split, (train, test) in enumerate(splits)))
+
+    save_dir = os.path.join(config('ml'), 'evaluation', flags['scheme'])
+    os.makedirs(save_dir, exist_ok=True)
+    report = benchmark_report(scores_df)
+    print(report.to_string(index=False))
+    scores_df.to_csv(os.path.join(save_dir, 'split_scores.csv'), index=False)
+    report.to_csv(os.path.join(save_dir, 'benchmark_report.csv'), index=False)
+    print(f'\nSaved benchmark report to {save_dir}')
@@ -0,0 +1,225 @@
+from decouple import config
+import os
+import json
+import hashlib
+import numpy as np
+import nibabel
+from joblib import Parallel, delayed
+from nilearn.maskers import NiftiMasker
+from nilearn.masking import unmask
+from nilearn import image as img
+
+'''
+Functions to mask and standardize the MVPA input images once and
+cache them as a (subjects x voxels) float32 array.
+
+The array is loaded memory-mapped so joblib workers share it rather
+than each reloading, resampling and masking every image. The store is
+rebuilt if any of its input images change.
+'''
+
+def store_path(name: str) -> str:
+
+    '''
+    Function to return the directory of a feature store
+
+    Parameters
+    ----------
+    name: str
+        name of the feature store
+
+    Returns
+    -------
+    str of path to feature store
+    '''
+
+    return os.path.join(config('ml'), 'feature_store', name)
+
+
+def fingerprint(paths: list) -> str:
+
+    '''
+    Function to fingerprint a list of images by
+    their paths, sizes and modification times.
+
+    Parameters
+    ----------
+    paths: list
+        list of paths to images
+
+    Returns
+    -------
+    str of sha1 hash
+    '''
+
+    stats = [(path, os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths]
+    return hashlib.sha1(json.dumps(stats).encode()).hexdigest()
+
+
+def mask_images(paths: list, mask_img: nibabel.nifti1.Nifti1Image) -> np.ndarray:
+
+    '''
+    Function to mask a chunk of images
+
+    Parameters
+    ----------
+    paths: list
+        list of paths to images
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask to apply
+
+    Returns
+    -------
+    np.ndarray of (images x voxels) float32
+    '''
+
+    return NiftiMasker(mask_img=mask_img).fit().transform(paths).astype(np.float32)
+
+
+def build_feature_store(paths: list, save_dir: str, mask_img: str = None, n_jobs: int = 8) -> None:
+
+    '''
+    Function to mask and standardize images into a cached
+    (subjects x voxels) float32 array. Each voxel is z-scored
+    across subjects in the same way nilearn decoders standardize.
+
+    Parameters
+    ----------
+    paths: list
+        list of paths to images, one per subject
+
+    save_dir: str
+        directory to save feature store to
+
+    mask_img: str
+        path to mask. If None a background mask
+        is computed from the images as nilearn decoders do
+
+    n_jobs: int
+        number of jobs to mask images with
+
+    Returns
+    -------
+    None
+    '''
+
+    os.makedirs(save_dir, exist_ok=True)
+    if mask_img is None:
+        mask_img = NiftiMasker(mask_strategy='background').fit(paths).mask_img_
+    mask_img = img.load_img(mask_img)
+    n_voxels = int(np.count_nonzero(mask_img.get_fdata()))
+
+    features = np.lib.format.open_memmap(os.path.join(save_dir, 'features.npy'), mode='w+',
+                                         dtype=np.float32, shape=(len(paths), n_voxels))
+    chunks = np.array_split(np.arange(len(paths)), min(n_jobs, len(paths)))
+    masked = Parallel(n_jobs=n_jobs)(delayed(mask_images)([paths[row] for row in chunk], mask_img) for chunk in chunks)
+    for chunk, chunk_features in zip(chunks, masked):
+        features[chunk] = chunk_features
+
+    mean = features.mean(axis=0, dtype=np.float64)
+    scale = features.std(axis=0, dtype=np.float64)
+    scale[scale == 0] = 1
+    features -= mean.astype(np.float32)
+    features /= scale.astype(np.float32)
+    features.flush()
+
+    np.save(os.path.join(save_dir, 'mean.npy'), mean.astype(np.float32))
+    np.save(os.path.join(save_dir, 'scale.npy'), scale.astype(np.float32))
+    mask_img.to_filename(os.path.join(save_dir, 'mask_img.nii.gz'))
+    with open(os.path.join(save_dir, 'meta.json'), 'w') as meta_file:
+        json.dump({'paths': list(paths), 'fingerprint': fingerprint(paths)}, meta_file)
+
+
+def load_feature_store(save_dir: str) -> dict:
+
+    '''
+    Function to load a feature store. The features
+    are memory-mapped rather than read in.
+
+    Parameters
+    ----------
+    save_dir: str
+        directory of feature store
+
+    Returns
+    -------
+    dict: dictionary object
+        dict of features, mean, scale, mask_img,
+        paths and fingerprint
+    '''
+
+    with open(os.path.join(save_dir, 'meta.json')) as meta_file:
+        meta = json.load(meta_file)
+    return {
+        'features': np.load(os.path.join(save_dir, 'features.npy'), mmap_mode='r'),
+        'mean': np.load(os.path.join(save_dir, 'mean.npy')),
+        'scale': np.load(os.path.join(save_dir, 'scale.npy')),
+        'mask_img': img.load_img(os.path.join(save_dir, 'mask_img.nii.gz')),
+        'paths': meta['paths'],
+        'fingerprint': meta['fingerprint'],
+    }
+
+
+def feature_store(paths: list, name: str, mask_img: str = None, n_jobs: int = 8) -> dict:
+
+    '''
+    Function to load a feature store, building it first
+    if it doesn't exist or its images have changed.
+
+    Parameters
+    ----------
+    paths: list
+        list of paths to images, one per subject
+
+    name: str
+        name of the feature store
+
+    mask_img: str
+        path to mask. If None a background mask
+        is computed from the images
+
+    n_jobs: int
+        number of jobs to mask images with
+
+    Returns
+    -------
+    dict: dictionary object
+        feature store from load_feature_store
+    '''
+
+    save_dir = store_path(name)
+    paths = list(paths)
+    if os.path.exists(os.path.join(save_dir, 'meta.json')):
+        store = load_feature_store(save_dir)
+        if store['paths'] == paths and store['fingerprint'] == fingerprint(paths):
+            return store
+    print(f'Building feature store {name} from {len(paths)} images')
+    build_feature_store(paths, save_dir, mask_img, n_jobs)
+    return load_feature_store(save_dir)
+
+
+def features_to_img(store: dict, rows: list = None) -> nibabel.nifti1.Nifti1Image:
+
+    '''
+    Function to turn the standardized features back into an
+    in-memory 4D image on the mask grid. For estimators that
+    only accept images (FREM, SpaceNet) so they mask an
+    image already in memory rather than reloading from disk.
+    Use with mask=store['mask_img'] and standardize=False.
+
+    Parameters
+    ----------
+    store: dict
+        feature store from load_feature_store
+
+    rows: list
+        rows (subjects) to include. Default all
+
+    Returns
+    -------
+    nibabel.nifti1.Nifti1Image 4D image
+    '''
+
+    features = store['features'] if rows is None else store['features'][rows]
+    return unmask(np.asarray(features), store['mask_img'])
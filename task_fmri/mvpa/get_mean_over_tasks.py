@@ -1,46 +1,153 @@
 from decouple import config
 import pandas as pd
-import glob
+import numpy as np
 import os
-import re
-from nilearn import image as img
+import sys
+import argparse
+from joblib import Parallel, delayed
+from nilearn.maskers import NiftiMasker
 from fNeuro.ml.mvpa_functions import ados
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modelling'))
+from first_level_index import FirstLevelIndex
+
+'''
+Script to build the mean task images used as MVPA inputs.
+
+All of a subject's task images are masked onto the same grid once and
+stacked, the mean images are then weighted sums over the stack
+(weights @ data) so any combination of tasks and time points can be
+made in a single pass. Subjects are processed in parallel and written
+to the train or test directory.
+'''
+
+tasks = ['eft', 'happy', 'fear']
+time_points = ['t1', 't2']
+inputs = [f'{task}_paths_{time_point}' for task in tasks for time_point in time_points]
+
+# Weight of each input image in each mean image
+mean_images = {
+    'combined': {image: 1 / len(inputs) for image in inputs},
+    't2': {f'{task}_paths_t2': 1 / len(tasks) for task in tasks},
+}
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of mask and number of jobs
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-m', '--mask',
+                      dest='mask',
+                      default=os.path.join(config('eft'), '2ndlevel', 'mixed_model', 'mask_img.nii.gz'),
+                      help='Mask defining the common grid')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=8,
+                      help='Number of subjects to process in parallel')
+    return vars(args.parse_args())
+
+
+def subject_images() -> pd.DataFrame:
+
+    '''
+    Function to get each participant's task images
+    from the 1st level index of each task.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    subject_scans_df: pd.DataFrame
+        DataFrame of G-Number and path to each task and time point
+    '''
+
+    scans_df = FirstLevelIndex(tasks).task_scans(tasks)
+    subject_scans_df = scans_df.rename(columns={f'{task}_{time_point}': f'{task}_paths_{time_point}'
+                                                for task in tasks for time_point in time_points})[inputs]
+    subject_scans_df['G-Number'] = scans_df['participant'].str.replace('sub-', '')
+    return subject_scans_df
+
+
+def weight_matrix() -> np.ndarray:
+
+    '''
+    Function to build the (n mean images x n inputs)
+    weight matrix from mean_images.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    np.ndarray of weights
+    '''
+
+    return np.array([[weights.get(image, 0) for image in inputs] for weights in mean_images.values()])
+
+
+def build_means(subjects: pd.DataFrame, masker: NiftiMasker, weights: np.ndarray, save_dir: str) -> list:
+
+    '''
+    Function to build and save the mean images of
+    a chunk of subjects.
+
+    Parameters
+    ----------
+    subjects: pd.DataFrame
+        DataFrame of id, directory and input paths
+
+    masker: NiftiMasker
+        fitted masker of the common grid
+
+    weights: np.ndarray
+        weight matrix from weight_matrix
+
+    save_dir: str
+        mean_task_images directory
+
+    Returns
+    -------
+    list of subjects saved
+    '''
+
+    stacked = np.stack([masker.transform(subject[inputs].to_list()) for _, subject in subjects.iterrows()])
+    means = np.einsum('mi,siv->smv', weights, stacked)
+    for (_, subject), subject_means in zip(subjects.iterrows(), means):
+        for mean_name, mean_data in zip(mean_images.keys(), subject_means):
+            masker.inverse_transform(mean_data).to_filename(
+                os.path.join(save_dir, subject['directory'], mean_name, f'sub-{subject["id"]}.nii.gz'))
+    return subjects['id'].to_list()
 
 
 if __name__ == "__main__":
+    flags = options()
     tv_l1_path = config('ml')
-    base_path = config('eft')
+    save_dir = os.path.join(tv_l1_path, 'mean_task_images')
     test_eft = ados('G2', test_train=None, directory='eft')
-    subject_scans_df = pd.read_csv(f"{base_path}/1stlevel_location.csv")
-    subject_scans_df = subject_scans_df.drop(subject_scans_df[subject_scans_df['t1'] == 75].index)
-    subject_scans_df['G-Number'] = subject_scans_df['t1'].apply(lambda part: re.findall('G....', part)[0]).reset_index(drop=True)
-    subject_scans_df['B-Number'] = subject_scans_df['t2'].apply(lambda part: re.findall(r'B\d...', part)[0]).reset_index(drop=True)
-    com = pd.merge(test_eft['G-Number'], subject_scans_df, on='G-Number')
-    beta_images_paths = pd.DataFrame(
-        data={
-            'id': com['G-Number'],
-            'eft_paths_t1': com['t1'],
-            'eft_paths_t2': com['t2'],
-            'happy_paths_t1': [re.sub('eft', 'happy', path) for path in  com['t1']],
-            'happy_paths_t2': [re.sub('eft', 'happy', path) for path in  com['t2']],
-            'fear_paths_t1': [re.sub('eft', 'fear', path) for path in  com['t1']],
-            'fear_paths_t2': [re.sub('eft', 'fear', path) for path in  com['t2']]
-            }
-            ).sort_values(by='id')
-    
-    test_dir = os.listdir(os.path.join(tv_l1_path, 'mean_task_images', 'test', 't1'))
-    for row in beta_images_paths.iterrows():
-        print(f'Working on subject {row[1]["id"]}')
-        eft_t1 = img.load_img(row[1]['eft_paths_t1'])
-        eft_t2 = img.load_img(row[1]['eft_paths_t2'])
-        happy_t1 = img.load_img(row[1]['happy_paths_t1'])
-        happy_t2 = img.load_img(row[1]['happy_paths_t2'])
-        fear_t1 = img.load_img(row[1]['fear_paths_t1'])
-        fear_t2 = img.load_img(row[1]['fear_paths_t2'])
-        combined_mean = img.mean_img([eft_t1, eft_t2, happy_t1, happy_t2, fear_t1, fear_t2])
-        t2 = img.mean_img([eft_t2, happy_t2, fear_t2])
-        directory = "train"
-        if f"sub-{row[1]['id']}.nii.gz" in test_dir:
-            directory = "test"
-        t2.to_filename(f'{tv_l1_path}/mean_task_images/{directory}/t2/sub-{row[1]["id"]}.nii.gz')
-        combined_mean.to_filename(f'{tv_l1_path}/mean_task_images/{directory}/combined/sub-{row[1]["id"]}.nii.gz')
\ No newline at end of file
+    test_subjects = pd.read_csv(os.path.join(save_dir, 'test', 'ados_test.csv'))['G-Number'].to_list()
+    beta_images_paths = pd.merge(test_eft['G-Number'], subject_images(), on='G-Number').rename(
+        columns={'G-Number': 'id'}).sort_values(by='id').reset_index(drop=True)
+    beta_images_paths['directory'] = np.where(beta_images_paths['id'].isin(test_subjects), 'test', 'train')
+    for directory in ['train', 'test']:
+        [os.makedirs(os.path.join(save_dir, directory, mean_name), exist_ok=True) for mean_name in mean_images.keys()]
+
+    print(f'Building mean images for {beta_images_paths.shape[0]} subjects')
+    masker = NiftiMasker(mask_img=flags['mask']).fit()
+    chunks = np.array_split(np.arange(beta_images_paths.shape[0]), min(flags['jobs'], beta_images_paths.shape[0]))
+    saved = Parallel(n_jobs=flags['jobs'])(delayed(build_means)(beta_images_paths.iloc[chunk], masker, weight_matrix(), save_dir)
+                                           for chunk in chunks)
+    print(f'Saved mean images for {sum(len(chunk) for chunk in saved)} subjects')
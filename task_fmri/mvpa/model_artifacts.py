@@ -0,0 +1,288 @@
+from decouple import config
+import os
+import json
+import numpy as np
+import joblib
+from joblib import Parallel, delayed
+from nilearn import image as img
+
+'''
+Functions to checkpoint MVPA training and save compact model artifacts.
+
+Each fold (or domain) is checkpointed as soon as it finishes so a rerun
+only fits the work that is missing. Trained models are saved as the
+coefficient map as a masked float32 vector, the intercept, best params
+and CV scores rather than pickling whole estimators. The mask and
+feature standardization of the feature store the models were trained
+on are saved once per artifact directory, and the store's fingerprint
+with each model so a model is only reused if it was trained on the
+current store.
+'''
+
+def checkpoint_dir(name: str, store: dict, **inputs) -> str:
+
+    '''
+    Function to return the checkpoint directory of a training run.
+    Checkpoints are kept per feature store fingerprint and a hash
+    of the run's other inputs so a rebuilt store or changed targets,
+    folds or parameters never resume from stale fits.
+
+    Parameters
+    ----------
+    name: str
+        name of training run i.e frem_multi_target
+
+    store: dict
+        feature store the run is trained on
+
+    inputs:
+        anything else the fits depend on i.e
+        targets, folds and param_grid
+
+    Returns
+    -------
+    str of path to checkpoint directory
+    '''
+
+    key = store['fingerprint'][:12]
+    if inputs:
+        key = f'{key}_{joblib.hash(inputs)[:12]}'
+    return os.path.join(config('ml'), 'checkpoints', name, key)
+
+
+def checkpointed(checkpoint: str, fit_function, *args, **kwargs):
+
+    '''
+    Function to load a checkpoint if it exists, otherwise
+    run the fit function and save its result as a checkpoint.
+    Checkpoints are written to a temporary file then moved so an
+    interrupted write never leaves a broken checkpoint.
+
+    Parameters
+    ----------
+    checkpoint: str
+        path to checkpoint file
+
+    fit_function: function
+        function to run if there is no checkpoint
+
+    args, kwargs:
+        arguments for fit_function
+
+    Returns
+    -------
+    result of fit_function
+    '''
+
+    if os.path.exists(checkpoint):
+        return joblib.load(checkpoint)
+    result = fit_function(*args, **kwargs)
+    joblib.dump(result, f'{checkpoint}.tmp')
+    os.replace(f'{checkpoint}.tmp', checkpoint)
+    return result
+
+
+def run_folds(fit_fold, folds: list, checkpoint_dir: str = None, n_jobs: int = 8, *args, **kwargs) -> list:
+
+    '''
+    Function to run a fit function over folds in parallel
+    with each fold checkpointed as it finishes.
+
+    Parameters
+    ----------
+    fit_fold: function
+        function called as fit_fold(*args, train, test, **kwargs)
+
+    folds: list
+        list of (train, test) indices
+
+    checkpoint_dir: str
+        directory to save fold checkpoints to. If None
+        folds are not checkpointed
+
+    n_jobs: int
+        number of folds to run in parallel
+
+    args, kwargs:
+        arguments for fit_fold
+
+    Returns
+    -------
+    list of fold results
+    '''
+
+    if checkpoint_dir is None:
+        return Parallel(n_jobs=n_jobs)(delayed(fit_fold)(*args, train, test, **kwargs) for train, test in folds)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    done = sum(os.path.exists(os.path.join(checkpoint_dir, f'fold_{fold}.pkl')) for fold in range(len(folds)))
+    if done:
+        print(f'\tResuming from {done} of {len(folds)} folds checkpointed in {checkpoint_dir}')
+    return Parallel(n_jobs=n_jobs)(
+        delayed(checkpointed)(os.path.join(checkpoint_dir, f'fold_{fold}.pkl'), fit_fold, *args, train, test, **kwargs)
+        for fold, (train, test) in enumerate(folds))
+
+
+def save_store_reference(save_dir: str, store: dict) -> None:
+
+    '''
+    Function to save the mask and standardization of the
+    feature store that the models in save_dir are trained on
+
+    Parameters
+    ----------
+    save_dir: str
+        artifact directory
+
+    store: dict
+        feature store from feature_store.load_feature_store
+
+    Returns
+    -------
+    None
+    '''
+
+    os.makedirs(save_dir, exist_ok=True)
+    store['mask_img'].to_filename(os.path.join(save_dir, 'mask_img.nii.gz'))
+    np.savez(os.path.join(save_dir, 'standardization.npz'), mean=store['mean'], scale=store['scale'])
+    with open(os.path.join(save_dir, 'feature_store.json'), 'w') as store_file:
+        json.dump({'fingerprint': store['fingerprint']}, store_file)
+
+
+def save_artifact(save_dir: str, domain: str, coef: np.ndarray, intercept: float,
+                  best_params, cv_scores: np.ndarray, store: dict) -> None:
+
+    '''
+    Function to save a compact model artifact
+
+    Parameters
+    ----------
+    save_dir: str
+        artifact directory
+
+    domain: str
+        ADOS domain the model predicts
+
+    coef: np.ndarray
+        coefficient map as a masked vector
+
+    intercept: float
+        intercept of model
+
+    best_params: dict or list
+        best parameters of the model (or of each fold)
+
+    cv_scores: np.ndarray
+        cross validation scores
+
+    store: dict
+        feature store the model was trained on
+
+    Returns
+    -------
+    None
+    '''
+
+    os.makedirs(save_dir, exist_ok=True)
+    np.savez(os.path.join(save_dir, f'{domain}.npz'),
+             coef=np.ravel(coef).astype(np.float32),
+             intercept=np.float64(np.ravel(intercept)[0]),
+             cv_scores=np.asarray(cv_scores, dtype=np.float64))
+    with open(os.path.join(save_dir, f'{domain}.json'), 'w') as params_file:
+        json.dump({'best_params': best_params, 'fingerprint': store['fingerprint']}, params_file, default=lambda value: np.asarray(value).tolist())
+
+
+def artifact_exists(save_dir: str, domain: str, store: dict) -> bool:
+
+    '''
+    Function to check if a domain has already been trained
+    on the current feature store
+
+    Parameters
+    ----------
+    save_dir: str
+        artifact directory
+
+    domain: str
+        ADOS domain
+
+    store: dict
+        feature store the model should be trained on
+
+    Returns
+    -------
+    bool
+    '''
+
+    params_path = os.path.join(save_dir, f'{domain}.json')
+    if not os.path.exists(os.path.join(save_dir, f'{domain}.npz')) or not os.path.exists(params_path):
+        return False
+    with open(params_path) as params_file:
+        return json.load(params_file).get('fingerprint') == store['fingerprint']
+
+
+def load_artifact(save_dir: str, domain: str) -> dict:
+
+    '''
+    Function to load a compact model artifact
+
+    Parameters
+    ----------
+    save_dir: str
+        artifact directory
+
+    domain: str
+        ADOS domain
+
+    Returns
+    -------
+    dict: dictionary object
+        dict of coef, intercept, cv_scores and best_params
+    '''
+
+    with np.load(os.path.join(save_dir, f'{domain}.npz')) as artifact:
+        loaded = {key: artifact[key] for key in artifact.files}
+    with open(os.path.join(save_dir, f'{domain}.json')) as params_file:
+        loaded.update(json.load(params_file))
+    loaded['intercept'] = float(loaded['intercept'])
+    return loaded
+
+
+def load_artifacts(save_dir: str, domains: list = None) -> dict:
+
+    '''
+    Function to load all the model artifacts in a directory with
+    the mask and standardization they were trained with. Raises if
+    a model was trained on a different feature store than the
+    saved mask and standardization are from.
+
+    Parameters
+    ----------
+    save_dir: str
+        artifact directory
+
+    domains: list
+        domains to load. Default all
+
+    Returns
+    -------
+    dict: dictionary object
+        dict of mask_img, mean, scale and models {domain: artifact}
+    '''
+
+    if domains is None:
+        domains = sorted(file[:-len('.npz')] for file in os.listdir(save_dir)
+                         if file.endswith('.npz') and file != 'standardization.npz')
+    with np.load(os.path.join(save_dir, 'standardization.npz')) as standardization:
+        mean, scale = standardization['mean'], standardization['scale']
+    with open(os.path.join(save_dir, 'feature_store.json')) as store_file:
+        fingerprint = json.load(store_file)['fingerprint']
+    models = {domain: load_artifact(save_dir, domain) for domain in domains}
+    stale = [domain for domain, model in models.items() if model.get('fingerprint') != fingerprint]
+    if stale:
+        raise ValueError(f'{", ".join(stale)} trained on a different feature store to {save_dir}. Retrain them')
+    return {
+        'mask_img': img.load_img(os.path.join(save_dir, 'mask_img.nii.gz')),
+        'mean': mean,
+        'scale': scale,
+        'models': models,
+    }
@@ -0,0 +1,313 @@
+import numpy as np
+import nibabel
+from sklearn.model_selection import ShuffleSplit, KFold, ParameterGrid
+from sklearn.metrics import r2_score
+from sklearn.svm import SVR
+from nilearn.regions import ReNA
+from model_artifacts import run_folds
+
+'''
+Functions to decode all the ADOS domains in one pass.
+
+The CV folds, the ReNA feature clustering of each fold and the fold
+data are shared by every target rather than recomputed per domain.
+FREM is reimplemented so a fold's clustering, screening correlations and
+linear kernel are calculated once and each target and grid point
+only fits an SVR on the precomputed kernel. Ridge fits all the targets
+(and all alphas) together in closed form.
+'''
+
+def shared_folds(n_samples: int, n_splits: int, shuffle_split: bool = True, random_state: int = 0) -> list:
+
+    '''
+    Function to create the CV folds shared by all targets.
+
+    Parameters
+    ----------
+    n_samples: int
+        number of subjects
+
+    n_splits: int
+        number of folds
+
+    shuffle_split: bool
+        If True uses ShuffleSplit as FREMRegressor does with an
+        int cv. Else KFold as SpaceNetRegressor does.
+
+    random_state: int
+        random state of splits
+
+    Returns
+    -------
+    list of (train, test) index arrays
+    '''
+
+    splitter = ShuffleSplit(n_splits, random_state=random_state) if shuffle_split else KFold(n_splits)
+    return list(splitter.split(np.zeros((n_samples, 1))))
+
+
+def cluster_fold(X: np.ndarray, train: np.ndarray, mask_img: nibabel.nifti1.Nifti1Image,
+                 clustering_percentile: int) -> ReNA:
+
+    '''
+    Function to fit ReNA clustering on a fold's
+    training data. Clustering is unsupervised so
+    is shared by all targets.
+
+    Parameters
+    ----------
+    X: np.ndarray
+        (subjects x voxels) features
+
+    train: np.ndarray
+        indices of training subjects
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask of features
+
+    clustering_percentile: int
+        percent of voxels to keep as clusters
+
+    Returns
+    -------
+    ReNA: fitted ReNA clustering
+    '''
+
+    n_clusters = int(X.shape[1] * clustering_percentile / 100.0)
+    return ReNA(mask_img, n_clusters=n_clusters, n_iter=20, threshold=1e-7, scaling=False).fit(np.asarray(X[train]))
+
+
+def screening_masks(X_train: np.ndarray, Y_train: np.ndarray, screening_percentile: int) -> np.ndarray:
+
+    '''
+    Function to do univariate feature screening for every target
+    at once. The F statistic of f_regression is a monotonic function
+    of the absolute correlation so features are ranked on correlations
+    from a single matrix product.
+
+    Parameters
+    ----------
+    X_train: np.ndarray
+        (subjects x features) training features
+
+    Y_train: np.ndarray
+        (subjects x targets) training targets
+
+    screening_percentile: int
+        percent of features to keep
+
+    Returns
+    -------
+    np.ndarray of (targets x features) bool of features kept
+    '''
+
+    X_centered = X_train - X_train.mean(axis=0)
+    Y_centered = Y_train - Y_train.mean(axis=0)
+    correlations = np.abs(X_centered.T @ Y_centered) / (
+        np.linalg.norm(X_centered, axis=0)[:, None] * np.linalg.norm(Y_centered, axis=0)[None, :] + 1e-12)
+    n_keep = max(1, int(np.ceil(X_train.shape[1] * screening_percentile / 100.0)))
+    keep = np.zeros((Y_train.shape[1], X_train.shape[1]), dtype=bool)
+    top = np.argsort(-correlations, axis=0)[:n_keep]
+    keep[np.repeat(np.arange(Y_train.shape[1])[None, :], n_keep, axis=0), top] = True
+    return keep
+
+
+def fit_frem_fold(X: np.ndarray, Y: np.ndarray, train: np.ndarray, test: np.ndarray,
+                  mask_img: nibabel.nifti1.Nifti1Image, param_grid: dict,
+                  clustering_percentile: int = 10, screening_percentile: int = 20) -> dict:
+
+    '''
+    Function to fit one FREM fold for all targets. For each target
+    the best grid point on the fold's test set is kept (as FREM does).
+
+    Parameters
+    ----------
+    X: np.ndarray
+        (subjects x voxels) features
+
+    Y: np.ndarray
+        (subjects x targets) targets
+
+    train: np.ndarray
+        indices of training subjects
+
+    test: np.ndarray
+        indices of test subjects
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask of features
+
+    param_grid: dict
+        grid of SVR parameters i.e C and epsilon
+
+    clustering_percentile: int
+        percent of voxels to keep as ReNA clusters
+
+    screening_percentile: int
+        percent of clusters to keep after screening
+
+    Returns
+    -------
+    dict: dictionary object
+        dict of coef (targets x voxels), intercept,
+        best_params and scores (one per target)
+    '''
+
+    clustering = cluster_fold(X, train, mask_img, clustering_percentile)
+    X_train = clustering.transform(np.asarray(X[train]))
+    X_test = clustering.transform(np.asarray(X[test]))
+    keep = screening_masks(X_train, Y[train], screening_percentile)
+
+    fold = {'coef': [], 'intercept': [], 'best_params': [], 'scores': []}
+    for target in range(Y.shape[1]):
+        train_kept, test_kept = X_train[:, keep[target]], X_test[:, keep[target]]
+        gram_train = train_kept @ train_kept.T
+        gram_test = test_kept @ train_kept.T
+        best = None
+        for params in ParameterGrid(param_grid):
+            svr = SVR(kernel='precomputed', **params).fit(gram_train, Y[train, target])
+            score = r2_score(Y[test, target], svr.predict(gram_test))
+            if best is None or score >= best['score']:
+                best = {'score': score, 'params': params, 'svr': svr}
+        clustered_coef = np.zeros(X_train.shape[1])
+        clustered_coef[keep[target]] = (best['svr'].dual_coef_ @ train_kept[best['svr'].support_])[0]
+        fold['coef'].append(clustering.inverse_transform(clustered_coef[None, :])[0])
+        fold['intercept'].append(float(best['svr'].intercept_[0]))
+        fold['best_params'].append(best['params'])
+        fold['scores'].append(best['score'])
+    fold['coef'] = np.array(fold['coef'], dtype=np.float32)
+    return fold
+
+
+def fit_frem_multi(X: np.ndarray, Y: np.ndarray, folds: list, mask_img: nibabel.nifti1.Nifti1Image,
+                   param_grid: dict, n_jobs: int = 8, clustering_percentile: int = 10,
+                   screening_percentile: int = 20, checkpoint_dir: str = None) -> dict:
+
+    '''
+    Function to fit FREM to all targets over shared folds.
+    The final model of each target is the average of
+    its best fold models.
+
+    Parameters
+    ----------
+    X: np.ndarray
+        (subjects x voxels) features. Memory-mapped
+        arrays are shared with the workers
+
+    Y: np.ndarray
+        (subjects x targets) targets
+
+    folds: list
+        list of (train, test) from shared_folds
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask of features
+
+    param_grid: dict
+        grid of SVR parameters i.e C and epsilon
+
+    n_jobs: int
+        number of folds to fit in parallel
+
+    clustering_percentile: int
+        percent of voxels to keep as ReNA clusters
+
+    screening_percentile: int
+        percent of clusters to keep after screening
+
+    checkpoint_dir: str
+        directory to checkpoint each fold in so an interrupted
+        fit resumes. If None folds are not checkpointed
+
+    Returns
+    -------
+    dict: dictionary object
+        dict of coef (targets x voxels), intercept (targets),
+        best_params and cv_scores (targets x folds)
+    '''
+
+    Y = np.asarray(Y, dtype=float)
+    fold_fits = run_folds(fit_frem_fold, folds, checkpoint_dir, n_jobs, X, Y,
+                          mask_img=mask_img, param_grid=param_grid,
+                          clustering_percentile=clustering_percentile,
+                          screening_percentile=screening_percentile)
+    return combine_folds(fold_fits)
+
+
+def combine_folds(fold_fits: list) -> dict:
+
+    '''
+    Function to average fold models into the final
+    model of each target (CV bagging).
+
+    Parameters
+    ----------
+    fold_fits: list
+        list of dicts from fit_frem_fold
+
+    Returns
+    -------
+    dict: dictionary object
+        dict of coef (targets x voxels), intercept (targets),
+        best_params and cv_scores (targets x folds)
+    '''
+
+    return {
+        'coef': np.mean([fold['coef'] for fold in fold_fits], axis=0).astype(np.float32),
+        'intercept': np.mean([fold['intercept'] for fold in fold_fits], axis=0),
+        'best_params': [[fold['best_params'][target] for fold in fold_fits]
+                        for target in range(len(fold_fits[0]['best_params']))],
+        'cv_scores': np.array([fold['scores'] for fold in fold_fits]).T,
+    }
+
+
+def fit_ridge_multi(X: np.ndarray, Y: np.ndarray, folds: list, alphas: list) -> dict:
+
+    '''
+    Function to fit ridge regression to all targets and all alphas
+    together. Each fold needs one eigendecomposition of the
+    (subjects x subjects) kernel, after which every target and alpha is
+    a matrix product.
+
+    Parameters
+    ----------
+    X: np.ndarray
+        (subjects x voxels) features
+
+    Y: np.ndarray
+        (subjects x targets) targets. Can be many columns
+        i.e permuted targets
+
+    folds: list
+        list of (train, test) from shared_folds
+
+    alphas: list
+        ridge penalties
+
+    Returns
+    -------
+    dict: dictionary object
+        dict of cv_scores (alphas x targets x folds) of r2 and
+        best_alpha (targets)
+    '''
+
+    Y = np.asarray(Y, dtype=float)
+    scores = np.zeros((len(alphas), Y.shape[1], len(folds)))
+    for fold_number, (train, test) in enumerate(folds):
+        X_train = np.asarray(X[train], dtype=float)
+        y_mean = Y[train].mean(axis=0)
+        x_mean = X_train.mean(axis=0)
+        X_train = X_train - x_mean
+        eigenvalues, eigenvectors = np.linalg.eigh(X_train @ X_train.T)
+        projected = eigenvectors.T @ (Y[train] - y_mean)
+        gram_test = (np.asarray(X[test], dtype=float) - x_mean) @ X_train.T
+        for alpha_number, alpha in enumerate(alphas):
+            dual = eigenvectors @ (projected / (eigenvalues + alpha)[:, None])
+            predicted = gram_test @ dual + y_mean
+            residual = ((Y[test] - predicted) ** 2).sum(axis=0)
+            total = ((Y[test] - Y[test].mean(axis=0)) ** 2).sum(axis=0)
+            scores[alpha_number, :, fold_number] = 1 - residual / np.where(total > 0, total, 1)
+    return {
+        'cv_scores': scores,
+        'best_alpha': np.array(alphas)[scores.mean(axis=2).argmax(axis=0)],
+    }
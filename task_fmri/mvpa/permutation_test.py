@@ -0,0 +1,251 @@
+from decouple import config
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from fNeuro.utils.pickling import ados
+from feature_store import feature_store
+from multi_target import shared_folds, fit_frem_multi, fit_ridge_multi
+from build_frem_models import param_grid
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'utils'))
+from instrumentation import profile
+
+'''
+Script to test whether the decoders predict ADOS scores above chance.
+
+Uses the cached feature store and one set of CV folds for the observed
+and every permuted score. The default surrogate estimator is ridge
+regression, which fits a whole batch of permuted targets (and all its
+alphas) in closed form with one kernel eigendecomposition per fold.
+FREM can be used instead and also fits a batch of permuted targets
+sharing each fold's clustering. Batches run in parallel until the
+number of permutations or the time budget of the domain is reached.
+'''
+
+ridge_alphas = np.logspace(-1, 5, 13)
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of flags
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-e', '--estimator',
+                      dest='estimator',
+                      default='ridge',
+                      choices=['ridge', 'frem'],
+                      help='ridge surrogate or the full FREM estimator')
+    args.add_argument('-n', '--permutations',
+                      dest='permutations',
+                      type=int,
+                      default=1000,
+                      help='Number of permutations per domain')
+    args.add_argument('-b', '--batch_size',
+                      dest='batch_size',
+                      type=int,
+                      default=100,
+                      help='Number of permutations fitted together')
+    args.add_argument('-t', '--time_budget',
+                      dest='time_budget',
+                      type=float,
+                      default=3600,
+                      help='Maximum seconds of permutations per domain')
+    args.add_argument('-f', '--folds',
+                      dest='folds',
+                      type=int,
+                      default=10,
+                      help='Number of CV folds')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=8,
+                      help='Number of batches to run in parallel')
+    return vars(args.parse_args())
+
+
+def cv_scores(X: np.ndarray, Y: np.ndarray, folds: list, estimator: str, mask_img=None) -> np.ndarray:
+
+    '''
+    Function to score each target column with
+    the mean r2 over the CV folds.
+
+    Parameters
+    ----------
+    X: np.ndarray
+        (subjects x voxels) features
+
+    Y: np.ndarray
+        (subjects x targets) targets
+
+    folds: list
+        list of (train, test) indices
+
+    estimator: str
+        ridge or frem
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask of features, for frem
+
+    Returns
+    -------
+    np.ndarray of score per target
+    '''
+
+    if estimator == 'frem':
+        return fit_frem_multi(X, Y, folds, mask_img, param_grid, n_jobs=1)['cv_scores'].mean(axis=1)
+    return fit_ridge_multi(X, Y, folds, ridge_alphas)['cv_scores'].mean(axis=2).max(axis=0)
+
+
+def permuted_scores(X: np.ndarray, y: np.ndarray, folds: list, estimator: str, batch_size: int,
+                    seed: int, mask_img=None) -> np.ndarray:
+
+    '''
+    Function to score a batch of label permutations
+
+    Parameters
+    ----------
+    X: np.ndarray
+        (subjects x voxels) features
+
+    y: np.ndarray
+        targets
+
+    folds: list
+        list of (train, test) indices
+
+    estimator: str
+        ridge or frem
+
+    batch_size: int
+        number of permutations
+
+    seed: int
+        random seed of batch
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask of features, for frem
+
+    Returns
+    -------
+    np.ndarray of score per permutation
+    '''
+
+    rng = np.random.default_rng(seed)
+    Y_permuted = np.column_stack([rng.permutation(y) for _ in range(batch_size)])
+    return cv_scores(X, Y_permuted, folds, estimator, mask_img)
+
+
+def null_distribution(X: np.ndarray, y: np.ndarray, folds: list, estimator: str, n_permutations: int,
+                      batch_size: int, time_budget: float, n_jobs: int = 8, seed: int = 0,
+                      mask_img=None) -> np.ndarray:
+
+    '''
+    Function to build the null distribution of a domain. Rounds of
+    n_jobs batches run until n_permutations are done or the time
+    budget runs out, so the budget may be exceeded by one round.
+
+    Parameters
+    ----------
+    X: np.ndarray
+        (subjects x voxels) features
+
+    y: np.ndarray
+        targets
+
+    folds: list
+        list of (train, test) indices
+
+    estimator: str
+        ridge or frem
+
+    n_permutations: int
+        number of permutations
+
+    batch_size: int
+        number of permutations per batch
+
+    time_budget: float
+        maximum seconds
+
+    n_jobs: int
+        number of batches to run in parallel
+
+    seed: int
+        random seed
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask of features, for frem
+
+    Returns
+    -------
+    np.ndarray of permuted scores
+    '''
+
+    start = time.perf_counter()
+    null = []
+    batch = 0
+    with Parallel(n_jobs=n_jobs) as parallel:
+        while len(null) < n_permutations and time.perf_counter() - start < time_budget:
+            batch_sizes = [min(batch_size, n_permutations - len(null) - done)
+                           for done in range(0, n_permutations - len(null), batch_size)][:n_jobs]
+            scores = parallel(delayed(permuted_scores)(X, y, folds, estimator, size, seed + batch + number, mask_img)
+                              for number, size in enumerate(batch_sizes))
+            null.extend(np.concatenate(scores))
+            batch += len(batch_sizes)
+            print(f'\t{len(null)} permutations in {time.perf_counter() - start:.0f} seconds')
+    return np.array(null)
+
+
+if __name__ == "__main__":
+    flags = options()
+    print(f'\nPermutation testing with {flags["estimator"]}')
+    ados_df = ados('G2', test_train='train', directory='combined')
+    ados_df = ados_df.drop([20]) # Remove the one outlier
+    print('\nLoading feature store')
+    with profile('feature_store', scans=len(ados_df)):
+        store = feature_store(ados_df['paths'], 'combined_train')
+    domains = ados_df.columns[1:6]
+    folds = shared_folds(ados_df.shape[0], flags['folds'], shuffle_split=flags['estimator'] == 'frem')
+    save_dir = os.path.join(config('ml'), 'permutation_test', flags['estimator'])
+    os.makedirs(save_dir, exist_ok=True)
+
+    results = []
+    for domain_number, domain in enumerate(domains):
+        print(f'\nWorking on {domain}')
+        y = ados_df[domain].values.astype(float)
+        start = time.perf_counter()
+        with profile('observed_score', domain=domain, estimator=flags['estimator']):
+            observed = cv_scores(store['features'], y[:, None], folds, flags['estimator'], store['mask_img'])[0]
+        with profile('permutations', domain=domain, estimator=flags['estimator']):
+            null = null_distribution(store['features'], y, folds, flags['estimator'], flags['permutations'],
+                                     flags['batch_size'], flags['time_budget'], flags['jobs'],
+                                     seed=domain_number * 1000000, mask_img=store['mask_img'])
+        np.save(os.path.join(save_dir, f'{domain}_null.npy'), null)
+        results.append({
+            'domain': domain,
+            'observed_r2': observed,
+            'n_permutations': len(null),
+            'p_value': (1 + np.sum(null >= observed)) / (1 + len(null)),
+            'null_mean': null.mean(),
+            'null_95': np.percentile(null, 95),
+            'seconds': time.perf_counter() - start,
+        })
+        print(f'\tr2 = {observed:.3f}, p = {results[-1]["p_value"]:.4f}')
+
+    results_df = pd.DataFrame(results)
+    print(results_df.to_string(index=False))
+    results_df.to_csv(os.path.join(save_dir, 'p_values.csv'), index=False)
+    print(f'\nSaved null distributions and p values to {save_dir}')
@@ -0,0 +1,256 @@
+from decouple import config
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from fNeuro.utils.pickling import ados
+from feature_store import mask_images
+from model_artifacts import load_artifacts
+
+'''
+Script and functions to predict ADOS scores from trained decoders.
+
+The compact artifacts of a model directory are loaded once and the
+feature standardization is folded into the coefficients, so
+predicting every domain for a batch of subjects is masking their
+images then a single (subjects x voxels) @ (voxels x domains) product.
+'''
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of flags
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-m', '--model',
+                      dest='model',
+                      default=os.path.join('frem_best_estimator', 'frem'),
+                      help='Model artifact directory, relative to the ml directory')
+    args.add_argument('-i', '--images',
+                      dest='images',
+                      nargs='+',
+                      default=None,
+                      help='Images to predict or a csv with a paths column. Default the test set')
+    args.add_argument('-o', '--output',
+                      dest='output',
+                      default=None,
+                      help='csv to save predictions to. Default predictions.csv in the model directory')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=8,
+                      help='Number of jobs to mask images with')
+    args.add_argument('--benchmark',
+                      dest='benchmark',
+                      action='store_true',
+                      help='Report throughput per 100 subjects')
+    return vars(args.parse_args())
+
+
+def load_decoder(artifact_dir: str, domains: list = None) -> dict:
+
+    '''
+    Function to load a model directory as a decoder. With z the
+    standardized features ((x - mean) / scale) each model is
+    z @ coef + intercept, which is folded into
+    x @ (coef / scale) + (intercept - (mean / scale) @ coef)
+    so raw masked images can be predicted directly.
+
+    Parameters
+    ----------
+    artifact_dir: str
+        model artifact directory
+
+    domains: list
+        domains to load. Default all
+
+    Returns
+    -------
+    dict: dictionary object
+        dict of domains, weights (voxels x domains) float32,
+        intercepts (domains) and mask_img
+    '''
+
+    artifacts = load_artifacts(artifact_dir, domains)
+    domains = list(artifacts['models'])
+    coef = np.array([artifacts['models'][domain]['coef'] for domain in domains], dtype=np.float64).T
+    intercept = np.array([artifacts['models'][domain]['intercept'] for domain in domains])
+    mean, scale = artifacts['mean'].astype(np.float64), artifacts['scale'].astype(np.float64)
+    return {
+        'domains': domains,
+        'weights': (coef / scale[:, None]).astype(np.float32),
+        'intercepts': intercept - (mean / scale) @ coef,
+        'mask_img': artifacts['mask_img'],
+    }
+
+
+def mask_batch(paths: list, decoder: dict, n_jobs: int = 8) -> np.ndarray:
+
+    '''
+    Function to mask a batch of images onto the
+    decoder's mask in parallel chunks.
+
+    Parameters
+    ----------
+    paths: list
+        list of paths to images
+
+    decoder: dict
+        decoder from load_decoder
+
+    n_jobs: int
+        number of jobs
+
+    Returns
+    -------
+    np.ndarray of (subjects x voxels) float32
+    '''
+
+    chunks = np.array_split(np.asarray(paths), min(n_jobs, len(paths)))
+    return np.vstack(Parallel(n_jobs=n_jobs)(delayed(mask_images)(list(chunk), decoder['mask_img']) for chunk in chunks))
+
+
+def predict_features(features: np.ndarray, decoder: dict) -> np.ndarray:
+
+    '''
+    Function to predict all domains from masked images
+
+    Parameters
+    ----------
+    features: np.ndarray
+        (subjects x voxels) masked images
+
+    decoder: dict
+        decoder from load_decoder
+
+    Returns
+    -------
+    np.ndarray of (subjects x domains) predictions
+    '''
+
+    return features @ decoder['weights'] + decoder['intercepts']
+
+
+def predict(paths: list, decoder: dict, n_jobs: int = 8) -> pd.DataFrame:
+
+    '''
+    Function to predict ADOS domains for a batch of images
+
+    Parameters
+    ----------
+    paths: list
+        list of paths to images
+
+    decoder: dict
+        decoder from load_decoder
+
+    n_jobs: int
+        number of jobs to mask images with
+
+    Returns
+    -------
+    pd.DataFrame of paths and predicted score of each domain
+    '''
+
+    predictions = predict_features(mask_batch(paths, decoder, n_jobs), decoder)
+    predictions_df = pd.DataFrame(predictions, columns=decoder['domains'])
+    predictions_df.insert(0, 'paths', list(paths))
+    return predictions_df
+
+
+def benchmark(paths: list, decoder: dict, n_jobs: int = 8, repeats: int = 5) -> pd.DataFrame:
+
+    '''
+    Function to benchmark prediction throughput
+
+    Parameters
+    ----------
+    paths: list
+        list of paths to images
+
+    decoder: dict
+        decoder from load_decoder
+
+    n_jobs: int
+        number of jobs to mask images with
+
+    repeats: int
+        number of times to repeat the prediction
+
+    Returns
+    -------
+    pd.DataFrame of seconds per 100 subjects of masking,
+    prediction and both
+    '''
+
+    start = time.perf_counter()
+    features = mask_batch(paths, decoder, n_jobs)
+    mask_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeats):
+        predict_features(features, decoder)
+    predict_seconds = (time.perf_counter() - start) / repeats
+    per_100 = 100 / len(paths)
+    return pd.DataFrame(data={
+        'stage': ['masking', 'prediction', 'total'],
+        'seconds_per_100_subjects': [mask_seconds * per_100, predict_seconds * per_100,
+                                     (mask_seconds + predict_seconds) * per_100],
+        'subjects_per_second': [len(paths) / mask_seconds, len(paths) / predict_seconds,
+                                len(paths) / (mask_seconds + predict_seconds)],
+    })
+
+
+def input_images(images: list) -> pd.DataFrame:
+
+    '''
+    Function to get the images to predict
+
+    Parameters
+    ----------
+    images: list
+        list of images, a csv with a paths column
+        or None for the test set
+
+    Returns
+    -------
+    pd.DataFrame with a paths column
+    '''
+
+    if images is None:
+        return ados('G2', test_train='test', directory='combined')
+    if len(images) == 1 and images[0].endswith('.csv'):
+        return pd.read_csv(images[0])
+    return pd.DataFrame(data={'paths': images})
+
+
+if __name__ == "__main__":
+    flags = options()
+    artifact_dir = os.path.join(config('ml'), flags['model'])
+    print(f'\nLoading decoder from {artifact_dir}')
+    decoder = load_decoder(artifact_dir)
+    images_df = input_images(flags['images'])
+    paths = list(images_df['paths'])
+
+    if flags['benchmark']:
+        print(f'\nBenchmarking prediction of {len(decoder["domains"])} domains for {len(paths)} subjects')
+        print(benchmark(paths, decoder, flags['jobs']).to_string(index=False))
+
+    print(f'\nPredicting {", ".join(decoder["domains"])} for {len(paths)} subjects')
+    predictions_df = predict(paths, decoder, flags['jobs'])
+    if 'G-Number' in images_df.columns:
+        predictions_df.insert(0, 'G-Number', images_df['G-Number'].values)
+    output = flags['output'] if flags['output'] else os.path.join(artifact_dir, 'predictions.csv')
+    predictions_df.to_csv(output, index=False)
+    print(f'\nSaved predictions to {output}')
@@ -0,0 +1,445 @@
+from decouple import config
+import os
+import re
+import sys
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel
+from scipy import sparse
+from joblib import Parallel, delayed
+from nilearn.maskers import NiftiMasker
+from nilearn.masking import unmask
+from nilearn import image as img
+from searchlight import mask_key, betas_key, sphere_index
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modelling'))
+from first_level_index import FirstLevelIndex
+
+'''
+Script and functions for representational similarity analysis (RSA) of
+the beta series maps from beta_regression.py.
+
+Each subject's trials are split into odd and even partitions, averaged
+per condition and noise normalized (divided by each voxel's residual
+standard deviation) and cached. ROIs and searchlight spheres are both
+sparse (regions x voxels) membership matrices, so the RDMs of every
+region come from per-voxel terms summed over regions with one sparse
+matrix product. Correlation distance uses the mean of the partitions,
+crossnobis is the cross-validated distance between the partitions.
+RDMs are compared between T1 and T2 (sign flipping paired differences)
+and between HC and AN (permuting group labels) with max statistic
+family-wise error correction, running permutations in parallel batches.
+'''
+
+distances = ['correlation', 'crossnobis']
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of flags
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-d', '--distance',
+                      dest='distance',
+                      default='crossnobis',
+                      choices=distances,
+                      help='RDM distance')
+    args.add_argument('-l', '--level',
+                      dest='level',
+                      default='roi',
+                      choices=['roi', 'searchlight'],
+                      help='Compute RDMs in atlas ROIs or searchlight spheres')
+    args.add_argument('-a', '--atlas',
+                      dest='atlas',
+                      default='harvard_oxford_cortical',
+                      help='Atlas of ROIs from the atlas index')
+    args.add_argument('-m', '--mask',
+                      dest='mask',
+                      default=os.path.join(config('eft'), '2ndlevel', 'mixed_model', 'mask_img.nii.gz'),
+                      help='Mask of voxels')
+    args.add_argument('-r', '--radius',
+                      dest='radius',
+                      type=float,
+                      default=6,
+                      help='Searchlight radius in mm')
+    args.add_argument('-n', '--permutations',
+                      dest='permutations',
+                      type=int,
+                      default=5000,
+                      help='Number of permutations')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=8,
+                      help='Number of jobs')
+    return vars(args.parse_args())
+
+
+def trial_paths(subject_dir: str) -> pd.DataFrame:
+
+    '''
+    Function to get a subject's beta maps with their
+    condition, trial number and partition.
+
+    Parameters
+    ----------
+    subject_dir: str
+        directory of subject's beta maps
+
+    Returns
+    -------
+    pd.DataFrame of path, condition, trial and
+    partition (0 even, 1 odd trials)
+    '''
+
+    trials = []
+    for path in glob.glob(os.path.join(subject_dir, '*_*.nii.gz')):
+        match = re.match(r'(.+)_(\d+)\.nii\.gz$', os.path.basename(path))
+        if match:
+            trials.append({'path': path, 'condition': match.group(1), 'trial': int(match.group(2))})
+    trials_df = pd.DataFrame(trials, columns=['path', 'condition', 'trial'])
+    trials_df['partition'] = trials_df['trial'] % 2
+    return trials_df.sort_values(['condition', 'trial']).reset_index(drop=True)
+
+
+def noise_normalized_patterns(subject_dir: str, mask_img: nibabel.nifti1.Nifti1Image, cache_dir: str) -> dict:
+
+    '''
+    Function to load, or compute and cache, a subject's noise
+    normalized condition patterns of each partition. The cache
+    is keyed by the mask and the beta maps.
+
+    Parameters
+    ----------
+    subject_dir: str
+        directory of subject's beta maps
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask
+
+    cache_dir: str
+        directory to cache patterns in
+
+    Returns
+    -------
+    dict: dictionary object
+        dict of patterns (partitions x conditions x voxels)
+        and conditions
+    '''
+
+    trials_df = trial_paths(subject_dir)
+    cache = os.path.join(cache_dir, f'rsa_patterns_{mask_key(mask_img, 0)}_{betas_key(list(trials_df["path"]))}.npz')
+    if os.path.exists(cache):
+        with np.load(cache) as cached:
+            return {'patterns': cached['patterns'], 'conditions': list(cached['conditions'])}
+
+    betas = np.nan_to_num(NiftiMasker(mask_img=mask_img).fit().transform(list(trials_df['path'])))
+    conditions = sorted(trials_df['condition'].unique())
+    cells = trials_df.groupby(['partition', 'condition']).indices
+    patterns = np.zeros((2, len(conditions), betas.shape[1]))
+    residuals = betas.copy()
+    for (partition, condition), rows in cells.items():
+        patterns[partition, conditions.index(condition)] = betas[rows].mean(axis=0)
+        residuals[rows] -= patterns[partition, conditions.index(condition)]
+    noise_sd = np.sqrt((residuals ** 2).sum(axis=0) / max(betas.shape[0] - len(cells), 1))
+    patterns = (patterns / np.where(noise_sd > 0, noise_sd, 1)).astype(np.float32)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale in glob.glob(os.path.join(cache_dir, f'rsa_patterns_{mask_key(mask_img, 0)}*.npz')):
+        os.remove(stale)
+    np.savez(cache, patterns=patterns, conditions=np.array(conditions))
+    return {'patterns': patterns, 'conditions': conditions}
+
+
+def roi_membership(mask_img: nibabel.nifti1.Nifti1Image, atlas: str) -> tuple:
+
+    '''
+    Function to build the sparse ROI membership of mask
+    voxels from the atlas index. The atlas index
+    must be built on the mask's grid.
+
+    Parameters
+    ----------
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask
+
+    atlas: str
+        name of atlas in the atlas index
+
+    Returns
+    -------
+    tuple of sparse.csr_matrix (regions x voxels)
+    and list of region names
+    '''
+
+    index_dir = os.path.join(config('eft'), '2ndlevel', 'atlas_index')
+    volume = np.load(os.path.join(index_dir, f'{atlas}_labels.npy'), mmap_mode='r')
+    table = pd.read_csv(os.path.join(index_dir, f'{atlas}_labels.csv'))
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    if volume.shape != mask.shape:
+        raise ValueError(f'Atlas index {atlas} is not on the grid of the mask')
+    voxel_labels = np.asarray(volume)[mask]
+    table = table[table['label'].isin(voxel_labels)].reset_index(drop=True)
+    rows = pd.Series(table.index, index=table['label'])
+    voxels = np.flatnonzero(np.isin(voxel_labels, table['label']))
+    membership = sparse.csr_matrix((np.ones(len(voxels), dtype=np.float32), (rows[voxel_labels[voxels]].values, voxels)),
+                                   shape=(len(table), mask.sum()))
+    return membership, list(table['region'])
+
+
+def rdms(patterns: np.ndarray, membership: sparse.csr_matrix, distance: str) -> np.ndarray:
+
+    '''
+    Function to compute the RDM of every region at once.
+    The per-voxel terms of the distance are summed over each
+    region's voxels by a sparse matrix product.
+
+    Parameters
+    ----------
+    patterns: np.ndarray
+        (partitions x conditions x voxels) patterns
+
+    membership: sparse.csr_matrix
+        (regions x voxels) membership
+
+    distance: str
+        correlation or crossnobis
+
+    Returns
+    -------
+    np.ndarray of (regions x condition pairs) dissimilarities
+    '''
+
+    n_conditions = patterns.shape[1]
+    first, second = np.triu_indices(n_conditions, 1)
+    n_voxels = np.asarray(membership.sum(axis=1)).ravel()
+    n_voxels[n_voxels == 0] = 1
+    if distance == 'crossnobis':
+        differences = patterns[:, first] - patterns[:, second]
+        return np.asarray(membership @ (differences[0] * differences[1]).T) / n_voxels[:, None]
+
+    mean_pattern = patterns.mean(axis=0)
+    sums = np.asarray(membership @ mean_pattern.T)
+    squares = np.asarray(membership @ (mean_pattern ** 2).T)
+    cross = np.asarray(membership @ (mean_pattern[first] * mean_pattern[second]).T)
+    covariance = cross - sums[:, first] * sums[:, second] / n_voxels[:, None]
+    variance = squares - sums ** 2 / n_voxels[:, None]
+    return 1 - covariance / np.sqrt(np.clip(variance[:, first] * variance[:, second], 1e-12, None))
+
+
+def permutation_batch(values: np.ndarray, groups: np.ndarray, statistic: np.ndarray,
+                      batch_size: int, seed: int) -> tuple:
+
+    '''
+    Function to run a batch of permutations. With groups the
+    group labels are permuted, otherwise the signs of the
+    (paired difference) values are flipped.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        (subjects x elements) values
+
+    groups: np.ndarray
+        bool of group membership or None for a paired test
+
+    statistic: np.ndarray
+        observed statistic of each element
+
+    batch_size: int
+        number of permutations
+
+    seed: int
+        random seed
+
+    Returns
+    -------
+    tuple of counts of permuted |statistic| >= observed |statistic|
+    per element and max |statistic| of each permutation
+    '''
+
+    rng = np.random.default_rng(seed)
+    exceed = np.zeros(values.shape[1], dtype=np.int64)
+    maxima = np.zeros(batch_size)
+    for permutation in range(batch_size):
+        if groups is None:
+            null = (rng.choice([-1, 1], size=values.shape[0]) @ values) / values.shape[0]
+        else:
+            permuted = rng.permutation(groups)
+            null = values[permuted].mean(axis=0) - values[~permuted].mean(axis=0)
+        exceed += np.abs(null) >= np.abs(statistic)
+        maxima[permutation] = np.nanmax(np.abs(null))
+    return exceed, maxima
+
+
+def permutation_test(values: np.ndarray, groups: np.ndarray = None, n_permutations: int = 5000,
+                     n_jobs: int = 8, seed: int = 0) -> dict:
+
+    '''
+    Function to test the mean (paired) or group difference
+    of every element with parallel permutations.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        (subjects x elements) values i.e RDMs or T2 - T1 RDMs
+
+    groups: np.ndarray
+        bool of group membership or None for a paired test
+
+    n_permutations: int
+        number of permutations
+
+    n_jobs: int
+        number of batches to run in parallel
+
+    seed: int
+        random seed
+
+    Returns
+    -------
+    dict: dictionary object
+        dict of statistic, p (uncorrected) and p_fwe
+        (max statistic corrected) of each element
+    '''
+
+    values = np.asarray(values, dtype=float)
+    if groups is None:
+        statistic = values.mean(axis=0)
+    else:
+        groups = np.asarray(groups, dtype=bool)
+        statistic = values[groups].mean(axis=0) - values[~groups].mean(axis=0)
+    batch_sizes = [len(batch) for batch in np.array_split(np.arange(n_permutations), n_jobs) if len(batch)]
+    batches = Parallel(n_jobs=n_jobs)(delayed(permutation_batch)(values, groups, statistic, size, seed + number)
+                                      for number, size in enumerate(batch_sizes))
+    exceed = sum(batch[0] for batch in batches)
+    maxima = np.concatenate([batch[1] for batch in batches])
+    return {
+        'statistic': statistic,
+        'p': (1 + exceed) / (1 + n_permutations),
+        'p_fwe': (1 + (maxima[None, :] >= np.abs(statistic)[:, None]).sum(axis=1)) / (1 + n_permutations),
+    }
+
+
+def subject_rdms(time_point: str, mask_img: nibabel.nifti1.Nifti1Image, membership: sparse.csr_matrix,
+                 distance: str, n_jobs: int = 8) -> tuple:
+
+    '''
+    Function to compute the RDMs of all subjects
+    of a time point in parallel.
+
+    Parameters
+    ----------
+    time_point: str
+        T1 or T2
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask
+
+    membership: sparse.csr_matrix
+        (regions x voxels) membership
+
+    distance: str
+        correlation or crossnobis
+
+    n_jobs: int
+        number of subjects to run in parallel
+
+    Returns
+    -------
+    tuple of dict {subject: (regions x pairs) RDMs}
+    and list of conditions. Both are empty if the
+    time point has no beta maps
+    '''
+
+    beta_dir = os.path.join(config('eft'), 'spotlight', 'beta_regression', time_point)
+    subjects = sorted(os.path.basename(subject) for subject in glob.glob(os.path.join(beta_dir, 'sub-*')))
+    patterns = Parallel(n_jobs=n_jobs)(
+        delayed(noise_normalized_patterns)(os.path.join(beta_dir, subject), mask_img,
+                                           os.path.join(config('eft'), 'spotlight', 'rsa', 'patterns', time_point, subject))
+        for subject in subjects)
+    if not patterns:
+        return {}, []
+    conditions = max((subject['conditions'] for subject in patterns), key=len)
+    return {subject: rdms(subject_patterns['patterns'], membership, distance)
+            for subject, subject_patterns in zip(subjects, patterns)
+            if subject_patterns['conditions'] == conditions}, conditions
+
+
+if __name__ == '__main__':
+    flags = options()
+    mask_img = img.load_img(flags['mask'])
+    if flags['level'] == 'roi':
+        membership, regions = roi_membership(mask_img, flags['atlas'])
+    else:
+        membership = sphere_index(mask_img, flags['radius'], os.path.join(config('eft'), 'spotlight', 'sphere_index'))
+        regions = None
+    save_dir = os.path.join(config('eft'), 'spotlight', 'rsa', f'{flags["level"]}_{flags["distance"]}')
+    os.makedirs(save_dir, exist_ok=True)
+
+    print(f'\nComputing {flags["distance"]} RDMs in {membership.shape[0]} regions')
+    time_point_rdms, conditions = {}, []
+    for time_point in ['T1', 'T2']:
+        rdms_dict, time_point_conditions = subject_rdms(time_point, mask_img, membership, flags['distance'], flags['jobs'])
+        print(f'{time_point}: {len(rdms_dict)} subjects')
+        if not rdms_dict:
+            continue
+        if conditions and time_point_conditions != conditions:
+            print(f'Skipping {time_point}, its conditions {time_point_conditions} differ from {conditions}')
+            continue
+        time_point_rdms[time_point], conditions = rdms_dict, time_point_conditions
+    if not time_point_rdms:
+        raise ValueError('No beta maps found at either time point')
+    first, second = np.triu_indices(len(conditions), 1)
+    pairs = [f'{conditions[condition_1]}-{conditions[condition_2]}' for condition_1, condition_2 in zip(first, second)]
+
+    participants = FirstLevelIndex(['eft']).participants('eft')
+    comparisons = {}
+    for time_point, rdms_dict in time_point_rdms.items():
+        subjects = list(rdms_dict)
+        comparisons[f'HC_vs_AN_{time_point}'] = (np.array([rdms_dict[subject].ravel() for subject in subjects]),
+                                                 np.array([bool(re.match(r'sub-[GB]1', subject)) for subject in subjects]))
+    t1 = {participants.get(subject, subject): rdm for subject, rdm in time_point_rdms.get('T1', {}).items()}
+    t2 = {participants.get(subject, subject): rdm for subject, rdm in time_point_rdms.get('T2', {}).items()}
+    paired = sorted(set(t1) & set(t2))
+    if paired:
+        comparisons['T2_vs_T1'] = (np.array([(t2[participant] - t1[participant]).ravel() for participant in paired]), None)
+    else:
+        print('No participants with RDMs at both time points, skipping T2_vs_T1')
+
+    results = []
+    for comparison, (values, groups) in comparisons.items():
+        print(f'\nPermutation testing {comparison} with {values.shape[0]} subjects')
+        test = permutation_test(values, groups, flags['permutations'], flags['jobs'])
+        shape = (membership.shape[0], len(pairs))
+        if flags['level'] == 'searchlight':
+            for pair_number, pair in enumerate(pairs):
+                for measure in ['statistic', 'p', 'p_fwe']:
+                    unmask(test[measure].reshape(shape)[:, pair_number], mask_img).to_filename(
+                        os.path.join(save_dir, f'{comparison}_{pair}_{measure}.nii.gz'))
+            continue
+        results.append(pd.DataFrame(data={
+            'comparison': comparison,
+            'region': np.repeat(regions, len(pairs)),
+            'pair': np.tile(pairs, len(regions)),
+            'statistic': test['statistic'],
+            'p': test['p'],
+            'p_fwe': test['p_fwe'],
+        }))
+
+    if results:
+        results_df = pd.concat(results)
+        results_df.to_csv(os.path.join(save_dir, 'rsa_permutation_tests.csv'), index=False)
+        print(f'\n{(results_df["p_fwe"] < 0.05).sum()} of {results_df.shape[0]} tests with p_fwe < 0.05')
+    print(f'\nSaved RSA results to {save_dir}')
@@ -0,0 +1,401 @@
+from decouple import config
+import os
+import re
+import sys
+import glob
+import json
+import hashlib
+import argparse
+import numpy as np
+import nibabel
+from scipy import sparse
+from joblib import Parallel, delayed
+from sklearn.neighbors import radius_neighbors_graph
+from sklearn.model_selection import StratifiedKFold
+from sklearn.svm import LinearSVC
+from nilearn.maskers import NiftiMasker
+from nilearn.masking import unmask
+from nilearn import image as img
+
+'''
+Script to run searchlight decoding of EFT ComplexFigures vs SimpleFigures
+trials on the beta series maps from beta_regression.py.
+
+The sphere around every voxel of the mask is computed once per mask and
+radius as a sparse (voxels x voxels) adjacency matrix and cached, so all
+subjects share it. Each subject's beta maps are masked once and cached
+as a float32 array that workers memory-map, the spheres are split into
+chunks that a worker pool cross-validates. Each subject's accuracy map is
+saved as it finishes so a group run only loads one subject at a time
+and resumes from the subjects already done.
+'''
+
+conditions = ['ComplexFigures', 'SimpleFigures']
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of flags
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-s', '--subjects',
+                      dest='subjects',
+                      nargs='+',
+                      default=None,
+                      help='Subjects to run. Default all subjects with beta maps')
+    args.add_argument('-t', '--time_point',
+                      dest='time_point',
+                      default='T1',
+                      help='Time point of beta maps')
+    args.add_argument('-m', '--mask',
+                      dest='mask',
+                      default=os.path.join(config('eft'), '2ndlevel', 'mixed_model', 'mask_img.nii.gz'),
+                      help='Mask defining the searchlight centres')
+    args.add_argument('-r', '--radius',
+                      dest='radius',
+                      type=float,
+                      default=6,
+                      help='Sphere radius in mm')
+    args.add_argument('-c', '--chunk_size',
+                      dest='chunk_size',
+                      type=int,
+                      default=2000,
+                      help='Number of spheres per worker task')
+    args.add_argument('-f', '--folds',
+                      dest='folds',
+                      type=int,
+                      default=4,
+                      help='Number of CV folds')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=8,
+                      help='Number of workers')
+    return vars(args.parse_args())
+
+
+def searchlight_dir(time_point: str) -> str:
+
+    '''
+    Function to return the searchlight directory
+    of a time point
+
+    Parameters
+    ----------
+    time_point: str
+        T1 or T2
+
+    Returns
+    -------
+    str of path to searchlight directory
+    '''
+
+    return os.path.join(config('eft'), 'spotlight', 'searchlight', time_point)
+
+
+def mask_key(mask_img: nibabel.nifti1.Nifti1Image, radius: float) -> str:
+
+    '''
+    Function to create a key of a mask and radius
+
+    Parameters
+    ----------
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask
+
+    radius: float
+        sphere radius in mm
+
+    Returns
+    -------
+    str of sha1 hash
+    '''
+
+    key = hashlib.sha1(np.asarray(mask_img.dataobj).astype(bool).tobytes())
+    key.update(np.asarray(mask_img.affine).tobytes())
+    key.update(str(radius).encode())
+    return key.hexdigest()[:12]
+
+
+def betas_key(paths: list) -> str:
+
+    '''
+    Function to create a key of a subject's beta maps
+    from their paths, sizes and modification times so
+    regenerated beta maps get a new key
+
+    Parameters
+    ----------
+    paths: list
+        list of paths to beta maps
+
+    Returns
+    -------
+    str of sha1 hash
+    '''
+
+    key = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        key.update(f'{path}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return key.hexdigest()[:12]
+
+
+def sphere_index(mask_img: nibabel.nifti1.Nifti1Image, radius: float, cache_dir: str) -> sparse.csr_matrix:
+
+    '''
+    Function to load, or compute and cache, the sphere of every
+    mask voxel as a sparse adjacency matrix. Row i holds the
+    mask voxels within radius mm of mask voxel i.
+
+    Parameters
+    ----------
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask
+
+    radius: float
+        sphere radius in mm
+
+    cache_dir: str
+        directory to cache the index in
+
+    Returns
+    -------
+    sparse.csr_matrix of (voxels x voxels) sphere membership
+    '''
+
+    cache = os.path.join(cache_dir, f'sphere_index_{mask_key(mask_img, radius)}.npz')
+    if os.path.exists(cache):
+        return sparse.load_npz(cache)
+    print(f'Building sphere index of radius {radius}mm')
+    voxels = np.column_stack(np.nonzero(np.asarray(mask_img.dataobj).astype(bool)))
+    coords = nibabel.affines.apply_affine(mask_img.affine, voxels)
+    adjacency = radius_neighbors_graph(coords, radius, mode='connectivity', include_self=True).tocsr()
+    adjacency.data = adjacency.data.astype(np.int8)
+    os.makedirs(cache_dir, exist_ok=True)
+    sparse.save_npz(cache, adjacency)
+    return adjacency
+
+
+def beta_paths(subject_dir: str) -> tuple:
+
+    '''
+    Function to get a subject's beta maps of each
+    condition, in trial order.
+
+    Parameters
+    ----------
+    subject_dir: str
+        directory of subject's beta maps
+
+    Returns
+    -------
+    tuple of list of paths and np.ndarray of labels
+    '''
+
+    paths, labels = [], []
+    for label, condition in enumerate(conditions):
+        condition_paths = glob.glob(os.path.join(subject_dir, f'{condition}_*.nii.gz'))
+        condition_paths = sorted(condition_paths, key=lambda path: int(re.findall(r'_(\d+)\.nii', path)[0]))
+        paths.extend(condition_paths)
+        labels.extend([label] * len(condition_paths))
+    return paths, np.array(labels)
+
+
+def subject_betas(subject_dir: str, mask_img: nibabel.nifti1.Nifti1Image, cache_dir: str) -> tuple:
+
+    '''
+    Function to load, or mask and cache, a subject's beta maps.
+    The cache is keyed by the mask and the beta maps and is
+    memory-mapped so workers share it.
+
+    Parameters
+    ----------
+    subject_dir: str
+        directory of subject's beta maps
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask
+
+    cache_dir: str
+        directory to cache the masked betas in
+
+    Returns
+    -------
+    tuple of np.ndarray (trials x voxels) betas and
+    np.ndarray of labels
+    '''
+
+    paths, labels = beta_paths(subject_dir)
+    cache = os.path.join(cache_dir, f'betas_{mask_key(mask_img, 0)}_{betas_key(paths)}.npy')
+    if not os.path.exists(cache):
+        os.makedirs(cache_dir, exist_ok=True)
+        for stale in glob.glob(os.path.join(cache_dir, f'betas_{mask_key(mask_img, 0)}*.npy')):
+            os.remove(stale)
+        betas = NiftiMasker(mask_img=mask_img).fit().transform(paths).astype(np.float32)
+        np.save(cache, np.nan_to_num(betas))
+    return np.load(cache, mmap_mode='r'), labels
+
+
+def score_spheres(betas: np.ndarray, labels: np.ndarray, spheres: sparse.csr_matrix, folds: list) -> np.ndarray:
+
+    '''
+    Function to cross-validate a linear SVM
+    in each sphere of a chunk.
+
+    Parameters
+    ----------
+    betas: np.ndarray
+        (trials x voxels) betas
+
+    labels: np.ndarray
+        condition of each trial
+
+    spheres: sparse.csr_matrix
+        rows of the sphere index for the chunk
+
+    folds: list
+        list of (train, test) indices
+
+    Returns
+    -------
+    np.ndarray of mean accuracy of each sphere
+    '''
+
+    scores = np.zeros(spheres.shape[0], dtype=np.float32)
+    for sphere in range(spheres.shape[0]):
+        X = np.asarray(betas[:, spheres.indices[spheres.indptr[sphere]:spheres.indptr[sphere + 1]]])
+        X = (X - X.mean(axis=0)) / np.where(X.std(axis=0) > 0, X.std(axis=0), 1)
+        scores[sphere] = np.mean([LinearSVC(dual=True).fit(X[train], labels[train]).score(X[test], labels[test])
+                                  for train, test in folds])
+    return scores
+
+
+def subject_searchlight(betas: np.ndarray, labels: np.ndarray, adjacency: sparse.csr_matrix, n_folds: int = 4,
+                        chunk_size: int = 2000, n_jobs: int = 8) -> np.ndarray:
+
+    '''
+    Function to run the searchlight of one subject
+    with chunks of spheres spread over workers.
+
+    Parameters
+    ----------
+    betas: np.ndarray
+        (trials x voxels) betas
+
+    labels: np.ndarray
+        condition of each trial
+
+    adjacency: sparse.csr_matrix
+        sphere index
+
+    n_folds: int
+        number of CV folds
+
+    chunk_size: int
+        number of spheres per task
+
+    n_jobs: int
+        number of workers
+
+    Returns
+    -------
+    np.ndarray of accuracy of each voxel
+    '''
+
+    folds = list(StratifiedKFold(n_splits=n_folds).split(np.zeros(len(labels)), labels))
+    chunks = range(0, adjacency.shape[0], chunk_size)
+    scores = Parallel(n_jobs=n_jobs)(delayed(score_spheres)(betas, labels, adjacency[start:start + chunk_size], folds)
+                                     for start in chunks)
+    return np.concatenate(scores)
+
+
+def run_subject(subject: str, time_point: str, mask_img: nibabel.nifti1.Nifti1Image, adjacency: sparse.csr_matrix,
+                key: str, n_folds: int = 4, chunk_size: int = 2000, n_jobs: int = 8) -> str:
+
+    '''
+    Function to run and save a subject's searchlight,
+    skipping subjects already done with the same mask,
+    radius and beta maps.
+
+    Parameters
+    ----------
+    subject: str
+        subject i.e sub-G1001
+
+    time_point: str
+        T1 or T2
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask
+
+    adjacency: sparse.csr_matrix
+        sphere index
+
+    key: str
+        key of mask and radius
+
+    n_folds: int
+        number of CV folds
+
+    chunk_size: int
+        number of spheres per task
+
+    n_jobs: int
+        number of workers
+
+    Returns
+    -------
+    str of path to accuracy map
+    '''
+
+    save_dir = os.path.join(searchlight_dir(time_point), subject)
+    subject_dir = os.path.join(config('eft'), 'spotlight', 'beta_regression', time_point, subject)
+    accuracy_path = os.path.join(save_dir, f'accuracy_{key}_{betas_key(beta_paths(subject_dir)[0])}.nii.gz')
+    if os.path.exists(accuracy_path):
+        print(f'{subject} already done')
+        return accuracy_path
+    betas, labels = subject_betas(subject_dir, mask_img, save_dir)
+    if min(np.bincount(labels, minlength=len(conditions))) < n_folds:
+        print(f'{subject} has too few trials of a condition, skipping')
+        return None
+    print(f'Working on {subject}, {len(labels)} trials')
+    scores = subject_searchlight(betas, labels, adjacency, n_folds, chunk_size, n_jobs)
+    unmask(scores, mask_img).to_filename(accuracy_path)
+    return accuracy_path
+
+
+if __name__ == '__main__':
+    flags = options()
+    mask_img = img.load_img(flags['mask'])
+    key = mask_key(mask_img, flags['radius'])
+    adjacency = sphere_index(mask_img, flags['radius'], os.path.join(config('eft'), 'spotlight', 'sphere_index'))
+    print(f'{adjacency.shape[0]} spheres of {adjacency.nnz / adjacency.shape[0]:.0f} voxels on average')
+
+    subjects = flags['subjects']
+    if subjects is None:
+        subjects = sorted(os.path.basename(subject) for subject in
+                          glob.glob(os.path.join(config('eft'), 'spotlight', 'beta_regression', flags['time_point'], 'sub-*')))
+    accuracy_paths = [run_subject(subject, flags['time_point'], mask_img, adjacency, key,
+                                  flags['folds'], flags['chunk_size'], flags['jobs']) for subject in subjects]
+    accuracy_paths = [path for path in accuracy_paths if path is not None]
+    if not accuracy_paths:
+        print('\nNo subjects finished, no mean accuracy to save')
+        sys.exit(1)
+
+    print(f'\nSaving mean accuracy of {len(accuracy_paths)} subjects')
+    save_dir = searchlight_dir(flags['time_point'])
+    img.mean_img(accuracy_paths).to_filename(os.path.join(save_dir, f'mean_accuracy_{key}.nii.gz'))
+    with open(os.path.join(save_dir, f'mean_accuracy_{key}.json'), 'w') as subjects_file:
+        json.dump({'subjects': [path.split(os.sep)[-2] for path in accuracy_paths], 'radius': flags['radius'],
+                   'mask': flags['mask']}, subjects_file)
@@ -0,0 +1,313 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import nibabel
+import joblib
+from joblib import Parallel, delayed
+from scipy import stats
+from sklearn.feature_selection import SelectPercentile, f_regression
+from nilearn.decoding.space_net_solvers import tvl1_solver
+from model_artifacts import checkpointed
+
+'''
+Functions for a warm-started regularization path search of
+TV-l1 (SpaceNet) models.
+
+Each fold goes through the l1_ratios from large to small and the alphas
+from large to small. Every fit starts from the neighbouring solution (the
+previous alpha, or the same point of the previous l1_ratio path) rather
+than from zero. An alpha path stops early once the validation score has
+not improved for a number of alphas. The solutions of each l1_ratio path
+are cached per fold, and each finished fold is checkpointed, so an
+interrupted search resumes where it stopped.
+'''
+
+class ValidationStopper:
+
+    '''
+    Callback for the TV-l1 solver to stop iterating
+    once the validation score stops improving.
+
+    Usage
+    ----
+    stopper = ValidationStopper(X_test, y_test)
+    tvl1_solver(..., callback=stopper)
+
+    '''
+
+    def __init__(self, X_test: np.ndarray, y_test: np.ndarray, tol: float = -1e-2) -> None:
+        self.X_test = X_test
+        self.y_test = y_test
+        self.tol = tol
+        self.scores = []
+
+    def __call__(self, variables) -> bool:
+        w = variables['w'] if isinstance(variables, dict) else variables
+        self.scores.append(validation_score(self.X_test, self.y_test, w)[0])
+        if len(self.scores) <= 20 or len(self.scores) % 10 != 2:
+            return False
+        return np.mean(np.diff(self.scores[-5:][::-1])) >= self.tol
+
+
+def validation_score(X_test: np.ndarray, y_test: np.ndarray, w: np.ndarray) -> tuple:
+
+    '''
+    Function to score a weight map on validation data with
+    the Pearson and Spearman correlations (as SpaceNet does)
+
+    Parameters
+    ----------
+    X_test: np.ndarray
+        (subjects x features) validation data
+
+    y_test: np.ndarray
+        validation targets
+
+    w: np.ndarray
+        weight map
+
+    Returns
+    -------
+    tuple of (pearson, spearman). -inf if the map is constant
+    '''
+
+    if np.ptp(w) == 0:
+        return (-np.inf, -np.inf)
+    y_pred = X_test @ w
+    return (np.corrcoef(y_pred, y_test)[1, 0], stats.spearmanr(y_pred, y_test)[0])
+
+
+def alpha_grid(X: np.ndarray, y: np.ndarray, l1_ratio: float, eps: float = 1e-3, n_alphas: int = 10) -> np.ndarray:
+
+    '''
+    Function to compute the alpha grid of a l1_ratio
+    from large to small alphas.
+
+    Parameters
+    ----------
+    X: np.ndarray
+        centered training data
+
+    y: np.ndarray
+        centered training targets
+
+    l1_ratio: float
+        mix of l1 and tv penalty
+
+    eps: float
+        alpha_min / alpha_max
+
+    n_alphas: int
+        number of alphas
+
+    Returns
+    -------
+    np.ndarray of alphas
+    '''
+
+    alpha_max = np.abs(X.T @ y).max() / max(l1_ratio, 1e-3)
+    return np.logspace(np.log10(alpha_max * eps), np.log10(alpha_max), num=n_alphas)[::-1]
+
+
+def crop_mask(mask: np.ndarray) -> np.ndarray:
+
+    '''
+    Function to crop a mask to its bounding box
+
+    Parameters
+    ----------
+    mask: np.ndarray
+        3D bool mask
+
+    Returns
+    -------
+    np.ndarray of cropped mask
+    '''
+
+    bounds = [np.flatnonzero(mask.any(axis=axes)) for axes in [(1, 2), (0, 2), (0, 1)]]
+    return mask[bounds[0][0]:bounds[0][-1] + 1, bounds[1][0]:bounds[1][-1] + 1, bounds[2][0]:bounds[2][-1] + 1]
+
+
+def fit_fold_path(X: np.ndarray, y: np.ndarray, mask: np.ndarray, train: np.ndarray, test: np.ndarray,
+                  l1_ratios: list, fold_dir: str, n_alphas: int = 10, eps: float = 1e-3,
+                  patience: int = 2, screening_percentile: int = 20, max_iter: int = 200,
+                  tol: float = 1e-4) -> dict:
+
+    '''
+    Function to run the warm-started path search of one fold.
+
+    Parameters
+    ----------
+    X: np.ndarray
+        (subjects x voxels) features
+
+    y: np.ndarray
+        targets
+
+    mask: np.ndarray
+        3D bool mask of features
+
+    train: np.ndarray
+        indices of training subjects
+
+    test: np.ndarray
+        indices of validation subjects
+
+    l1_ratios: list
+        l1_ratios to search
+
+    fold_dir: str
+        directory to cache the fold's path solutions in
+
+    n_alphas: int
+        number of alphas per l1_ratio
+
+    eps: float
+        alpha_min / alpha_max
+
+    patience: int
+        number of alphas without improvement before
+        the path stops
+
+    screening_percentile: int
+        percent of voxels kept by univariate screening
+
+    max_iter: int
+        max iterations of the solver
+
+    tol: float
+        tolerance of the final refit. The path uses 2 * tol
+
+    Returns
+    -------
+    dict: dictionary object
+        dict of coef (voxels), intercept, best_l1_ratio,
+        best_alpha, best_score, n_fits and seconds
+    '''
+
+    start = time.perf_counter()
+    os.makedirs(fold_dir, exist_ok=True)
+    X_train, y_train = np.asarray(X[train], dtype=float), np.asarray(y[train], dtype=float)
+    support = np.ones(X.shape[1], dtype=bool)
+    if X.shape[1] > 100 and screening_percentile < 100:
+        support = SelectPercentile(f_regression, percentile=screening_percentile).fit(X_train, y_train).get_support()
+    screened_mask = mask.copy()
+    screened_mask[mask] = support
+    screened_mask = crop_mask(screened_mask)
+
+    x_mean, y_mean = X_train[:, support].mean(axis=0), y_train.mean()
+    X_train = X_train[:, support] - x_mean
+    y_train = y_train - y_mean
+    X_test, y_test = np.asarray(X[test], dtype=float)[:, support] - x_mean, np.asarray(y[test], dtype=float) - y_mean
+
+    best = {'score': (-np.inf, -np.inf), 'l1_ratio': None, 'alpha': None, 'init': None}
+    previous_path = []
+    n_fits = 0
+    for l1_ratio in sorted(l1_ratios)[::-1]:
+        checkpoint = os.path.join(fold_dir, f'l1_ratio_{l1_ratio}.pkl')
+        if os.path.exists(checkpoint):
+            path = joblib.load(checkpoint)
+        else:
+            path = {'alphas': [], 'scores': [], 'inits': []}
+            init = None
+            for alpha_number, alpha in enumerate(alpha_grid(X_train, y_train, l1_ratio, eps, n_alphas)):
+                if init is None and alpha_number < len(previous_path):
+                    init = previous_path[alpha_number]
+                _, _, init = tvl1_solver(X_train, y_train, alpha, l1_ratio, mask=screened_mask, loss='mse',
+                                         init=init, callback=ValidationStopper(X_test, y_test),
+                                         max_iter=max_iter, tol=2 * tol)
+                n_fits += 1
+                path['alphas'].append(alpha)
+                path['scores'].append(validation_score(X_test, y_test, init['w'][:X_train.shape[1]]))
+                path['inits'].append(init)
+                best_on_path = max(range(len(path['scores'])), key=lambda number: path['scores'][number])
+                if len(path['scores']) - 1 - best_on_path >= patience:
+                    break
+            joblib.dump(path, f'{checkpoint}.tmp')
+            os.replace(f'{checkpoint}.tmp', checkpoint)
+
+        for alpha, score, init in zip(path['alphas'], path['scores'], path['inits']):
+            if np.isfinite(score[0]) and score > best['score']:
+                best = {'score': score, 'l1_ratio': l1_ratio, 'alpha': alpha, 'init': init}
+        previous_path = path['inits']
+
+    if best['alpha'] is None:
+        best.update({'l1_ratio': sorted(l1_ratios)[-1], 'alpha': alpha_grid(X_train, y_train, sorted(l1_ratios)[-1], eps, n_alphas)[0]})
+    w, _, _ = tvl1_solver(X_train, y_train, best['alpha'], best['l1_ratio'], mask=screened_mask, loss='mse',
+                          init=best['init'], max_iter=max_iter, tol=tol)
+    coef = np.zeros(X.shape[1], dtype=np.float32)
+    coef[support] = w[:X_train.shape[1]]
+
+    return {
+        'coef': coef,
+        'intercept': float(y_mean - x_mean @ w[:X_train.shape[1]]),
+        'best_l1_ratio': best['l1_ratio'],
+        'best_alpha': best['alpha'],
+        'best_score': best['score'][0],
+        'n_fits': n_fits,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def path_search(X: np.ndarray, y: np.ndarray, mask_img: nibabel.nifti1.Nifti1Image, folds: list,
+                l1_ratios: list, cache_dir: str, n_jobs: int = 8, **path_params) -> dict:
+
+    '''
+    Function to run the warm-started path search over all folds
+    in parallel. As with SpaceNet the final model is the average
+    of the best model of each fold.
+
+    Parameters
+    ----------
+    X: np.ndarray
+        (subjects x voxels) features
+
+    y: np.ndarray
+        targets
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        mask of features
+
+    folds: list
+        list of (train, test) indices
+
+    l1_ratios: list
+        l1_ratios to search
+
+    cache_dir: str
+        directory to cache fold solutions in
+
+    n_jobs: int
+        number of folds to run in parallel
+
+    path_params: dict
+        extra parameters for fit_fold_path
+
+    Returns
+    -------
+    dict: dictionary object
+        dict of coef, intercept, best_params, cv_scores
+        and timing (pd.DataFrame per fold)
+    '''
+
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    fold_fits = Parallel(n_jobs=n_jobs)(
+        delayed(checkpointed)(os.path.join(cache_dir, f'fold_{fold}.pkl'), fit_fold_path, X, y, mask, train, test,
+                              l1_ratios, os.path.join(cache_dir, f'fold_{fold}'), **path_params)
+        for fold, (train, test) in enumerate(folds))
+
+    timing = pd.DataFrame(data={
+        'fold': range(len(fold_fits)),
+        'seconds': [fold['seconds'] for fold in fold_fits],
+        'n_fits': [fold['n_fits'] for fold in fold_fits],
+        'best_l1_ratio': [fold['best_l1_ratio'] for fold in fold_fits],
+        'best_alpha': [fold['best_alpha'] for fold in fold_fits],
+    })
+    return {
+        'coef': np.mean([fold['coef'] for fold in fold_fits], axis=0).astype(np.float32),
+        'intercept': float(np.mean([fold['intercept'] for fold in fold_fits])),
+        'best_params': [{'l1_ratio': fold['best_l1_ratio'], 'alpha': fold['best_alpha']} for fold in fold_fits],
+        'cv_scores': np.array([fold['best_score'] for fold in fold_fits]),
+        'timing': timing,
+    }
@@ -0,0 +1,289 @@
+from decouple import config
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel
+from nilearn import image as img
+from nilearn import datasets
+
+'''
+Script to build a precomputed atlas label index.
+
+Each atlas is resampled once to the analysis grid
+(MNI152NLin2009cAsym res-2) and cached as an int16 memory-mapped
+label volume with a label table so that peak and cluster annotation
+become array lookups rather than resampling the atlas per contrast.
+'''
+
+atlases = {
+    'harvard_oxford_cortical': 'cort-maxprob-thr25-2mm',
+    'harvard_oxford_subcortical': 'sub-maxprob-thr25-2mm',
+    'aal': 'SPM12',
+}
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of atlas names, reference image
+        and save directory
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-a', '--atlas',
+                      dest='atlas',
+                      nargs='+',
+                      default=list(atlases.keys()),
+                      help=f'Atlases to index. Any of {", ".join(atlases.keys())}')
+    args.add_argument('-r', '--reference',
+                      dest='reference',
+                      default=os.path.join(config('eft'), '2ndlevel', 'mixed_model', 'mask_img.nii.gz'),
+                      help='Image on the analysis grid to resample atlases to')
+    args.add_argument('-s', '--save',
+                      dest='save',
+                      default=os.path.join(config('eft'), '2ndlevel', 'atlas_index'),
+                      help='Directory to save the atlas index to')
+    return vars(args.parse_args())
+
+
+def fetch_atlas(atlas_name: str) -> dict:
+
+    '''
+    Function to fetch an atlas from nilearn
+    and return the map with a label table.
+
+    Parameters
+    ----------
+    atlas_name: str
+        name of atlas. Must be a key of atlases
+
+    Returns
+    -------
+    dict: dictionary object
+        dictionary of atlas image and
+        label table of label value and region name
+    '''
+
+    if atlas_name == 'aal':
+        atlas = datasets.fetch_atlas_aal(version=atlases[atlas_name])
+        # Recent nilearn lists the background in indices and labels, older versions in neither
+        label_values = [int(index) for index in atlas.indices]
+        region_names = list(atlas.labels)
+        if region_names[0] != 'Background':
+            label_values, region_names = [0] + label_values, ['Background'] + region_names
+    else:
+        atlas = datasets.fetch_atlas_harvard_oxford(atlases[atlas_name])
+        region_names = list(atlas.labels)
+        label_values = list(range(0, len(region_names)))
+    assert len(label_values) == len(region_names), \
+        f'{atlas_name} has {len(label_values)} label values but {len(region_names)} region names'
+
+    return {
+        'maps': img.load_img(atlas.maps),
+        'labels': pd.DataFrame(data={'label': label_values, 'region': region_names})
+    }
+
+
+def index_paths(save_dir: str, atlas_name: str) -> dict:
+
+    '''
+    Function to return the paths of the
+    files making up an atlas index.
+
+    Parameters
+    ----------
+    save_dir: str
+        directory of the atlas index
+
+    atlas_name: str
+        name of atlas
+
+    Returns
+    -------
+    dict of file paths
+    '''
+
+    return {
+        'volume': os.path.join(save_dir, f'{atlas_name}_labels.npy'),
+        'affine': os.path.join(save_dir, f'{atlas_name}_affine.npy'),
+        'table': os.path.join(save_dir, f'{atlas_name}_labels.csv'),
+    }
+
+
+def build_atlas_index(atlas_img: nibabel.nifti1.Nifti1Image,
+                      label_table: pd.DataFrame,
+                      reference_img: str,
+                      save_dir: str,
+                      atlas_name: str) -> None:
+
+    '''
+    Function to resample an atlas to the analysis grid
+    and save it as an int16 label volume and label table.
+
+    Parameters
+    ----------
+    atlas_img: nibabel.nifti1.Nifti1Image
+        label image of atlas
+
+    label_table: pd.DataFrame
+        DataFrame of label value and region name
+
+    reference_img: str
+        path to image on the analysis grid
+
+    save_dir: str
+        directory to save index to
+
+    atlas_name: str
+        name of atlas
+
+    Returns
+    -------
+    None
+    '''
+
+    reference = img.load_img(reference_img)
+    resampled = img.resample_to_img(atlas_img, reference, interpolation='nearest')
+    data = np.rint(np.asarray(resampled.dataobj)).astype(np.int32)
+    if data.max() > np.iinfo(np.int16).max:
+        raise ValueError(f'{atlas_name} has label values too large for an int16 index')
+
+    files = index_paths(save_dir, atlas_name)
+    volume = np.lib.format.open_memmap(files['volume'], mode='w+', dtype=np.int16, shape=data.shape)
+    volume[:] = data
+    volume.flush()
+    np.save(files['affine'], reference.affine)
+
+    voxel_counts = np.bincount(data.ravel(), minlength=label_table['label'].max() + 1)
+    label_table = label_table.copy()
+    label_table['n_voxels'] = voxel_counts[label_table['label'].values]
+    label_table.to_csv(files['table'], index=False)
+
+
+def load_atlas_index(save_dir: str, atlas_name: str) -> dict:
+
+    '''
+    Function to load an atlas index. The label
+    volume is memory-mapped rather than read in.
+
+    Parameters
+    ----------
+    save_dir: str
+        directory of the atlas index
+
+    atlas_name: str
+        name of atlas
+
+    Returns
+    -------
+    dict: dictionary object
+        dictionary of memory-mapped label volume, affine,
+        inverse affine and label table indexed by label value
+    '''
+
+    files = index_paths(save_dir, atlas_name)
+    affine = np.load(files['affine'])
+    table = pd.read_csv(files['table']).set_index('label')
+
+    return {
+        'name': atlas_name,
+        'volume': np.load(files['volume'], mmap_mode='r'),
+        'affine': affine,
+        'inverse_affine': np.linalg.inv(affine),
+        'region_names': table['region'].reindex(range(0, table.index.max() + 1)).fillna('').values,
+        'table': table,
+    }
+
+
+def coords_to_regions(atlas_index: dict, coords: np.ndarray) -> pd.DataFrame:
+
+    '''
+    Function to look up the atlas region at
+    a set of MNI coordinates (i.e peaks).
+
+    Parameters
+    ----------
+    atlas_index: dict
+        atlas index from load_atlas_index
+
+    coords: np.ndarray
+        (n x 3) array of mm coordinates
+
+    Returns
+    -------
+    pd.DataFrame: DataFrame
+        DataFrame of coordinates with label and region.
+        Coordinates outside of the volume are given label 0.
+    '''
+
+    coords = np.atleast_2d(np.asarray(coords, dtype=float))
+    voxels = np.rint(coords @ atlas_index['inverse_affine'][:3, :3].T + atlas_index['inverse_affine'][:3, 3]).astype(int)
+    in_volume = np.all((voxels >= 0) & (voxels < np.array(atlas_index['volume'].shape)), axis=1)
+    labels = np.zeros(coords.shape[0], dtype=int)
+    labels[in_volume] = atlas_index['volume'][tuple(voxels[in_volume].T)]
+
+    return pd.DataFrame(data={
+        'x': coords[:, 0],
+        'y': coords[:, 1],
+        'z': coords[:, 2],
+        'label': labels,
+        'region': atlas_index['region_names'][labels]
+    })
+
+
+def cluster_overlap(atlas_index: dict, cluster_img: nibabel.nifti1.Nifti1Image) -> pd.DataFrame:
+
+    '''
+    Function to get the overlap of a cluster
+    (or any binary image) with the atlas regions.
+
+    Parameters
+    ----------
+    atlas_index: dict
+        atlas index from load_atlas_index
+
+    cluster_img: nibabel.nifti1.Nifti1Image
+        image of cluster. Any non zero voxel is
+        counted as part of the cluster
+
+    Returns
+    -------
+    pd.DataFrame: DataFrame
+        DataFrame of regions overlapping the cluster with
+        number of voxels and percent of cluster in each region
+    '''
+
+    cluster_img = img.load_img(cluster_img)
+    if cluster_img.shape[:3] != atlas_index['volume'].shape or not np.allclose(cluster_img.affine, atlas_index['affine']):
+        cluster_img = img.resample_img(cluster_img, target_affine=atlas_index['affine'],
+                                       target_shape=atlas_index['volume'].shape,
+                                       interpolation='nearest')
+    cluster = np.nan_to_num(np.asarray(cluster_img.dataobj)) != 0
+    counts = np.bincount(atlas_index['volume'][cluster], minlength=len(atlas_index['region_names']))
+    labels = np.flatnonzero(counts)
+
+    return pd.DataFrame(data={
+        'label': labels,
+        'region': atlas_index['region_names'][labels],
+        'n_voxels': counts[labels],
+        'percent_of_cluster': 100 * counts[labels] / max(cluster.sum(), 1)
+    }).sort_values(by='n_voxels', ascending=False).reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    flags = options()
+    os.makedirs(flags['save'], exist_ok=True)
+    for atlas_name in flags['atlas']:
+        print(f'Building atlas index for {atlas_name}')
+        atlas = fetch_atlas(atlas_name)
+        build_atlas_index(atlas['maps'], atlas['labels'], flags['reference'], flags['save'], atlas_name)
+    print(f'Atlas index saved to {flags["save"]}')
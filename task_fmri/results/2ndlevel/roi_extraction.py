@@ -0,0 +1,443 @@
+from decouple import config
+import os
+import sys
+import json
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel
+from scipy import sparse, ndimage
+from joblib import Parallel, delayed
+from nilearn import image as img
+from atlas_index import load_atlas_index
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'modelling'))
+from first_level_index import FirstLevelIndex, index_columns
+
+'''
+Script to extract ROI values from the 1st level outputs of all
+subjects, tasks and time points.
+
+ROIs from atlas labels, significant clusters and spheres are built into
+one sparse (ROIs x voxels) weight matrix on the reference grid, each row
+weighting its voxels by 1 / n voxels. Every image is read once and all
+ROI means come from a single matrix product per chunk of images. Values
+are cached per image (keyed by path, size and mtime) so reruns only read
+new or changed images. The output is a tidy table with the T1 and T2
+IDs so it merges with the neuroimaging behavioural measures.
+'''
+
+tasks = ['happy', 'fear', 'eft']
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of flags
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-t', '--task',
+                      dest='task',
+                      nargs='+',
+                      default=tasks,
+                      help='Tasks to extract from')
+    args.add_argument('-a', '--atlas',
+                      dest='atlas',
+                      nargs='*',
+                      default=['harvard_oxford_cortical'],
+                      help='Atlases from the atlas index to use as ROIs')
+    args.add_argument('-c', '--clusters',
+                      dest='clusters',
+                      nargs='*',
+                      default=[],
+                      help='Stat images (i.e -log10 p) to take significant clusters from')
+    args.add_argument('--threshold',
+                      dest='threshold',
+                      type=float,
+                      default=-np.log10(0.05),
+                      help='Threshold of cluster images')
+    args.add_argument('--min_cluster_size',
+                      dest='min_cluster_size',
+                      type=int,
+                      default=10,
+                      help='Minimum voxels in a cluster')
+    args.add_argument('-s', '--spheres',
+                      dest='spheres',
+                      nargs='*',
+                      default=[],
+                      help='Spheres as name:x,y,z in MNI mm')
+    args.add_argument('-r', '--radius',
+                      dest='radius',
+                      type=float,
+                      default=6,
+                      help='Sphere radius in mm')
+    args.add_argument('--betas',
+                      dest='betas',
+                      action='store_true',
+                      help='Extract every beta image as well as the default contrasts')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=8,
+                      help='Number of jobs to read images with')
+    return vars(args.parse_args())
+
+
+def reference_grid() -> nibabel.nifti1.Nifti1Image:
+
+    '''
+    Function to load the reference mask that ROIs
+    are defined on (as the atlas index is).
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    nibabel.nifti1.Nifti1Image of mask
+    '''
+
+    return img.load_img(os.path.join(config('eft'), '2ndlevel', 'mixed_model', 'mask_img.nii.gz'))
+
+
+def atlas_rois(atlas: str, mask: np.ndarray) -> tuple:
+
+    '''
+    Function to get the ROIs of an atlas from the atlas index
+
+    Parameters
+    ----------
+    atlas: str
+        name of atlas
+
+    mask: np.ndarray
+        3D bool reference mask
+
+    Returns
+    -------
+    tuple of list of voxel arrays (indices into the mask)
+    and pd.DataFrame of roi and source
+    '''
+
+    atlas_index = load_atlas_index(os.path.join(config('eft'), '2ndlevel', 'atlas_index'), atlas)
+    voxel_labels = np.asarray(atlas_index['volume'])[mask]
+    order = np.argsort(voxel_labels, kind='stable')
+    labels, starts = np.unique(voxel_labels[order], return_index=True)
+    groups = np.split(order, starts[1:])
+    keep = labels > 0
+    return ([group for group, kept in zip(groups, keep) if kept],
+            pd.DataFrame(data={'roi': atlas_index['region_names'][labels[keep]], 'source': atlas}))
+
+
+def cluster_rois(cluster_img: str, mask_img: nibabel.nifti1.Nifti1Image, threshold: float, min_size: int) -> tuple:
+
+    '''
+    Function to get the significant clusters of a stat
+    image as ROIs (face connected voxels above threshold)
+
+    Parameters
+    ----------
+    cluster_img: str
+        path to stat image
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        reference mask
+
+    threshold: float
+        threshold of stat image
+
+    min_size: int
+        minimum voxels in a cluster
+
+    Returns
+    -------
+    tuple of list of voxel arrays (indices into the mask)
+    and pd.DataFrame of roi and source
+    '''
+
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    stat = img.resample_to_img(cluster_img, mask_img, interpolation='nearest').get_fdata()
+    clusters, n_clusters = ndimage.label((np.abs(stat) > threshold) & mask)
+    voxel_clusters = clusters[mask]
+    sizes = np.bincount(voxel_clusters, minlength=n_clusters + 1)
+    kept = [cluster for cluster in range(1, n_clusters + 1) if sizes[cluster] >= min_size]
+    kept = sorted(kept, key=lambda cluster: -sizes[cluster])
+    name = os.path.basename(cluster_img).split('.')[0]
+    voxels = [np.flatnonzero(voxel_clusters == cluster) for cluster in kept]
+    peaks = [nibabel.affines.apply_affine(mask_img.affine, np.column_stack(np.nonzero(mask))[roi][np.argmax(np.abs(stat[mask][roi]))])
+             for roi in voxels]
+    return voxels, pd.DataFrame(data={'roi': [f'{name}_cluster_{number + 1}_{"_".join(str(int(coord)) for coord in peak)}'
+                                              for number, peak in enumerate(peaks)],
+                                      'source': name})
+
+
+def sphere_rois(spheres: list, mask_img: nibabel.nifti1.Nifti1Image, radius: float) -> tuple:
+
+    '''
+    Function to get spheres as ROIs
+
+    Parameters
+    ----------
+    spheres: list
+        list of name:x,y,z strings
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        reference mask
+
+    radius: float
+        sphere radius in mm
+
+    Returns
+    -------
+    tuple of list of voxel arrays (indices into the mask)
+    and pd.DataFrame of roi and source
+    '''
+
+    coords = nibabel.affines.apply_affine(mask_img.affine, np.column_stack(np.nonzero(np.asarray(mask_img.dataobj).astype(bool))))
+    names, voxels = [], []
+    for sphere in spheres:
+        name, centre = sphere.split(':')
+        centre = np.array([float(coord) for coord in centre.split(',')])
+        names.append(name)
+        voxels.append(np.flatnonzero(((coords - centre) ** 2).sum(axis=1) <= radius ** 2))
+    return voxels, pd.DataFrame(data={'roi': names, 'source': 'sphere'})
+
+
+def weight_matrix(roi_voxels: list, n_voxels: int) -> sparse.csr_matrix:
+
+    '''
+    Function to build the sparse ROI weight matrix.
+    Each row weights its voxels by 1 / n voxels so
+    the matrix product of an image is the ROI means.
+
+    Parameters
+    ----------
+    roi_voxels: list
+        list of voxel arrays (indices into the mask)
+
+    n_voxels: int
+        number of voxels in the mask
+
+    Returns
+    -------
+    sparse.csr_matrix of (ROIs x voxels) weights
+    '''
+
+    rows = np.concatenate([np.full(len(voxels), roi) for roi, voxels in enumerate(roi_voxels)])
+    weights = np.concatenate([np.full(len(voxels), 1 / max(len(voxels), 1)) for voxels in roi_voxels])
+    return sparse.csr_matrix((weights, (rows, np.concatenate(roi_voxels))), shape=(len(roi_voxels), n_voxels))
+
+
+def build_rois(flags: dict, mask_img: nibabel.nifti1.Nifti1Image, save_dir: str) -> tuple:
+
+    '''
+    Function to load, or build and cache, the weight
+    matrix of all the ROI definitions.
+
+    Parameters
+    ----------
+    flags: dict
+        dict of atlas, clusters, threshold, min_cluster_size,
+        spheres and radius
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        reference mask
+
+    save_dir: str
+        directory to cache ROIs in
+
+    Returns
+    -------
+    tuple of sparse.csr_matrix weights, pd.DataFrame
+    of ROIs and str of ROI key
+    '''
+
+    definition = {key: flags[key] for key in ['atlas', 'clusters', 'threshold', 'min_cluster_size', 'spheres', 'radius']}
+    definition['clusters'] = [(path, os.stat(path).st_mtime_ns) for path in definition['clusters']]
+    key = hashlib.sha1(json.dumps(definition, sort_keys=True).encode()).hexdigest()[:12]
+    roi_dir = os.path.join(save_dir, f'rois_{key}')
+    if os.path.exists(os.path.join(roi_dir, 'rois.csv')):
+        return sparse.load_npz(os.path.join(roi_dir, 'weights.npz')), pd.read_csv(os.path.join(roi_dir, 'rois.csv')), key
+
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    rois = [atlas_rois(atlas, mask) for atlas in flags['atlas']]
+    rois += [cluster_rois(cluster_img, mask_img, flags['threshold'], flags['min_cluster_size']) for cluster_img in flags['clusters']]
+    if flags['spheres']:
+        rois.append(sphere_rois(flags['spheres'], mask_img, flags['radius']))
+    roi_voxels = [voxels for source_voxels, _ in rois for voxels in source_voxels]
+    rois_df = pd.concat([source_df for _, source_df in rois]).reset_index(drop=True)
+    rois_df['n_voxels'] = [len(voxels) for voxels in roi_voxels]
+    weights = weight_matrix(roi_voxels, int(mask.sum()))
+
+    os.makedirs(roi_dir, exist_ok=True)
+    sparse.save_npz(os.path.join(roi_dir, 'weights.npz'), weights)
+    rois_df.to_csv(os.path.join(roi_dir, 'rois.csv'), index=False)
+    with open(os.path.join(roi_dir, 'definition.json'), 'w') as definition_file:
+        json.dump(definition, definition_file)
+    return weights, rois_df, key
+
+
+def extract_chunk(paths: list, mask_img: nibabel.nifti1.Nifti1Image, weights: sparse.csr_matrix) -> np.ndarray:
+
+    '''
+    Function to extract the ROI means of a chunk of images.
+    Images not on the reference grid are resampled to it.
+
+    Parameters
+    ----------
+    paths: list
+        list of paths to images
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        reference mask
+
+    weights: sparse.csr_matrix
+        (ROIs x voxels) weights
+
+    Returns
+    -------
+    np.ndarray of (images x ROIs) means
+    '''
+
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    data = np.zeros((len(paths), int(mask.sum())), dtype=np.float32)
+    for row, path in enumerate(paths):
+        image = img.load_img(path)
+        if image.shape[:3] != mask.shape or not np.allclose(image.affine, mask_img.affine):
+            image = img.resample_to_img(image, mask_img)
+        data[row] = np.asarray(image.dataobj)[mask]
+    return np.asarray(weights @ np.nan_to_num(data).T).T
+
+
+def extract_values(images_df: pd.DataFrame, mask_img: nibabel.nifti1.Nifti1Image, weights: sparse.csr_matrix,
+                   cache_path: str, n_jobs: int = 8) -> np.ndarray:
+
+    '''
+    Function to extract the ROI means of every image, reusing
+    the cached values of images that haven't changed.
+
+    Parameters
+    ----------
+    images_df: pd.DataFrame
+        DataFrame with path, size and mtime_ns columns
+
+    mask_img: nibabel.nifti1.Nifti1Image
+        reference mask
+
+    weights: sparse.csr_matrix
+        (ROIs x voxels) weights
+
+    cache_path: str
+        path to cache of values
+
+    n_jobs: int
+        number of jobs to read images with
+
+    Returns
+    -------
+    np.ndarray of (images x ROIs) means
+    '''
+
+    keys = images_df[['path', 'size', 'mtime_ns']].reset_index(drop=True)
+    cached = pd.read_parquet(cache_path) if os.path.exists(cache_path) else pd.DataFrame(columns=['path', 'size', 'mtime_ns'])
+    merged = keys.merge(cached, on=['path', 'size', 'mtime_ns'], how='left')
+    values = merged.drop(columns=['path', 'size', 'mtime_ns']).reindex(columns=[str(roi) for roi in range(weights.shape[0])])
+    values = values.values.astype(float)
+    missing = np.flatnonzero(np.isnan(values).all(axis=1))
+    print(f'{len(keys) - len(missing)} images cached, reading {len(missing)}')
+    if len(missing):
+        chunks = np.array_split(missing, min(n_jobs * 4, len(missing)))
+        extracted = Parallel(n_jobs=n_jobs)(delayed(extract_chunk)(list(keys['path'].values[chunk]), mask_img, weights)
+                                            for chunk in chunks)
+        for chunk, chunk_values in zip(chunks, extracted):
+            values[chunk] = chunk_values
+        cache = pd.concat([keys, pd.DataFrame(values, columns=[str(roi) for roi in range(weights.shape[0])])], axis=1)
+        cache.to_parquet(cache_path, index=False)
+    return values
+
+
+def tidy_table(images_df: pd.DataFrame, values: np.ndarray, rois_df: pd.DataFrame) -> pd.DataFrame:
+
+    '''
+    Function to build the tidy table of ROI values with percent
+    signal change (relative to the session constant beta of the
+    same subject, task and time point) and T1/T2 IDs.
+
+    Parameters
+    ----------
+    images_df: pd.DataFrame
+        DataFrame of 1st level index rows
+        with a constant column
+
+    values: np.ndarray
+        (images x ROIs) means
+
+    rois_df: pd.DataFrame
+        DataFrame of ROIs
+
+    Returns
+    -------
+    pd.DataFrame of participant, t1, t2, subject, group, task,
+    timepoint, contrast, roi, source, mean and psc
+    '''
+
+    images_df = images_df.reset_index(drop=True)
+    constant_rows = images_df[images_df['constant']].reset_index().set_index(['subject', 'task', 'timepoint'])['index']
+    constant = constant_rows.reindex(pd.MultiIndex.from_frame(images_df[['subject', 'task', 'timepoint']])).values
+    baseline = np.full(values.shape, np.nan)
+    has_constant = ~np.isnan(constant)
+    baseline[has_constant] = values[constant[has_constant].astype(int)]
+    psc = 100 * values / np.where(np.abs(baseline) > 0, baseline, np.nan)
+
+    ids = images_df.pivot_table(index='participant', columns='timepoint', values='subject', aggfunc='first')
+    ids = ids.reindex(columns=['T1', 'T2']).apply(lambda column: column.str.replace('sub-', ''))
+    table = pd.DataFrame(data={
+        'participant': np.repeat(images_df['participant'].values, len(rois_df)),
+        'subject': np.repeat(images_df['subject'].values, len(rois_df)),
+        'group': np.repeat(images_df['group'].values, len(rois_df)),
+        'task': np.repeat(images_df['task'].values, len(rois_df)),
+        'timepoint': np.repeat(images_df['timepoint'].values, len(rois_df)),
+        'contrast': np.repeat(images_df['contrast'].values, len(rois_df)),
+        'roi': np.tile(rois_df['roi'].values, len(images_df)),
+        'source': np.tile(rois_df['source'].values, len(images_df)),
+        'mean': values.ravel(),
+        'psc': psc.ravel(),
+    })
+    table.insert(1, 't1', table['participant'].map(ids['T1']))
+    table.insert(2, 't2', table['participant'].map(ids['T2']))
+    return table
+
+
+if __name__ == '__main__':
+    flags = options()
+    save_dir = os.path.join(config('eft'), '2ndlevel', 'roi_extraction')
+    mask_img = reference_grid()
+    print('Building ROIs')
+    weights, rois_df, key = build_rois(flags, mask_img, save_dir)
+    print(f'{weights.shape[0]} ROIs from {", ".join(rois_df["source"].unique())}')
+
+    index = FirstLevelIndex(flags['task'])
+    index_df = index.frame.copy()
+    betas = index_df['contrast'].str.startswith('beta_')
+    index_df['constant'] = False
+    index_df.loc[betas, 'constant'] = (index_df[betas].groupby(['subject', 'task', 'timepoint'])['contrast']
+                                       .transform('max') == index_df.loc[betas, 'contrast'])
+    images_df = index_df[index_df['default'] | index_df['constant'] | (betas & flags['betas'])].reset_index(drop=True)
+    images_df['path'] = [index.path(*key) for key in images_df[index_columns].itertuples(index=False, name=None)]
+
+    print(f'Extracting {len(images_df)} images')
+    values = extract_values(images_df, mask_img, weights, os.path.join(save_dir, f'rois_{key}', 'values.parquet'), flags['jobs'])
+    table = tidy_table(images_df, values, rois_df)
+    table = table[np.repeat((images_df['default'] | flags['betas']).values, len(rois_df))]
+    table.to_csv(os.path.join(save_dir, f'roi_values_{key}.csv'), index=False)
+    print(f'Saved ROI values to {os.path.join(save_dir, f"roi_values_{key}.csv")}')
@@ -1,24 +1,256 @@
 import pandas as pd
 from decouple import config
 import os
-import nilearn.image as img
-import re
+import gzip
+import time
+import argparse
+import numpy as np
+import nibabel
+import sys
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'task_fmri', 'modelling'))
+from first_level_index import FirstLevelIndex
 
+'''
+Script to reduce each participant's T1 and T2 1st level contrast maps
+to one image, the mean, the difference (T2 - T1) or the percent change
+from T1.
 
+Participants are reduced in parallel by a process pool. Inputs must share
+a shape and affine, outputs can be gzipped at any compression level or
+left uncompressed for intermediate files, and each output is reloaded and
+checked against its inputs before it replaces any previous output. A run
+report lists every participant with the reason of any failure.
+'''
 
-path = config('fear')
-save_dir = os.path.join(config('bayesian'), 'scans')
-files = pd.read_csv(f"{path}/1stlevel_location.csv")
-files = files.drop(files[files['t1'] == 75].index)
-for subject in range(0, files.shape[0]):
+operations = ['mean', 'diff', 'pct_change']
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of flags
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-t', '--task',
+                      dest='task',
+                      default='fear',
+                      help='Task name. Either happy, eft or fear')
+    args.add_argument('-o', '--operation',
+                      dest='operation',
+                      default='mean',
+                      choices=operations,
+                      help='Reduction of T1 and T2 images')
+    args.add_argument('-s', '--save_dir',
+                      dest='save_dir',
+                      default=None,
+                      help='Directory to save images to. Default bayesian/scans')
+    args.add_argument('-c', '--compression',
+                      dest='compression',
+                      type=int,
+                      default=6,
+                      help='gzip compression level 1-9, 0 for uncompressed .nii')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=8,
+                      help='Number of workers')
+    return vars(args.parse_args())
+
+
+def paired_scans(task: str) -> pd.DataFrame:
+
+    '''
+    Function to get every participant with a default
+    contrast map. Participants missing a time point
+    are kept with a path of NaN so they are reported.
+
+    Parameters
+    ----------
+    task: str
+        task name
+
+    Returns
+    -------
+    pd.DataFrame of t1 and t2 paths indexed by participant
+    '''
+
+    return FirstLevelIndex([task]).subject_scans(task, complete=False).set_index('participant')[['t1', 't2']]
+
+
+def reduce_images(t1_data: np.ndarray, t2_data: np.ndarray, operation: str) -> np.ndarray:
+
+    '''
+    Function to reduce T1 and T2 data. Percent change
+    is 0 where T1 is 0.
+
+    Parameters
+    ----------
+    t1_data: np.ndarray
+        T1 image data
+
+    t2_data: np.ndarray
+        T2 image data
+
+    operation: str
+        mean, diff or pct_change
+
+    Returns
+    -------
+    np.ndarray of reduced data
+    '''
+
+    if operation == 'mean':
+        return (t1_data + t2_data) / 2
+    if operation == 'diff':
+        return t2_data - t1_data
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(t1_data != 0, 100 * (t2_data - t1_data) / np.abs(t1_data), 0)
+
+
+def output_path(save_dir: str, participant: str, operation: str, compression: int) -> str:
+
+    '''
+    Function to return the output path of a participant.
+    Means keep the name concat_scans has always used.
+
+    Parameters
+    ----------
+    save_dir: str
+        directory to save images to
+
+    participant: str
+        participant i.e B1001
+
+    operation: str
+        mean, diff or pct_change
+
+    compression: int
+        gzip compression level, 0 for uncompressed
+
+    Returns
+    -------
+    str of path
+    '''
+
+    name = participant if operation == 'mean' else f'{participant}_{operation}'
+    return os.path.join(save_dir, f'{name}.nii.gz' if compression else f'{name}.nii')
+
+
+def save_image(image: nibabel.Nifti1Image, path: str, compression: int) -> None:
+
+    '''
+    Function to write an image with a gzip compression level
+    to a temporary file, verify it and move it into place.
+
+    Parameters
+    ----------
+    image: nibabel.Nifti1Image
+        image to save
+
+    path: str
+        path to save image to
+
+    compression: int
+        gzip compression level, 0 for uncompressed
+
+    Returns
+    -------
+    None
+    '''
+
+    tmp_path = f'{path}.tmp{".nii.gz" if compression else ".nii"}'
+    if compression:
+        with gzip.open(tmp_path, 'wb', compresslevel=compression) as image_file:
+            image_file.write(image.to_bytes())
+    else:
+        image.to_filename(tmp_path)
+    saved = nibabel.load(tmp_path)
+    if saved.shape != image.shape or not np.allclose(saved.affine, image.affine):
+        os.remove(tmp_path)
+        raise ValueError(f'Saved image has shape {saved.shape} and affine not matching the input')
+    if not np.isfinite(np.asarray(saved.dataobj)).any():
+        os.remove(tmp_path)
+        raise ValueError('Saved image has no finite values')
+    os.replace(tmp_path, path)
+
+
+def reduce_participant(participant: str, t1_path: str, t2_path: str, operation: str,
+                       save_dir: str, compression: int) -> dict:
+
+    '''
+    Function to reduce and save one participant's
+    images. Runs in the worker processes.
+
+    Parameters
+    ----------
+    participant: str
+        participant i.e B1001
+
+    t1_path: str
+        path to T1 image, NaN if missing
+
+    t2_path: str
+        path to T2 image, NaN if missing
+
+    operation: str
+        mean, diff or pct_change
+
+    save_dir: str
+        directory to save images to
+
+    compression: int
+        gzip compression level, 0 for uncompressed
+
+    Returns
+    -------
+    dict of participant, status, path, error and seconds
+    '''
+
+    start = time.perf_counter()
+    path = output_path(save_dir, participant, operation, compression)
     try:
-        name = re.findall(r'sub-.....', files['t1'].iloc[subject])[0]
-        print('working on ', name)
-        t1_image = img.load_img(files['t1'].iloc[subject])
-        t2_image = img.load_img(files['t2'].iloc[subject])
-        concat_img = img.mean_img([t1_image, t2_image])
-        concat_img.to_filename(f'{save_dir}/{name}.nii.gz')
-        
+        missing = [time_point for time_point, scan in [('T1', t1_path), ('T2', t2_path)] if pd.isna(scan)]
+        if missing:
+            raise FileNotFoundError(f'missing {" and ".join(missing)} contrast map')
+        t1_image = nibabel.load(t1_path)
+        t2_image = nibabel.load(t2_path)
+        if t1_image.shape != t2_image.shape:
+            raise ValueError(f'T1 shape {t1_image.shape} and T2 shape {t2_image.shape} differ')
+        if not np.allclose(t1_image.affine, t2_image.affine, atol=1e-4):
+            raise ValueError('T1 and T2 affines differ')
+        data = reduce_images(t1_image.get_fdata(dtype=np.float32), t2_image.get_fdata(dtype=np.float32), operation)
+        save_image(nibabel.Nifti1Image(data.astype(np.float32), t1_image.affine), path, compression)
+        status, error = 'done', None
     except Exception as e:
-        print(e)
-        continue
+        status, error = 'failed', f'{type(e).__name__}: {e}'
+    return {'participant': participant, 'status': status, 'path': path, 'error': error,
+            'seconds': round(time.perf_counter() - start, 2)}
+
+
+if __name__ == '__main__':
+    flags = options()
+    save_dir = flags['save_dir'] if flags['save_dir'] else os.path.join(config('bayesian'), 'scans')
+    os.makedirs(save_dir, exist_ok=True)
+    files = paired_scans(flags['task'])
+    print(f'Reducing {len(files)} participants to their {flags["operation"]} with {flags["jobs"]} workers')
+    with ProcessPoolExecutor(max_workers=flags['jobs']) as executor:
+        report = list(executor.map(reduce_participant, files.index, files['t1'], files['t2'],
+                                   [flags['operation']] * len(files), [save_dir] * len(files),
+                                   [flags['compression']] * len(files)))
+    report_df = pd.DataFrame(report, columns=['participant', 'status', 'path', 'error', 'seconds'])
+    report_df.to_csv(os.path.join(save_dir, f'concat_report_{flags["task"]}_{flags["operation"]}.csv'), index=False)
+    failed_df = report_df[report_df['status'] == 'failed']
+    print(f'{len(report_df) - len(failed_df)} images saved to {save_dir}')
+    if not failed_df.empty:
+        print(f'{len(failed_df)} failed:')
+        print(failed_df[['participant', 'error']].to_string(index=False))
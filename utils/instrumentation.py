@@ -0,0 +1,354 @@
+from decouple import config
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import argparse
+import functools
+from contextlib import contextmanager
+
+'''
+Timing and resource instrumentation of pipeline stages.
+
+Wrap a stage in the profile context manager, or a function in the
+profiled decorator, and one JSON line is appended to the run's log with
+its wall time, CPU time (of the process and of child processes it waited
+on, i.e nipype's SPM or os.system calls to PALM), peak and growth of
+resident memory (of the process and of its largest waited on child)
+and bytes read and written. Stages can be given a subject and any
+other fields and can be nested.
+
+Every process of a run writes to the same log, named after the SLURM
+job (and array task) or the time and pid of the first process, which
+is passed on to worker processes through the environment. Running this
+file aggregates logs into a per stage report.
+
+Usage
+----
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'utils'))
+from instrumentation import profile, profiled
+
+with profile('glm_fit', subject='sub-B1001', task='eft'):
+    ...
+
+@profiled('load_images')
+def load(...):
+    ...
+'''
+
+stack = []
+
+def log_dir() -> str:
+
+    '''
+    Function to return the profiling log directory
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    str of path to log directory
+    '''
+
+    return config('profiling', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'profiling'))
+
+
+def run_id() -> str:
+
+    '''
+    Function to get the id of the run, set once per
+    run and inherited by child processes.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    str of run id
+    '''
+
+    if 'PROFILE_RUN_ID' not in os.environ:
+        if 'SLURM_JOB_ID' in os.environ:
+            run = f'slurm-{os.environ.get("SLURM_ARRAY_JOB_ID", os.environ["SLURM_JOB_ID"])}'
+            if 'SLURM_ARRAY_TASK_ID' in os.environ:
+                run += f'_{os.environ["SLURM_ARRAY_TASK_ID"]}'
+        else:
+            run = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+        os.environ['PROFILE_RUN_ID'] = run
+    return os.environ['PROFILE_RUN_ID']
+
+
+def io_bytes() -> tuple:
+
+    '''
+    Function to get the bytes read and written by the process.
+    Uses /proc/self/io where available, otherwise block counts.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    tuple of bytes read and bytes written
+    '''
+
+    try:
+        with open('/proc/self/io') as io_file:
+            counters = dict(line.split(': ') for line in io_file.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+
+def snapshot() -> dict:
+
+    '''
+    Function to take a snapshot of the
+    process's resource counters.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    dict of counters
+    '''
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = io_bytes()
+    return {
+        'wall': time.perf_counter(),
+        'cpu': own.ru_utime + own.ru_stime,
+        'children_cpu': children.ru_utime + children.ru_stime,
+        # ru_maxrss is in kilobytes on linux and bytes on mac
+        'max_rss_mb': own.ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024),
+        'children_max_rss_mb': children.ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024),
+        'read_bytes': read_bytes,
+        'write_bytes': write_bytes,
+    }
+
+
+def write_record(record: dict) -> None:
+
+    '''
+    Function to append a record to the run's log.
+    Lines are written in one call to a file opened
+    for appending so processes can share the log.
+
+    Parameters
+    ----------
+    record: dict
+        record to write
+
+    Returns
+    -------
+    None
+    '''
+
+    os.makedirs(log_dir(), exist_ok=True)
+    with open(os.path.join(log_dir(), f'{record["run"]}.jsonl'), 'a') as log:
+        log.write(json.dumps(record, default=str) + '\n')
+
+
+@contextmanager
+def profile(stage: str, subject: str = None, **fields):
+
+    '''
+    Context manager to record the resources used by a stage.
+    Errors are recorded and raised again.
+
+    Parameters
+    ----------
+    stage: str
+        name of stage
+
+    subject: str
+        subject the stage is ran on
+
+    fields:
+        extra fields to record i.e task or domain
+
+    Returns
+    -------
+    None
+    '''
+
+    start = snapshot()
+    started = time.strftime('%Y-%m-%dT%H:%M:%S')
+    parent = stack[-1] if stack else None
+    stack.append(stage)
+    status, error = 'ok', None
+    try:
+        yield
+    except BaseException as e:
+        status, error = 'error', f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        stack.pop()
+        end = snapshot()
+        write_record({
+            'run': run_id(),
+            'script': os.path.basename(sys.argv[0]),
+            'stage': stage,
+            'parent': parent,
+            'subject': subject,
+            **fields,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'start': started,
+            'wall_s': round(end['wall'] - start['wall'], 4),
+            'cpu_s': round(end['cpu'] - start['cpu'], 4),
+            'children_cpu_s': round(end['children_cpu'] - start['children_cpu'], 4),
+            'peak_rss_mb': round(end['max_rss_mb'], 1),
+            'rss_growth_mb': round(end['max_rss_mb'] - start['max_rss_mb'], 1),
+            'children_peak_rss_mb': round(end['children_max_rss_mb'], 1),
+            'read_mb': round((end['read_bytes'] - start['read_bytes']) / 1024 ** 2, 3),
+            'write_mb': round((end['write_bytes'] - start['write_bytes']) / 1024 ** 2, 3),
+            'status': status,
+            'error': error,
+        })
+
+
+def profiled(stage: str = None, subject_arg: str = None):
+
+    '''
+    Decorator to profile every call of a function
+
+    Parameters
+    ----------
+    stage: str
+        name of stage. Default function name
+
+    subject_arg: str
+        name of the keyword argument holding the subject
+
+    Returns
+    -------
+    function: decorator
+    '''
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile(stage if stage else function.__name__, kwargs.get(subject_arg) if subject_arg else None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def read_logs(paths: list):
+
+    '''
+    Function to read profiling logs
+
+    Parameters
+    ----------
+    paths: list
+        list of paths to jsonl logs
+
+    Returns
+    -------
+    pd.DataFrame of records
+    '''
+
+    import pandas as pd
+    records = []
+    for path in paths:
+        with open(path) as log:
+            records.extend(json.loads(line) for line in log if line.strip())
+    return pd.DataFrame(records)
+
+
+def report(records_df):
+
+    '''
+    Function to aggregate records into a per stage report.
+    Share of wall time is of the top level stages of each
+    run, so nested stages aren't counted twice.
+
+    Parameters
+    ----------
+    records_df: pd.DataFrame
+        profiling records
+
+    Returns
+    -------
+    pd.DataFrame of stage summaries sorted by total wall time
+    '''
+
+    if 'children_peak_rss_mb' not in records_df:
+        records_df = records_df.assign(children_peak_rss_mb=float('nan'))
+    summary_df = records_df.groupby(['script', 'stage'], dropna=False).agg(
+        calls=('wall_s', 'size'),
+        errors=('status', lambda status: int((status == 'error').sum())),
+        subjects=('subject', 'nunique'),
+        wall_total_s=('wall_s', 'sum'),
+        wall_mean_s=('wall_s', 'mean'),
+        wall_p95_s=('wall_s', lambda wall: wall.quantile(0.95)),
+        wall_max_s=('wall_s', 'max'),
+        cpu_total_s=('cpu_s', 'sum'),
+        children_cpu_total_s=('children_cpu_s', 'sum'),
+        peak_rss_mb=('peak_rss_mb', 'max'),
+        children_peak_rss_mb=('children_peak_rss_mb', 'max'),
+        read_mb=('read_mb', 'sum'),
+        write_mb=('write_mb', 'sum'),
+    ).reset_index()
+    summary_df['cpu_per_wall'] = ((summary_df['cpu_total_s'] + summary_df['children_cpu_total_s'])
+                                  / summary_df['wall_total_s'].where(summary_df['wall_total_s'] > 0))
+    top_level_wall = records_df.loc[records_df['parent'].isna(), 'wall_s'].sum()
+    summary_df['wall_share'] = summary_df['wall_total_s'] / top_level_wall if top_level_wall else float('nan')
+    return summary_df.sort_values('wall_total_s', ascending=False).round(3)
+
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of runs and output
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-r', '--runs',
+                      dest='runs',
+                      nargs='+',
+                      default=None,
+                      help='Run ids or prefixes to report, i.e slurm-1234. Default most recent run')
+    args.add_argument('-o', '--output',
+                      dest='output',
+                      default=None,
+                      help='Path to save report csv to')
+    return vars(args.parse_args())
+
+
+if __name__ == '__main__':
+    flags = options()
+    logs = sorted((os.path.join(log_dir(), name) for name in os.listdir(log_dir()) if name.endswith('.jsonl')),
+                  key=os.path.getmtime)
+    if flags['runs']:
+        logs = [log for log in logs if any(os.path.basename(log).startswith(run) for run in flags['runs'])]
+    else:
+        logs = logs[-1:]
+    records_df = read_logs(logs)
+    print(f'{len(records_df)} records from {len(logs)} logs')
+    report_df = report(records_df)
+    print(report_df[['script', 'stage', 'calls', 'errors', 'subjects', 'wall_total_s', 'wall_share',
+                     'cpu_per_wall', 'peak_rss_mb', 'read_mb']].to_string(index=False))
+    if flags['output']:
+        report_df.to_csv(flags['output'], index=False)
@@ -0,0 +1,385 @@
+from decouple import config
+import os
+import re
+import json
+import time
+import argparse
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Bulk rename of derivative files from declarative plans.
+
+A plan is a regex that selects files by name and an ordered list of
+(pattern, replacement) rules applied to the file name, never to the
+directories above it. The tree is scanned with one thread per top level
+directory, every rename is planned before anything is moved and the plan
+is checked for collisions (two files renamed to the same name, or onto a
+file that already exists and isn't itself being moved).
+
+Renames are executed in two phases, every file to a temporary name and
+then every temporary name to its new name, so chains and swaps within a
+plan are safe. Each step is written to a journal before it is done, a
+failed run is rolled back from its journal and a finished run can be
+undone with --rollback.
+'''
+
+palm_contrasts = {'c1': 'time', 'c2': 'interaction'}
+plans = {
+    'palm': {
+        'description': 'PALM outputs to short names i.e mixed_model_tfce_tstat_fwep_c1 to tfce_fwep_time',
+        'root': os.path.join('{task_dir}', '2ndlevel'),
+        'match': r'^(mixed_model|group)_.+_[cf]\d+\.nii(\.gz)?$',
+        'rules': [(r'^(mixed_model|group)_', ''),
+                  (r'tstat_fwep', 'fwep'),
+                  (r'_c1(?=\.nii)', '_time'),
+                  (r'_c2(?=\.nii)', '_interaction')],
+    },
+    'palm_bids': {
+        'description': 'PALM outputs to BIDS derivatives i.e task-eft_desc-mixedmodel_contrast-time_stat-tfcefwep_statmap',
+        'root': os.path.join('{task_dir}', '2ndlevel'),
+        'match': r'^(mixed_model|group)_((vox|tfce|clustere|clusterm|dpv|dat)_)?[tfz]stat(_(fwep|fdrp|uncp))?_[cf]\d+\.nii(\.gz)?$',
+        'rules': [(r'^mixed_model_(?P<rest>.+)$', r'desc-mixedmodel_\g<rest>'),
+                  (r'^group_(?P<rest>.+)$', r'desc-group_\g<rest>'),
+                  (r'^(?P<desc>desc-\w+?)_(?P<inference>vox|tfce|clustere|clusterm|dpv|dat)_(?P<stat>[tfz]stat)_(?P<p>fwep|fdrp|uncp)_',
+                   r'\g<desc>_stat-\g<inference>\g<p>_'),
+                  (r'^(?P<desc>desc-\w+?)_(?P<inference>vox|tfce|clustere|clusterm|dpv|dat)_(?P<stat>[tfz]stat)_',
+                   r'\g<desc>_stat-\g<inference>\g<stat>_'),
+                  # Statistics without an inference prefix i.e mixed_model_tstat_c1
+                  (r'^(?P<desc>desc-\w+?)_(?P<stat>[tfz]stat)_(?P<p>fwep|fdrp|uncp)_', r'\g<desc>_stat-\g<stat>\g<p>_'),
+                  (r'^(?P<desc>desc-\w+?)_(?P<stat>[tfz]stat)_', r'\g<desc>_stat-\g<stat>_'),
+                  *[(rf'_{contrast}(?=\.nii)', f'_contrast-{label}') for contrast, label in palm_contrasts.items()],
+                  (r'_(?P<contrast>[cf]\d+)(?=\.nii)', r'_contrast-\g<contrast>'),
+                  (r'^(?P<entities>desc-\w+?_stat-\w+?)_(?P<contrast>contrast-\w+)(?=\.nii)', r'task-{task}_\g<entities>_\g<contrast>_statmap')],
+    },
+    'confounds': {
+        'description': 'fmriprep confounds regressors to timeseries i.e desc-confounds_regressors.tsv to desc-confounds_timeseries.tsv',
+        'root': '{task_dir}',
+        'match': r'^sub-.+_task-{task}_desc-confounds_regressors\.(tsv|json)$',
+        'rules': [(r'_regressors(?=\.(tsv|json)$)', '_timeseries')],
+    },
+}
+
+def options() -> dict:
+
+    '''
+    Function to accept accept command line flags.
+
+    Parameters
+    ---------
+    None
+
+    Returns
+    -------
+    dict: dictionary object
+        Dictionary of flags
+    '''
+
+    args = argparse.ArgumentParser()
+    args.add_argument('-p', '--plan',
+                      dest='plan',
+                      choices=list(plans.keys()),
+                      help='Rename plan to run')
+    args.add_argument('-t', '--task',
+                      dest='task',
+                      help='Task name. Either happy, eft or fear')
+    args.add_argument('-d', '--directory',
+                      dest='directory',
+                      default=None,
+                      help='Directory to scan. Default from plan')
+    args.add_argument('-j', '--jobs',
+                      dest='jobs',
+                      type=int,
+                      default=8,
+                      help='Number of directory scan threads')
+    args.add_argument('-n', '--dry_run',
+                      dest='dry_run',
+                      action='store_true',
+                      help='Only print the plan')
+    args.add_argument('-r', '--rollback',
+                      dest='rollback',
+                      default=None,
+                      help='Journal of a run to roll back')
+    return vars(args.parse_args())
+
+
+def resolve_plan(name: str, task: str) -> dict:
+
+    '''
+    Function to fill in the task of a plan
+
+    Parameters
+    ----------
+    name: str
+        plan name
+
+    task: str
+        task name
+
+    Returns
+    -------
+    dict of plan with root, match and rules
+    with task filled in
+    '''
+
+    plan = plans[name]
+    fields = {'task': task, 'task_dir': config(task)}
+    return {
+        'root': plan['root'].format(**fields),
+        'match': re.compile(plan['match'].replace('{task}', task)),
+        'rules': [(re.compile(pattern), replacement.replace('{task}', task)) for pattern, replacement in plan['rules']],
+    }
+
+
+def scan_tree(directory: str, match: re.Pattern) -> list:
+
+    '''
+    Function to walk a directory tree with scandir
+    and return files whose name matches.
+
+    Parameters
+    ----------
+    directory: str
+        directory to walk
+
+    match: re.Pattern
+        compiled regex of file names
+
+    Returns
+    -------
+    list of paths
+    '''
+
+    paths, directories = [], [directory]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif match.search(entry.name):
+                    paths.append(entry.path)
+    return paths
+
+
+def scan(root: str, match: re.Pattern, n_jobs: int = 8) -> list:
+
+    '''
+    Function to scan a tree for files to rename
+    with a thread per top level directory.
+
+    Parameters
+    ----------
+    root: str
+        root of tree
+
+    match: re.Pattern
+        compiled regex of file names
+
+    n_jobs: int
+        number of threads
+
+    Returns
+    -------
+    list of sorted paths
+    '''
+
+    with os.scandir(root) as entries:
+        entries = list(entries)
+    paths = [entry.path for entry in entries if not entry.is_dir(follow_symlinks=False) and match.search(entry.name)]
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for tree_paths in executor.map(scan_tree, [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)],
+                                       [match] * len(entries)):
+            paths.extend(tree_paths)
+    return sorted(paths)
+
+
+def plan_renames(paths: list, rules: list) -> pd.DataFrame:
+
+    '''
+    Function to plan the new name of every file
+
+    Parameters
+    ----------
+    paths: list
+        list of paths
+
+    rules: list
+        list of compiled (pattern, replacement) rules
+
+    Returns
+    -------
+    pd.DataFrame of src and dst of files that change name
+    '''
+
+    renames = []
+    for path in paths:
+        name = os.path.basename(path)
+        for pattern, replacement in rules:
+            name = pattern.sub(replacement, name)
+        if name != os.path.basename(path):
+            renames.append({'src': path, 'dst': os.path.join(os.path.dirname(path), name)})
+    return pd.DataFrame(renames, columns=['src', 'dst'])
+
+
+def collisions(plan_df: pd.DataFrame) -> pd.DataFrame:
+
+    '''
+    Function to find renames that would overwrite a file
+
+    Parameters
+    ----------
+    plan_df: pd.DataFrame
+        planned renames
+
+    Returns
+    -------
+    pd.DataFrame of colliding renames with reason
+    '''
+
+    duplicated = plan_df[plan_df['dst'].duplicated(keep=False)].assign(reason='same new name')
+    sources = set(plan_df['src'])
+    existing = plan_df[plan_df['dst'].map(lambda dst: os.path.lexists(dst) and dst not in sources)]
+    return pd.concat([duplicated, existing.assign(reason='new name exists')])
+
+
+def journal_step(journal, src: str, dst: str) -> None:
+
+    '''
+    Function to record a rename in the journal
+    before it is done.
+
+    Parameters
+    ----------
+    journal: file object
+        open journal
+
+    src: str
+        path before rename
+
+    dst: str
+        path after rename
+
+    Returns
+    -------
+    None
+    '''
+
+    journal.write(json.dumps({'src': src, 'dst': dst}) + '\n')
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def rollback(journal_path: str) -> int:
+
+    '''
+    Function to undo the renames of a journal in
+    reverse order. Steps that were journaled but
+    not done are skipped.
+
+    Parameters
+    ----------
+    journal_path: str
+        path to journal
+
+    Returns
+    -------
+    int of number of renames undone
+    '''
+
+    with open(journal_path) as journal:
+        steps = [json.loads(line) for line in journal if line.strip()]
+    undone = 0
+    for step in reversed(steps):
+        if os.path.lexists(step['dst']) and not os.path.lexists(step['src']):
+            os.rename(step['dst'], step['src'])
+            undone += 1
+    return undone
+
+
+def execute(plan_df: pd.DataFrame, journal_path: str) -> None:
+
+    '''
+    Function to run planned renames in two phases through
+    temporary names, rolling back if any rename fails.
+
+    Parameters
+    ----------
+    plan_df: pd.DataFrame
+        planned renames
+
+    journal_path: str
+        path to write journal to
+
+    Returns
+    -------
+    None
+    '''
+
+    run_id = os.path.basename(journal_path).split('.')[0]
+    temporary = [os.path.join(os.path.dirname(src), f'.{run_id}_{index}') for index, src in enumerate(plan_df['src'])]
+    try:
+        with open(journal_path, 'w') as journal:
+            for src, tmp in zip(plan_df['src'], temporary):
+                journal_step(journal, src, tmp)
+                os.rename(src, tmp)
+            for tmp, dst in zip(temporary, plan_df['dst']):
+                journal_step(journal, tmp, dst)
+                os.rename(tmp, dst)
+    except Exception as e:
+        print(f'Rename failed with {type(e).__name__}: {e}. Rolling back')
+        print(f'Rolled back {rollback(journal_path)} renames')
+        raise
+
+
+def relayout(plan: str, task: str, directory: str = None, n_jobs: int = 8, dry_run: bool = False) -> pd.DataFrame:
+
+    '''
+    Function to scan, plan, check and run a rename plan.
+
+    Parameters
+    ----------
+    plan: str
+        plan name
+
+    task: str
+        task name
+
+    directory: str
+        directory to scan. Default from plan
+
+    n_jobs: int
+        number of scan threads
+
+    dry_run: bool
+        only plan the renames
+
+    Returns
+    -------
+    pd.DataFrame of planned renames
+    '''
+
+    resolved = resolve_plan(plan, task)
+    root = directory if directory else resolved['root']
+    print(f'Scanning {root}')
+    plan_df = plan_renames(scan(root, resolved['match'], n_jobs), resolved['rules'])
+    print(f'{len(plan_df)} files to rename')
+    collisions_df = collisions(plan_df)
+    if not collisions_df.empty:
+        print(collisions_df.to_string(index=False))
+        raise ValueError(f'{len(collisions_df)} renames collide, nothing was renamed')
+    if dry_run or plan_df.empty:
+        return plan_df
+    journal_path = os.path.join(root, f'relayout_{plan}_{time.strftime("%Y%m%d%H%M%S")}.jsonl')
+    execute(plan_df, journal_path)
+    print(f'Renamed {len(plan_df)} files. Journal saved to {journal_path}')
+    return plan_df
+
+
+if __name__ == '__main__':
+    flags = options()
+    if flags['rollback']:
+        print(f'Rolled back {rollback(flags["rollback"])} renames')
+    else:
+        plan_df = relayout(flags['plan'], flags['task'], flags['directory'], flags['jobs'], flags['dry_run'])
+        for src, dst in plan_df.itertuples(index=False):
+            print(f'{os.path.relpath(src, os.path.dirname(os.path.dirname(src)))} -> {os.path.basename(dst)}')